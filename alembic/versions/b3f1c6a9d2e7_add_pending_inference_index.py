@@ -0,0 +1,27 @@
+"""add pending inference index
+
+Revision ID: b3f1c6a9d2e7
+Revises: e49f0ac2240d
+Create Date: 2026-10-17 10:12:43.518306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c6a9d2e7'
+down_revision = 'e49f0ac2240d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('slippy_tiles', schema=None) as batch_op:
+        batch_op.create_index('pending_inference_index', ['polygon_name', 'centroid_distance'], unique=False,
+                              sqlite_where=sa.text('inference_ran = 0 AND centroid_distance IS NOT NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('slippy_tiles', schema=None) as batch_op:
+        batch_op.drop_index('pending_inference_index')
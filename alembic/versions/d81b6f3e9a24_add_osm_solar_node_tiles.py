@@ -0,0 +1,55 @@
+"""add osm solar node tiles
+
+Adds the slippy tile each OSM solar node is in, so nodes can be joined against slippy_tiles on tile coordinates.
+
+Revision ID: d81b6f3e9a24
+Revises: b3f1c6a9d2e7
+Create Date: 2026-10-18 00:12:47.903114
+
+"""
+import math
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81b6f3e9a24'
+down_revision = 'b3f1c6a9d2e7'
+branch_labels = None
+depends_on = None
+
+ZOOM = 21
+
+
+def deg2num(lon_deg, lat_deg, zoom=ZOOM):
+    # the same as process_city_shapes.deg2num, copied so this migration doesn't change if that does
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    return (int((lon_deg + 180.0) / 360.0 * n),
+            int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n))
+
+
+def upgrade():
+    with op.batch_alter_table('osm_solar_nodes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('column', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('row', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('zoom', sa.Integer(), nullable=True))
+        batch_op.create_index('osm_solar_node_tile_index', ['row', 'column', 'zoom'], unique=False)
+
+    connection = op.get_bind()
+    nodes = connection.execute(sa.text('SELECT longitude, latitude FROM osm_solar_nodes')).fetchall()
+    if nodes:
+        connection.execute(
+            sa.text('UPDATE osm_solar_nodes SET "column" = :column, "row" = :row, zoom = :zoom '
+                    'WHERE longitude = :longitude AND latitude = :latitude'),
+            [dict(zip(('column', 'row'), deg2num(longitude, latitude)), zoom=ZOOM, longitude=longitude,
+                  latitude=latitude) for longitude, latitude in nodes])
+
+
+def downgrade():
+    with op.batch_alter_table('osm_solar_nodes', schema=None) as batch_op:
+        batch_op.drop_index('osm_solar_node_tile_index')
+        batch_op.drop_column('zoom')
+        batch_op.drop_column('row')
+        batch_op.drop_column('column')
@@ -0,0 +1,83 @@
+"""
+Compares tracing cluster outlines straight from the tile grid (clustering.trace_rings) with how
+get_clustered_positive_polygon_dicts used to outline them, a shapely box per tile unioned per cluster, and checks the
+two cover exactly the same area.
+
+Run from the repository root: python benchmarks/benchmark_cluster_outlines.py --clusters 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from shapely.geometry import Polygon, box
+from shapely.ops import unary_union
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import clustering
+
+
+def generate_clusters(cluster_count, max_side, fill=0.8, seed=0):
+    """
+    Generates clusters of positive tiles that are ragged squares of random sizes, so plenty of them have holes or fall
+    apart into several parts, spread out so they don't touch.
+
+    :return: tuple of (coordinates, labels), ndarrays of each tile's (column, row) and which cluster it's in
+    """
+    random_state = np.random.RandomState(seed)
+    coordinates, labels = [], []
+    for label, side in enumerate(random_state.randint(1, max_side + 1, cluster_count)):
+        offsets = np.argwhere(random_state.rand(side, side) < fill)
+        if not len(offsets):
+            offsets = np.zeros((1, 2), dtype=np.int64)
+        coordinates.append(offsets + (label * (max_side + 1), 0))
+        labels.append(np.full(len(offsets), label))
+    return np.vstack(coordinates), np.concatenate(labels)
+
+
+def union_outlines(coordinates, labels):
+    """The implementation get_clustered_positive_polygon_dicts used before trace_rings, kept here as the baseline."""
+    order = np.argsort(labels, kind='stable')
+    ends = np.flatnonzero(np.diff(labels[order])) + 1
+    return [unary_union([box(column, row, column + 1, row + 1) for column, row in cluster.tolist()])
+            for cluster in np.split(coordinates[order], ends)]
+
+
+def traced_outlines(coordinates, labels):
+    rings, ring_labels, ring_components, areas = clustering.trace_rings(coordinates, labels)
+    return rings, clustering.group_rings(ring_labels, ring_components, areas)
+
+
+def to_shapely(rings, polygons):
+    return unary_union([Polygon(rings[polygon[0]], [rings[hole] for hole in polygon[1:]]) for polygon in polygons])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark tracing cluster outlines against unioning tile boxes')
+    parser.add_argument('--clusters', dest='clusters', type=int, default=20000,
+                        help='Number of clusters to outline, default 20000')
+    parser.add_argument('--max_side', dest='max_side', type=int, default=30,
+                        help='Clusters are up to this many tiles on a side, default 30')
+    parser.add_argument('--check', dest='check', type=int, default=1000,
+                        help='Number of clusters to check against the baseline, default 1000')
+    args = parser.parse_args()
+
+    coordinates, labels = generate_clusters(args.clusters, args.max_side)
+    start_time = time.time()
+    expected = union_outlines(coordinates, labels)
+    union_seconds = time.time() - start_time
+    start_time = time.time()
+    rings, label_polygons = traced_outlines(coordinates, labels)
+    trace_seconds = time.time() - start_time
+    vertex_count = sum(len(ring) for ring in rings)
+    print("{0} tiles in {1} clusters: {2:.3f}s unioning tile boxes vs {3:.3f}s tracing {4} rings ({5} vertices), "
+          "{6:.1f}x faster".format(len(coordinates), args.clusters, union_seconds, trace_seconds, len(rings),
+                                   vertex_count, union_seconds / trace_seconds))
+    print("{0} clusters have holes, {1} have separate parts".format(
+        sum(any(len(polygon) > 1 for polygon in polygons) for polygons in label_polygons.values()),
+        sum(len(polygons) > 1 for polygons in label_polygons.values())))
+    for label in range(min(args.check, args.clusters)):
+        actual = to_shapely(rings, label_polygons[label])
+        assert actual.is_valid and actual.symmetric_difference(expected[label]).area == 0
@@ -0,0 +1,129 @@
+"""
+Compares the array versions of deg2num/num2deg with converting a coordinate at a time, which is how
+convert_to_slippy_tile_coords and the maproulette exports used to call them: on a GeometryCollection of every city
+polygon, and on exporting large sets of positive tiles and clusters to maproulette geojson.
+
+Run from the repository root: python benchmarks/benchmark_coordinate_conversion.py --tiles 1000000
+Pass --input_csv data/100k_US_cities.csv to convert the real city polygons (which must already be gathered) rather
+than generated ones.
+"""
+import argparse
+import functools
+import os
+import sys
+import time
+
+import numpy as np
+from shapely.geometry import shape, mapping, box
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import maproulette
+import process_city_shapes
+
+# roughly the contiguous US
+LONGITUDE_RANGE = (-124.0, -70.0)
+LATITUDE_RANGE = (26.0, 48.0)
+
+
+def generate_city_polygons(city_count, seed=0):
+    """Generates simplified city polygons the way combine_all_polygons would, from random clouds of points."""
+    random_state = np.random.RandomState(seed)
+    polygons = []
+    for _ in range(city_count):
+        center = (random_state.uniform(*LONGITUDE_RANGE), random_state.uniform(*LATITUDE_RANGE))
+        points = center + random_state.normal(scale=random_state.uniform(0.02, 0.2), size=(50, 2))
+        polygons.append(process_city_shapes.simplify_polygon({'type': 'MultiPoint', 'coordinates': points.tolist()}))
+    return polygons
+
+
+def convert_to_slippy_tile_coords_per_vertex(polygons, zoom=21):
+    """The implementation convert_to_slippy_tile_coords used before deg2num_array, kept here as the baseline."""
+    converted_polygons = []
+    for polygon in polygons:
+        geojson_object = mapping(polygon)
+        geojson_object['coordinates'] = np.apply_along_axis(process_city_shapes.deg2num, 2,
+                                                            np.array(geojson_object['coordinates']), zoom=zoom)
+        converted_polygons.append(shape(geojson_object))
+    return converted_polygons
+
+
+def tile_outline_points_per_vertex(column_rows, as_strings=True):
+    """How create_simple_maproulette_geojson used to turn each tile into its outline's points, kept as the baseline."""
+    all_points = []
+    for column, row in column_rows:
+        bounding_polygon_slippy_coordinates = [(column, row), (column + 1, row), (column + 1, row + 1),
+                                               (column, row + 1), (column, row)]
+        bounding_polygon_lon_lat_coordinates = \
+            map(functools.partial(process_city_shapes.num2deg, center=False), bounding_polygon_slippy_coordinates)
+        points = [list(coordinates) for coordinates in bounding_polygon_lon_lat_coordinates]
+        all_points.append(str(points) if as_strings else points)
+    return all_points
+
+
+def tile_outline_points(column_rows, as_strings=True):
+    outlines = maproulette.get_tile_outlines_lon_lat(column_rows)
+    return [str(outline.tolist()) for outline in outlines] if as_strings else outlines
+
+
+def cluster_outline_points_per_vertex(outlines, as_strings=True):
+    """How get_clustered_positive_polygon_dicts used to convert each cluster's outline, kept as the baseline."""
+    all_points = []
+    for outline in outlines:
+        points = [list(coordinates) for coordinates in
+                  map(functools.partial(process_city_shapes.num2deg, center=False), zip(*outline.exterior.xy))]
+        all_points.append(str(points) if as_strings else points)
+    return all_points
+
+
+def cluster_outline_points(outlines, as_strings=True):
+    outlines = maproulette.get_rings_lon_lat([np.column_stack(outline.exterior.xy) for outline in outlines])
+    return [str(outline.tolist()) for outline in outlines] if as_strings else outlines
+
+
+def compare(name, item_count, baseline, vectorized, *args):
+    start_time = time.time()
+    expected = baseline(*args)
+    baseline_seconds = time.time() - start_time
+    start_time = time.time()
+    actual = vectorized(*args)
+    vectorized_seconds = time.time() - start_time
+    print("{0}: {1:.3f}s per coordinate vs {2:.3f}s as arrays for {3} items ({4:.1f}x faster)".format(
+        name, baseline_seconds, vectorized_seconds, item_count, baseline_seconds / vectorized_seconds))
+    return expected, actual
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark per coordinate against array coordinate conversion')
+    parser.add_argument('--input_csv', dest='csvpath', default=None,
+                        help='Convert the real polygons of the cities in this csv instead of generated ones')
+    parser.add_argument('--cities', dest='cities', type=int, default=311,
+                        help='Number of city polygons to generate, default 311 (as many as data/100k_US_cities.csv)')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=1000000,
+                        help='Number of positive tiles to export, default 1000000')
+    parser.add_argument('--clusters', dest='clusters', type=int, default=200000,
+                        help='Number of positive clusters to export, default 200000')
+    args = parser.parse_args()
+
+    if args.csvpath:
+        polygons = list(process_city_shapes.combine_all_polygons(args.csvpath))
+    else:
+        polygons = generate_city_polygons(args.cities)
+    expected, actual = compare('convert_to_slippy_tile_coords', len(polygons), convert_to_slippy_tile_coords_per_vertex,
+                               process_city_shapes.convert_to_slippy_tile_coords, polygons)
+    assert all(before.equals_exact(after, 0) for before, after in zip(expected, actual))
+
+    random_state = np.random.RandomState(0)
+    column_rows = random_state.randint(2 ** 19, 2 ** 20, (args.tiles, 2))
+    sides = random_state.randint(1, 5, args.clusters)
+    outlines = [box(column, row, column + side, row + side)
+                for (column, row), side in zip(column_rows[:args.clusters].tolist(), sides.tolist())]
+    # writing the geojson means formatting every float as a string, which costs the same either way, so the
+    # conversion is also timed on its own
+    for as_strings, suffix in [(False, ''), (True, ' (and formatting)')]:
+        expected, actual = compare('maproulette tile outlines' + suffix, args.tiles, tile_outline_points_per_vertex,
+                                   tile_outline_points, column_rows, as_strings)
+        # the last digit or so can differ, numpy's and math's trig functions don't round identically
+        assert as_strings or np.allclose(expected, actual, rtol=0, atol=1e-9)
+        expected, actual = compare('maproulette cluster outlines' + suffix, args.clusters,
+                                   cluster_outline_points_per_vertex, cluster_outline_points, outlines, as_strings)
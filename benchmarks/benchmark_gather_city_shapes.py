@@ -0,0 +1,67 @@
+"""
+Gathers city polygons from a local stub nominatim server (see synthetic.StubNominatimServer) a city at a time and
+then with a pool of workers, and checks that a second gather is answered without any requests, in a throwaway working
+directory so data/ is never touched.
+
+Run from the repository root: python benchmarks/benchmark_gather_city_shapes.py --cities 200 --latency 0.2
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import gather_city_shapes
+import synthetic
+
+
+def write_cities_csv(filename, city_count):
+    with open(filename, 'w') as outfile:
+        for index in range(city_count):
+            outfile.write('City {index}, State {state}\n'.format(index=index, state=index % 50))
+
+
+def time_gather(csvpath, server, workers):
+    requests_before = server.requests
+    start_time = time.time()
+    failures = gather_city_shapes.gather(csvpath, workers=workers)
+    return time.time() - start_time, server.requests - requests_before, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark gathering city polygons against a stub nominatim')
+    parser.add_argument('--cities', dest='cities', type=int, default=200, help='Number of cities, default 200')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.2,
+                        help='Seconds the stub takes to answer each request, default 0.2')
+    parser.add_argument('--failure_rate', dest='failure_rate', type=float, default=0.05,
+                        help='Fraction of requests the stub fails with a 503, default 0.05')
+    parser.add_argument('--workers', dest='workers', type=int, default=8, help='Number of workers, default 8')
+    parser.add_argument('--rate', dest='rate', type=float, default=None,
+                        help='Requests per second limit, default none as the stub has no usage policy')
+    args = parser.parse_args()
+
+    server = synthetic.StubNominatimServer(latency=args.latency, failure_rate=args.failure_rate)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        csvpath = 'cities.csv'
+        write_cities_csv(csvpath, args.cities)
+        for workers in [1, args.workers]:
+            shutil.rmtree('data', ignore_errors=True)
+            gather_city_shapes.configure_nominatim(url=server.url, rate=args.rate)
+            seconds, request_count, failures = time_gather(csvpath, server, workers)
+            print("{workers} workers: {cities} cities in {seconds:.2f}s ({rate:.1f} cities/s), {requests} requests, "
+                  "{failures} failed".format(workers=workers, cities=args.cities, seconds=seconds,
+                                             rate=args.cities / seconds, requests=request_count,
+                                             failures=len(failures)))
+        # resuming skips the cities already gathered, and the cache answers for any whose files are gone
+        _, request_count, _ = time_gather(csvpath, server, args.workers)
+        assert request_count == 0
+        shutil.rmtree(os.path.join('data', 'geoJSON'))
+        _, request_count, failures = time_gather(csvpath, server, args.workers)
+        assert request_count == 0 and not failures
+        assert len(os.listdir(os.path.join('data', 'geoJSON'))) == args.cities
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    server.close()
@@ -0,0 +1,71 @@
+"""
+Prefetches query grids with ImageryPrefetcher from a local stub imagery server (see synthetic.StubImageryServer),
+requested over http through UrlStaticService, once without a rate limit and once with the RateLimiter set to the rate
+the stub allows, on a throwaway database and imagery directory so data/ is never touched. Checks every grid ends up
+saved either way, and reports how many requests the stub turned away with a 429.
+
+Run from the repository root: python benchmarks/benchmark_imagery_prefetch.py --grids 40 --latency 0.1 --rate 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import imagery
+import solardb
+import synthetic
+from synthetic import BASE_COORDS
+
+
+def get_grid_centers(grid_count, grid_size=imagery.GRID_SIZE, zoom=imagery.FINAL_ZOOM):
+    """
+    :return: list of (column, row, zoom) of a tile in the middle of each of grid_count query grids, spaced out so the
+    grids of their border tiles never overlap
+    """
+    base = imagery.get_grid_base_coords(BASE_COORDS, grid_size=grid_size)
+    side = int(grid_count ** 0.5) + 1
+    return [(base[0] + 2 * grid_size * (index % side) + grid_size // 2,
+             base[1] + 2 * grid_size * (index // side) + grid_size // 2, zoom) for index in range(grid_count)]
+
+
+def time_prefetch(name, server, coords, directory, workers, rate):
+    imagery.tile_storage = imagery.FileTileStorage(directory)
+    imagery.configure_imagery_service(url=server.url, rate=rate)
+    requests_before, rate_limited_before = server.requests, server.rate_limited
+    start_time = time.time()
+    prefetcher = imagery.ImageryPrefetcher(workers=workers)
+    queued = prefetcher.prefetch(coords)
+    prefetcher.shutdown(wait=True)
+    seconds = time.time() - start_time
+    print("{name}: {grids} grids in {seconds:.2f}s ({rate:.1f} grids/s), {requests} requests, {limited} got a 429"
+          .format(name=name, grids=queued, seconds=seconds, rate=queued / seconds,
+                  requests=server.requests - requests_before, limited=server.rate_limited - rate_limited_before))
+    assert queued == len(coords) and prefetcher.fetched == queued and not prefetcher.failed
+    assert not imagery.get_missing_grids(coords)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark prefetching imagery grids against a stub imagery server')
+    parser.add_argument('--grids', dest='grids', type=int, default=40, help='Number of grids to fetch, default 40')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.1,
+                        help='Seconds the stub takes to answer each request, default 0.1')
+    parser.add_argument('--rate', dest='rate', type=float, default=20,
+                        help='Requests per second the stub answers before it starts sending 429s, default 20')
+    parser.add_argument('--failure_rate', dest='failure_rate', type=float, default=0.0,
+                        help='Fraction of requests the stub sends a 429 regardless of the rate, default 0')
+    parser.add_argument('--workers', dest='workers', type=int, default=8, help='Number of prefetch workers, default 8')
+    args = parser.parse_args()
+
+    server = synthetic.StubImageryServer(latency=args.latency, rate=args.rate, failure_rate=args.failure_rate)
+    server.warm_up(width=imagery.MAX_IMAGE_SIDE_LENGTH, retina=imagery.ZOOM_FACTOR > 0)
+    coords = get_grid_centers(args.grids)
+    with tempfile.TemporaryDirectory() as directory:
+        solardb.configure_database('sqlite:///' + os.path.join(directory, 'prefetch.db'))
+        imagery.configure_imagery_store('tiles')
+        imagery.configure_image_caches(tile_megabytes=0)
+        time_prefetch('no rate limit', server, coords, os.path.join(directory, 'unlimited'), args.workers, None)
+        time_prefetch('rate limited', server, coords, os.path.join(directory, 'limited'), args.workers, args.rate)
+    server.close()
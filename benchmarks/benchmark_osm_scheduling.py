@@ -0,0 +1,93 @@
+"""
+Drains the inference work queue the way run_classification does (without running the model), once handing out every
+tile and once skipping the tiles near an OSM solar node, on a throwaway sqlite database so data/solar.db is never
+touched. Checks that exactly the tiles within the radius of a node were held back, and that deferring them hands them
+out after every other tile.
+
+Run from the repository root: python benchmarks/benchmark_osm_scheduling.py --tiles 200000 --nodes 2000 --radius 1
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import process_city_shapes
+import solardb
+from benchmark_persist_coords import generate_coords, generate_polygon_stub
+
+
+def drain(work_queue):
+    """:return: list of (column, row) of every tile handed out, in the order they were"""
+    handed_out = []
+    with solardb.session_scope():
+        while True:
+            tiles = work_queue.next_batch()
+            if not tiles:
+                return handed_out
+            for tile in tiles:
+                tile.inference_ran = True
+            solardb.update_tiles(tiles)
+            handed_out.extend((tile.column, tile.row) for tile in tiles)
+
+
+def reset_inference():
+    with solardb.get_engine().begin() as connection:
+        connection.execute(solardb.SlippyTile.__table__.update().values(inference_ran=False))
+
+
+def measure(name, work_queue):
+    start_time = time.time()
+    handed_out = drain(work_queue)
+    seconds = time.time() - start_time
+    print("{0}: {1} tiles handed out in {2:.2f}s, {3} held back".format(name, len(handed_out), seconds,
+                                                                      work_queue.held_back_count))
+    reset_inference()
+    return handed_out
+
+
+def get_near_tiles(coords, node_tiles, radius):
+    """Brute force version of the neighbourhood the work queue works out, as a set of (column, row)."""
+    near = set()
+    for column, row in node_tiles.tolist():
+        for column_offset in range(-radius, radius + 1):
+            for row_offset in range(-radius, radius + 1):
+                near.add((column + column_offset, row + row_offset))
+    return near & set(map(tuple, coords.tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark holding back the tiles near OSM solar nodes from inference')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=200000,
+                        help='Number of tiles waiting on inference, default 200000')
+    parser.add_argument('--nodes', dest='nodes', type=int, default=2000,
+                        help='Number of OSM solar nodes among them, default 2000')
+    parser.add_argument('--radius', dest='radius', type=int, default=1,
+                        help='Hold back tiles within this many tiles of a node, default 1')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        solardb.configure_database('sqlite:///' + os.path.join(directory, 'scheduling.db'))
+        solardb.persist_polygons([('benchmark', generate_polygon_stub())])
+        coords = generate_coords(args.tiles).astype(np.int64)
+        solardb.persist_coords('benchmark', coords)
+        random_state = np.random.RandomState(0)
+        node_tiles = coords[random_state.choice(len(coords), args.nodes, replace=False)]
+        solardb.persist_osm_solar_nodes(process_city_shapes.num2deg_array(node_tiles).tolist())
+        near = get_near_tiles(coords, node_tiles, args.radius)
+
+        every_tile = measure('every tile', solardb.InferenceWorkQueue())
+        start_time = time.time()
+        work_queue = solardb.InferenceWorkQueue(osm_radius=args.radius, osm_mode='skip')
+        print("worked out the neighbourhood of {0} nodes in {1:.3f}s".format(args.nodes, time.time() - start_time))
+        skipped = measure('skip', work_queue)
+        assert len(every_tile) == len(coords)
+        assert work_queue.held_back_count == len(near)
+        assert set(skipped) == set(map(tuple, coords.tolist())) - near
+        deferred = measure('defer', solardb.InferenceWorkQueue(osm_radius=args.radius, osm_mode='defer'))
+        assert len(deferred) == len(coords) and set(deferred[len(skipped):]) == near
+        print("skipping saves inference and imagery on {0:.1f}% of the tiles".format(100 * len(near) / len(coords)))
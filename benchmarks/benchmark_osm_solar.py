@@ -0,0 +1,75 @@
+"""
+Queries a stub overpass server (see synthetic.StubOverpassServer) for the solar nodes in some city sized polygons, the
+way osm_solar does, first with a cold cache and then again, and checks the second run only queries the tiles that have
+gone stale. Runs in a throwaway working directory so data/ is never touched.
+
+Run from the repository root: python benchmarks/benchmark_osm_solar.py --cities 20 --latency 0.5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from shapely.geometry import Point
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import osm_solar
+import solardb
+import synthetic
+
+
+def generate_city_polygons(city_count, seed=0):
+    random_state = np.random.RandomState(seed)
+    return [Point(random_state.uniform(-124, -70), random_state.uniform(26, 48))
+            .buffer(random_state.uniform(0.05, 0.3)).simplify(0.01) for _ in range(city_count)]
+
+
+def time_query(server, polygons, workers):
+    requests_before = server.requests
+    start_time = time.time()
+    osm_solar.query_and_persist_osm_solar(polygons, workers=workers)
+    return time.time() - start_time, server.requests - requests_before
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark tiled, cached overpass queries against a stub overpass')
+    parser.add_argument('--cities', dest='cities', type=int, default=20, help='Number of cities, default 20')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.5,
+                        help='Seconds the stub takes to answer each query, default 0.5')
+    parser.add_argument('--workers', dest='workers', type=int, default=osm_solar.DEFAULT_OVERPASS_WORKERS,
+                        help='Number of tiles to query at once, default {}'.format(osm_solar.DEFAULT_OVERPASS_WORKERS))
+    args = parser.parse_args()
+
+    server = synthetic.StubOverpassServer(latency=args.latency)
+    polygons = generate_city_polygons(args.cities)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.makedirs('data')
+        solardb.configure_database('sqlite:///' + os.path.join(directory, 'data', 'solar.db'))
+        solardb.Base.metadata.create_all(solardb.get_engine())
+        osm_solar.configure_overpass(url=server.url, rate=None)
+        seconds, request_count = time_query(server, polygons, args.workers)
+        print("cold cache: {seconds:.2f}s, {requests} tile queries".format(seconds=seconds, requests=request_count))
+        seconds, request_count = time_query(server, polygons, args.workers)
+        print("warm cache: {seconds:.3f}s, {requests} tile queries".format(seconds=seconds, requests=request_count))
+        assert request_count == 0
+        # age a few tiles past the ttl, only those get queried again
+        stale_filenames = sorted(os.listdir(osm_solar.cache_directory))[:5]
+        for filename in stale_filenames:
+            filepath = os.path.join(osm_solar.cache_directory, filename)
+            with open(filepath) as infile:
+                cached = json.load(infile)
+            cached['fetched'] -= osm_solar.cache_ttl + 1
+            with open(filepath, 'w') as outfile:
+                json.dump(cached, outfile)
+        _, request_count = time_query(server, polygons, args.workers)
+        print("{stale} stale tiles: {requests} tile queries".format(stale=len(stale_filenames),
+                                                                     requests=request_count))
+        assert request_count == len(stale_filenames)
+        print("{count} solar nodes persisted".format(count=len(solardb.get_osm_pv_nodes())))
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    server.close()
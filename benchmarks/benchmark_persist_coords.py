@@ -0,0 +1,80 @@
+"""
+Compares the bulk Core insert path of solardb.persist_coords with the ORM path it replaced, on a throwaway sqlite
+database so data/solar.db is never touched.
+
+Run from the repository root: python benchmarks/benchmark_persist_coords.py --tiles 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import solardb
+
+
+def use_database(path):
+    solardb.configure_database('sqlite:///' + path)
+
+
+def generate_coords(tile_count, zoom=21):
+    side = int(np.ceil(np.sqrt(tile_count)))
+    base = 2 ** (zoom - 1)
+    columns, rows = np.meshgrid(np.arange(base, base + side), np.arange(base, base + side))
+    return np.column_stack((columns.ravel(), rows.ravel()))[:tile_count].astype(np.float64)
+
+
+def persist_coords_orm(polygon_name, coords, zoom=21, batch_size=100000):
+    """The ORM implementation persist_coords used before the bulk insert path, kept here as the baseline."""
+    session = solardb.Session()
+    tiles_to_add = []
+    for coord in coords:
+        if len(tiles_to_add) >= batch_size:
+            session.add_all(tiles_to_add)
+            session.commit()
+            tiles_to_add = []
+        tiles_to_add.append(solardb.SlippyTile(polygon_name=polygon_name, column=coord[0], row=coord[1], zoom=zoom))
+    session.add_all(tiles_to_add)
+    session.query(solardb.SearchPolygon).filter(
+        solardb.SearchPolygon.name == polygon_name).first().inner_coords_calculated = True
+    session.commit()
+    session.close()
+
+
+def time_persistence(persist_function, coords, directory):
+    use_database(os.path.join(directory, persist_function.__name__ + '.db'))
+    solardb.persist_polygons([('benchmark', generate_polygon_stub())])
+    start_time = time.time()
+    persist_function('benchmark', coords)
+    return time.time() - start_time
+
+
+def generate_polygon_stub():
+    class Centroid(object):
+        x = 0.0
+        y = 0.0
+
+    class PolygonStub(object):
+        centroid = Centroid()
+
+    return PolygonStub()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark bulk versus ORM persistence of inner grid coordinates')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=1000000, help='number of tiles to persist')
+    parser.add_argument('--skip_orm', dest='skip_orm', action='store_const', const=True, default=False,
+                        help='only time the bulk path (the ORM path takes a long time for large tile counts)')
+    args = parser.parse_args()
+
+    coords = generate_coords(args.tiles)
+    with tempfile.TemporaryDirectory() as directory:
+        functions = [solardb.persist_coords] if args.skip_orm else [persist_coords_orm, solardb.persist_coords]
+        for function in functions:
+            seconds = time_persistence(function, coords, directory)
+            print("{name}: {tiles} tiles in {seconds:.2f} seconds, {rate:.0f} rows/s".format(
+                name=function.__name__, tiles=args.tiles, seconds=seconds, rate=args.tiles / seconds))
@@ -0,0 +1,94 @@
+"""
+Compares the scan line rasterization (rasterize.get_coords_inside_polygon) with the shapely reference implementation
+(process_city_shapes.get_coords_inside_polygon_shapely) on every city shape bundled in data/geoJSON.zip, read straight
+from the zip so nothing has to be gathered first. Shapes are compared as they are (multipolygons, holes and all), or
+simplified the way the pipeline simplifies them with --simplify. Exits with an error if any shape's inner coordinates
+don't match.
+
+Snapping a shape's vertices to the tile grid can leave two parts of a multipolygon touching or overlapping. Shapely
+counts a tile on the edge of one part that's also on or inside another as inside, while the scan line counts it as on
+the boundary, so those tiles are reported but aren't counted as mismatches.
+
+Run from the repository root: python benchmarks/benchmark_rasterize_bundled_shapes.py --zoom 16
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import process_city_shapes
+import rasterize
+
+GEOJSON_ZIP = os.path.join(os.path.dirname(__file__), '..', 'data', 'geoJSON.zip')
+
+
+def read_bundled_shapes(filename=GEOJSON_ZIP):
+    """:return: list of (name, shapely geometry) of every shape in the zip, in lon/lat"""
+    from shapely.geometry import shape
+
+    with zipfile.ZipFile(filename) as archive:
+        return [(os.path.splitext(os.path.basename(name))[0], shape(json.loads(archive.read(name))))
+                for name in sorted(archive.namelist()) if name.endswith('.json')]
+
+
+def is_where_parts_meet(polygon, coords):
+    """:return: whether every one of coords is on or inside at least two parts of the (multi)polygon"""
+    from shapely.geometry import Point
+
+    parts = getattr(polygon, 'geoms', [polygon])
+    return all(sum(part.intersects(Point(coords_tuple)) for part in parts) >= 2 for coords_tuple in coords)
+
+
+def timed(function, polygon):
+    start_time = time.time()
+    coords = function(polygon)
+    return coords, time.time() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and time rasterizing every bundled city shape against shapely')
+    parser.add_argument('--zoom', dest='zoom', type=int, default=16,
+                        help='Zoom level to compare inner coordinates at, default 16 so shapely finishes in minutes')
+    parser.add_argument('--simplify', dest='simplify', action='store_true',
+                        help='Simplify the shapes like process_city_shapes does before comparing them')
+    args = parser.parse_args()
+
+    shapes = read_bundled_shapes()
+    names = [name for name, _ in shapes]
+    polygons = [shape for _, shape in shapes]
+    if args.simplify:
+        polygons = [process_city_shapes.simplify_polygon(polygon) for polygon in polygons]
+    polygons = process_city_shapes.convert_to_slippy_tile_coords(polygons, zoom=args.zoom)
+    shapely_seconds, rasterize_seconds, tile_count = 0.0, 0.0, 0
+    mismatched_names = []
+    meeting_tiles = 0
+    for name, polygon in zip(names, polygons):
+        expected, seconds = timed(process_city_shapes.get_coords_inside_polygon_shapely, polygon)
+        shapely_seconds += seconds
+        actual, seconds = timed(rasterize.get_coords_inside_polygon, polygon)
+        rasterize_seconds += seconds
+        tile_count += len(expected)
+        if np.array_equal(expected, actual):
+            continue
+        missing = set(map(tuple, expected.tolist())) - set(map(tuple, actual.tolist()))
+        if len(expected) == len(actual) + len(missing) and is_where_parts_meet(polygon, missing):
+            meeting_tiles += len(missing)
+        else:
+            print("Inner coordinates for {name} don't match, {expected} expected and {actual} calculated"
+                  .format(name=name, expected=len(expected), actual=len(actual)))
+            mismatched_names.append(name)
+    print("{shapes} shapes, {tiles} tiles inside them at zoom level {zoom}".format(shapes=len(shapes),
+                                                                                 tiles=tile_count, zoom=args.zoom))
+    if meeting_tiles:
+        print("{tiles} tiles where two parts of a multipolygon meet were left out".format(tiles=meeting_tiles))
+    print("shapely: {0:.2f}s, rasterize: {1:.2f}s ({2:.0f}x faster)".format(
+        shapely_seconds, rasterize_seconds, shapely_seconds / max(rasterize_seconds, 1e-9)))
+    if mismatched_names:
+        sys.exit("{mismatched} of {total} shapes had mismatched inner coordinates".format(
+            mismatched=len(mismatched_names), total=len(shapes)))
@@ -0,0 +1,82 @@
+"""
+Measures how long each entry point takes to import, from the figures python -X importtime reports, and how long each
+script takes to print its --help (i.e. start up and do nothing).
+
+Run from the repository root: python benchmarks/benchmark_startup.py
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPOSITORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULES = ['solardb', 'process_city_shapes', 'imagery', 'maproulette', 'gather_city_shapes', 'run_inference']
+SCRIPTS = ['process_city_shapes.py', 'imagery.py', 'gather_city_shapes.py', 'run_inference.py',
+           'run_entire_process.py']
+
+
+def parse_importtime(output):
+    """
+    :param output: stderr of python -X importtime
+    :return: list of (module, depth, cumulative microseconds) tuples, in the order they were reported (imports are
+    reported after everything they import, and a depth of 0 is a top level import)
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative_time, module = line[len('import time:'):].split('|')
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((module.strip(), depth, int(cumulative_time)))
+    return imports
+
+
+def time_import(module):
+    """
+    :return: (import time of module in seconds, list of (name, seconds) of its direct imports) or None if it failed
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=REPOSITORY,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        return None
+    imports = parse_importtime(result.stderr)
+    end = max(position for position, (name, depth, _) in enumerate(imports) if name == module and depth == 0)
+    start = max([position + 1 for position, (_, depth, _) in enumerate(imports[:end]) if depth == 0] or [0])
+    direct_imports = [(name, cumulative / 1e6) for name, depth, cumulative in imports[start:end] if depth == 1]
+    return imports[end][2] / 1e6, direct_imports
+
+
+def time_help(script, repeat=3):
+    """:return: best wall time in seconds of running script --help, or None if it failed"""
+    best = None
+    for _ in range(repeat):
+        start_time = time.time()
+        result = subprocess.run([sys.executable, script, '--help'], cwd=REPOSITORY, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        if result.returncode:
+            return None
+        elapsed = time.time() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark how long each entry point takes to start up')
+    parser.add_argument('--slowest', dest='slowest', type=int, default=5,
+                        help='Number of slowest direct imports to list for each module, default 5')
+    args = parser.parse_args()
+
+    for module in MODULES:
+        timing = time_import(module)
+        if timing is None:
+            print("import {0}: failed (missing dependency?)".format(module))
+            continue
+        total, direct_imports = timing
+        slowest = sorted(direct_imports, key=lambda item: item[1], reverse=True)[:args.slowest]
+        print("import {0}: {1:.3f}s, slowest imports: {2}".format(module, total, ', '.join(
+            "{0} {1:.3f}s".format(name, seconds) for name, seconds in slowest)))
+    for script in SCRIPTS:
+        elapsed = time_help(script)
+        print("{0} --help: {1}".format(script, "failed (missing dependency?)" if elapsed is None else
+                                       "{0:.3f}s".format(elapsed)))
@@ -0,0 +1,81 @@
+"""
+Compares reading tiles from the file per tile layout with reading them from sharded storage, on throwaway directories
+so data/imagery is never touched. Reads are made in a random order, like the inference work queue makes them once a
+region has been partly processed. Both layouts are read with a warm page cache, so the difference measured is the cost
+of opening files and of the directory lookups, not of the disk itself.
+
+Run from the repository root: python benchmarks/benchmark_tile_storage.py --tiles 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import imagery
+
+
+def generate_tiles(tile_count, zoom=21, distinct=1000):
+    """Generates tiles with a limited number of distinct images, as in imagery with lots of open water or fields."""
+    random_state = np.random.RandomState(0)
+    images = [Image.fromarray(random_state.randint(0, 255, (8, 8, 3), dtype=np.uint8).repeat(32, 0).repeat(32, 1))
+              for _ in range(min(distinct, tile_count))]
+    side = int(np.ceil(np.sqrt(tile_count)))
+    base = 2 ** (zoom - 1)
+    return [imagery.ImageTile(images[index % len(images)], (base + index % side, base + index // side))
+            for index in range(tile_count)]
+
+
+def time_reads(storage, coords, zoom=21, decode=False):
+    start_time = time.time()
+    for tile_coords in coords:
+        if decode:
+            storage.load(tile_coords, zoom=zoom).load()
+        else:
+            storage.read_bytes(tile_coords, zoom=zoom)
+    return len(coords) / (time.time() - start_time)
+
+
+def time_exists(storage, coords, zoom=21):
+    start_time = time.time()
+    for tile_coords in coords:
+        storage.exists(tile_coords, zoom=zoom)
+    return len(coords) / (time.time() - start_time)
+
+
+def disk_usage(directory):
+    return sum(os.path.getsize(os.path.join(path, filename))
+               for path, _, filenames in os.walk(directory) for filename in filenames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark file per tile storage against sharded storage')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=20000, help='Number of tiles, default 20000')
+    parser.add_argument('--distinct', dest='distinct', type=int, default=1000,
+                        help='Number of distinct tile images, default 1000')
+    args = parser.parse_args()
+
+    tiles = generate_tiles(args.tiles, distinct=args.distinct)
+    coords = [tile.coords for tile in tiles]
+    np.random.RandomState(1).shuffle(coords)
+    with tempfile.TemporaryDirectory() as directory:
+        storages = [('files', imagery.FileTileStorage(os.path.join(directory, 'files'))),
+                    ('shards', imagery.ShardedTileStorage(os.path.join(directory, 'shards')))]
+        for name, storage in storages:
+            start_time = time.time()
+            for start in range(0, len(tiles), imagery.GRID_SIZE ** 2):
+                storage.save_many(tiles[start:start + imagery.GRID_SIZE ** 2])
+            write_rate = len(tiles) / (time.time() - start_time)
+            if name == 'shards':
+                # reopen so reads go through the index loaded from disk
+                storage = imagery.ShardedTileStorage(os.path.join(directory, 'shards'))
+            print("{0:>6}: write {1:.0f} tiles/s, exists {2:.0f} tiles/s, read {3:.0f} tiles/s, "
+                  "read and decode {4:.0f} tiles/s, {5:.1f}MB on disk"
+                  .format(name, write_rate, time_exists(storage, coords), time_reads(storage, coords),
+                          time_reads(storage, coords, decode=True),
+                          disk_usage(os.path.join(directory, name)) / 1024 / 1024))
@@ -0,0 +1,54 @@
+"""
+Compares loading every tile over threshold as SlippyTiles (query_tiles_over_threshold) with streaming them as chunks
+of lightweight rows (iter_tiles_over_threshold), in time and in peak python memory, on a throwaway sqlite database so
+data/solar.db is never touched.
+
+Run from the repository root: python benchmarks/benchmark_tile_streaming.py --tiles 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import solardb
+from benchmark_persist_coords import generate_coords, generate_polygon_stub
+
+
+def measure(name, function, tile_count):
+    tracemalloc.start()
+    start_time = time.time()
+    function()
+    seconds = time.time() - start_time
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{0}: {1:.2f}s ({2:.0f} tiles/s), peak {3:.1f}MB".format(name, seconds, tile_count / seconds,
+                                                                    peak_bytes / 1024 / 1024))
+
+
+def load_orm_tiles():
+    tiles = solardb.query_tiles_over_threshold()
+    return len(tiles)
+
+
+def stream_tile_rows():
+    return sum(len(tiles) for tiles in solardb.iter_tiles_over_threshold())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark loading positive tiles as ORM objects against streaming')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=1000000,
+                        help='Number of positive tiles, default 1000000')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        solardb.configure_database('sqlite:///' + os.path.join(directory, 'streaming.db'))
+        solardb.persist_polygons([('benchmark', generate_polygon_stub())])
+        solardb.persist_coords('benchmark', generate_coords(args.tiles), compute_centroid_distance=False)
+        with solardb.get_engine().begin() as connection:
+            connection.execute(solardb.SlippyTile.__table__.update().values(panel_softmax=0.9))
+        measure('query_tiles_over_threshold', load_orm_tiles, args.tiles)
+        measure('iter_tiles_over_threshold', stream_tile_rows, args.tiles)
@@ -0,0 +1,260 @@
+"""
+Benchmarks every stage of the pipeline offline, against a generated search polygon, generated imagery (served by a
+stand in for mapbox) and a stub Predictor, in a throwaway working directory so data/ is never touched. Results are
+written as json so runs can be compared to catch regressions.
+
+Run from the repository root:
+    python benchmarks/run_benchmarks.py --scale 10k --output baseline.json
+    python benchmarks/run_benchmarks.py --scale 10k --compare baseline.json
+"""
+import argparse
+import concurrent.futures
+import collections
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from sqlalchemy import bindparam, func, select
+
+REPOSITORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(REPOSITORY)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+SCALES = collections.OrderedDict([('10k', 10000), ('1m', 1000000), ('20m', 20000000)])
+BENCHMARKS = ['get_coords_inside_polygon', 'persist_coords', 'compute_centroid_distances', 'gather_imagery',
+              'stitch_image_at_coordinate', 'stitch_array_at_coordinate', 'classify_tiles', 'detect_clusters',
+              'create_clustered_maproulette_geojson']
+POLYGON_NAME = 'Benchmark, Synthetic'
+DEFAULT_STITCHES = 300
+DEFAULT_TOLERANCE = 0.2
+
+
+def timed(function, *args, **kwargs):
+    """:return: (return value of function, seconds it took)"""
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def result(seconds, items, unit, **extra):
+    """Every benchmark reports how long it took and how many items (tiles, stitches, etc.) it got through."""
+    extra.update({'seconds': seconds, 'items': int(items), 'unit': unit, 'rate': items / seconds if seconds else None})
+    return extra
+
+
+def get_sample_grids(polygon, stitches, grid_size):
+    """
+    :return: base coords of the query grids the stitched tiles are taken from, a row of them from the polygon's centroid
+    """
+    import imagery
+
+    interior_tiles = (grid_size - 2) ** 2
+    centroid_base = imagery.get_grid_base_coords((int(polygon.centroid.x), int(polygon.centroid.y)))
+    return [(centroid_base[0] + index * grid_size, centroid_base[1])
+            for index in range(-(-stitches // interior_tiles))]
+
+
+def get_sample_tiles(grid_bases, stitches, grid_size):
+    """:return: (column, row) of the tiles to stitch, all far enough inside their grid that no neighbours are needed"""
+    tiles = [(base[0] + column_offset, base[1] + row_offset) for base in grid_bases
+             for row_offset in range(1, grid_size - 1) for column_offset in range(1, grid_size - 1)]
+    return tiles[:stitches]
+
+
+def run_benchmarks(tile_count, names, stitches=DEFAULT_STITCHES, predictor_latency=0.0):
+    """
+    Runs the benchmarks in order, each later one works on what the earlier ones left in the (throwaway) database and
+    imagery directories, so this has to be run from inside a throwaway working directory.
+
+    :param tile_count: approximate number of tiles inside the generated search polygon
+    :param names: names of the benchmarks to run, from BENCHMARKS
+    :param stitches: number of tiles to stitch and classify
+    :param predictor_latency: seconds the stub predictor takes per image
+    :return: dict of benchmark name to result
+    """
+    # imported here as the modules pick up their data directories from the working directory when imported
+    import imagery
+    import process_city_shapes
+    import rasterize
+    import solardb
+
+    solardb.configure_database('sqlite:///' + os.path.join(os.getcwd(), 'data', 'solar.db'))
+    imagery.service = synthetic.SyntheticImageryService()
+    imagery.service.warm_up(width=imagery.MAX_IMAGE_SIDE_LENGTH, retina=imagery.ZOOM_FACTOR > 0)
+    polygon = synthetic.generate_polygon(tile_count)
+    solardb.persist_polygons([(POLYGON_NAME, polygon)])
+    results = collections.OrderedDict()
+
+    def run(name, function, *args, **kwargs):
+        if name not in names:
+            return None
+        try:
+            results[name] = function(*args, **kwargs)
+        except ImportError as error:
+            # e.g. tensorflow or skimage not being installed, the rest of the benchmarks can still run
+            results[name] = {'skipped': str(error)}
+        print("{0}: {1}".format(name, json.dumps(results[name])))
+        return results[name]
+
+    def benchmark_inner_grid():
+        coords, seconds = timed(process_city_shapes.get_coords_inside_polygon, polygon)
+        return result(seconds, len(coords), 'tiles')
+
+    def benchmark_persist():
+        row_count, seconds = timed(solardb.persist_coord_chunks, POLYGON_NAME,
+                                   rasterize.iter_coords_inside_polygon(polygon), compute_centroid_distance=False)
+        return result(seconds, row_count, 'tiles')
+
+    def benchmark_centroid_distances():
+        _, seconds = timed(solardb.compute_centroid_distances)
+        return result(seconds, count_tiles(), 'tiles')
+
+    def count_tiles():
+        with solardb.get_engine().connect() as connection:
+            return connection.execute(select([func.count()]).select_from(solardb.SlippyTile.__table__)).scalar()
+
+    grid_bases = get_sample_grids(polygon, stitches, imagery.GRID_SIZE)
+    sample_tiles = get_sample_tiles(grid_bases, stitches, imagery.GRID_SIZE)
+
+    def benchmark_gather(store):
+        imagery.configure_imagery_store(store)
+        _, seconds = timed(lambda: [imagery.gather_and_persist_imagery_at_coordinate(base) for base in grid_bases])
+        return result(seconds, len(grid_bases), 'grids', store=store)
+
+    def benchmark_stitch(store, function):
+        imagery.configure_imagery_store(store)
+        imagery.configure_image_caches()
+        imagery.open_grid_array.cache_clear()
+        order = np.random.RandomState(0).permutation(len(sample_tiles))
+        _, seconds = timed(lambda: [function(sample_tiles[index]) for index in order])
+        return result(seconds, len(sample_tiles), 'stitches', store=store)
+
+    def benchmark_classify():
+        import run_inference
+
+        imagery.configure_imagery_store('tiles')
+        imagery.configure_image_caches()
+        tiles = [solardb.SlippyTile(column=column, row=row, zoom=imagery.FINAL_ZOOM) for column, row in sample_tiles]
+        image_buffers = [np.empty((run_inference.DEFAULT_BATCH_SIZE, run_inference.IMAGE_SIZE,
+                                   run_inference.IMAGE_SIZE, 3), dtype=np.float32)
+                         for _ in range(run_inference.DEFAULT_PREFETCH_DEPTH + 1)]
+        stage_seconds = collections.defaultdict(float)
+        with concurrent.futures.ThreadPoolExecutor(run_inference.DEFAULT_PREPROCESS_WORKERS) as executor:
+            _, seconds = timed(run_inference.classify_tiles, synthetic.StubPredictor(predictor_latency), tiles,
+                               executor, image_buffers, stage_seconds)
+        return result(seconds, len(tiles), 'tiles', stage_seconds=dict(stage_seconds))
+
+    def mark_positive_tiles():
+        """Marks clusters of tiles as positive (and puts an osm panel on some of them) for the later benchmarks."""
+        coords = process_city_shapes.get_coords_inside_polygon(polygon).astype(np.int64)
+        positives = synthetic.generate_positive_blobs(coords)
+        tiles = solardb.SlippyTile.__table__
+        with solardb.get_engine().begin() as connection:
+            connection.execute(
+                tiles.update().where(tiles.c.column == bindparam('tile_column'))
+                .where(tiles.c.row == bindparam('tile_row')).values(panel_softmax=0.9, inference_ran=True),
+                [{'tile_column': int(column), 'tile_row': int(row)} for column, row in positives])
+        solardb.persist_osm_solar_nodes(process_city_shapes.num2deg_array(positives[::10]).tolist())
+        return len(positives)
+
+    def benchmark_detect_clusters(positive_count):
+        import run_inference
+
+        _, seconds = timed(run_inference.detect_clusters)
+        return result(seconds, positive_count, 'positive tiles')
+
+    def benchmark_maproulette(positive_count):
+        import maproulette
+
+        _, seconds = timed(maproulette.create_clustered_maproulette_geojson, polygon_name=POLYGON_NAME)
+        return result(seconds, positive_count, 'positive tiles')
+
+    run('get_coords_inside_polygon', benchmark_inner_grid)
+    if not run('persist_coords', benchmark_persist):
+        # everything after this needs the inner grid in the database
+        solardb.persist_coord_chunks(POLYGON_NAME, rasterize.iter_coords_inside_polygon(polygon))
+    run('compute_centroid_distances', benchmark_centroid_distances)
+    run('gather_imagery', benchmark_gather, 'tiles')
+    run('stitch_image_at_coordinate', benchmark_stitch, 'tiles', imagery.stitch_image_at_coordinate)
+    if 'stitch_array_at_coordinate' in names:
+        benchmark_gather('mosaic')
+    run('stitch_array_at_coordinate', benchmark_stitch, 'mosaic', imagery.stitch_array_at_coordinate)
+    run('classify_tiles', benchmark_classify)
+    if 'detect_clusters' in names or 'create_clustered_maproulette_geojson' in names:
+        positive_count = mark_positive_tiles()
+        run('detect_clusters', benchmark_detect_clusters, positive_count)
+        run('create_clustered_maproulette_geojson', benchmark_maproulette, positive_count)
+    return results
+
+
+def compare_results(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """
+    Prints how the rate of every benchmark changed since the baseline run.
+
+    :return: list of the names of benchmarks that got slower by more than tolerance
+    """
+    regressions = []
+    for name, current_result in current['results'].items():
+        baseline_result = baseline['results'].get(name, {})
+        if not current_result.get('rate') or not baseline_result.get('rate'):
+            continue
+        change = current_result['rate'] / baseline_result['rate'] - 1
+        regressed = change < -tolerance
+        if regressed:
+            regressions.append(name)
+        print("{0:<40} {1:>14.1f} -> {2:>14.1f} {3} ({4:+.0%}){5}".format(
+            name, baseline_result['rate'], current_result['rate'], current_result['unit'] + '/s', change,
+            ' REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline offline with generated data')
+    parser.add_argument('--scale', dest='scale', choices=list(SCALES), default='10k',
+                        help='Approximate number of tiles in the generated search polygon, default 10k')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=None,
+                        help='Exact number of tiles to generate instead of one of the scales')
+    parser.add_argument('--only', dest='only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help='Only run these benchmarks')
+    parser.add_argument('--stitches', dest='stitches', type=int, default=DEFAULT_STITCHES,
+                        help='Number of tiles to stitch and classify, default {}'.format(DEFAULT_STITCHES))
+    parser.add_argument('--predictor-latency', dest='predictor_latency', type=float, default=0.0,
+                        help='Seconds the stub predictor takes per image, default 0')
+    parser.add_argument('--output', dest='output', default=None, help='Write the results to this json file')
+    parser.add_argument('--compare', dest='compare', default=None,
+                        help='Compare the results to a json file written by an earlier run with --output')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction a rate can drop by before it counts as a regression, default {}'
+                        .format(DEFAULT_TOLERANCE))
+    parser.add_argument('--workdir', dest='workdir', default=None,
+                        help='Directory to generate the database and imagery in (kept afterwards), defaults to a '
+                             'temporary directory')
+    args = parser.parse_args()
+
+    tile_count = args.tiles or SCALES[args.scale]
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        workdir = os.path.abspath(args.workdir or temporary_directory)
+        os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+        os.chdir(workdir)
+        results = run_benchmarks(tile_count, args.only, stitches=args.stitches,
+                                 predictor_latency=args.predictor_latency)
+        os.chdir(REPOSITORY)
+
+    report = {'scale': args.scale if not args.tiles else None, 'tiles': tile_count, 'stitches': args.stitches,
+              'timestamp': time.time(), 'python': platform.python_version(), 'machine': platform.machine(),
+              'processor_count': os.cpu_count(), 'results': results}
+    if output:
+        with open(output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    if baseline:
+        with open(baseline, 'r') as infile:
+            if compare_results(json.load(infile), report, tolerance=args.tolerance):
+                sys.exit(1)
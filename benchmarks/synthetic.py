@@ -0,0 +1,315 @@
+"""
+Generated stand-ins for everything the pipeline normally gets from the network or a checkpoint: search polygons,
+imagery served the way mapbox serves it (in process or over http), nominatim and overpass servers and a DeepSolar
+Predictor.
+"""
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+from shapely.geometry import Polygon
+
+# a column/row well inside the zoom 21 map, so generated polygons never wrap around its edge
+BASE_COORDS = (335000, 810000)
+
+
+def generate_polygon(tile_count, base_coords=BASE_COORDS, lobes=5, wobble=0.2, vertices=720, hole_fraction=0.05):
+    """
+    Generates a wobbly, star-ish polygon (with a hole in it) in slippy tile coordinates, sized so roughly tile_count
+    tiles lie inside it. Its vertices are whole tile coordinates, like those from convert_to_slippy_tile_coords, so the
+    grid inside it lines up with the tiles.
+
+    :param tile_count: approximate number of zoom 21 tiles inside the polygon
+    :param base_coords: (column, row) of the top left of the polygon's bounding box
+    :param lobes: number of lobes around the outline
+    :param wobble: how far the lobes reach in and out, as a fraction of the radius
+    :param vertices: number of vertices in the outline
+    :param hole_fraction: fraction of the area taken up by the hole in the middle
+    :return: shapely Polygon
+    """
+    # the area of r = R * (1 + w * sin(k * theta)) is pi * R^2 * (1 + w^2 / 2)
+    radius = math.sqrt(tile_count / (math.pi * (1 + wobble ** 2 / 2) * (1 - hole_fraction)))
+    center = (base_coords[0] + radius * (1 + wobble), base_coords[1] + radius * (1 + wobble))
+    thetas = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    radii = radius * (1 + wobble * np.sin(lobes * thetas))
+    exterior = np.column_stack((center[0] + radii * np.cos(thetas), center[1] + radii * np.sin(thetas)))
+    hole_radius = radius * math.sqrt(hole_fraction * (1 + wobble ** 2 / 2))
+    hole = np.column_stack((center[0] + hole_radius * np.cos(thetas), center[1] + hole_radius * np.sin(thetas)))
+    return Polygon(np.trunc(exterior), [np.trunc(hole[::-1])])
+
+
+def generate_jpeg(side_length, seed, quality=90):
+    """
+    Generates a jpeg with some large scale structure and some noise, so it compresses about as well as real imagery.
+
+    :return: the encoded jpeg bytes
+    """
+    random_state = np.random.RandomState(seed % 2 ** 32)
+    coarse = random_state.randint(0, 255, (side_length // 64, side_length // 64, 3), dtype=np.uint8)
+    image = Image.fromarray(coarse).resize((side_length, side_length), Image.BILINEAR)
+    noise = random_state.randint(-12, 12, (side_length, side_length, 3))
+    pixels = np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    output = BytesIO()
+    Image.fromarray(pixels).save(output, 'jpeg', quality=quality)
+    return output.getvalue()
+
+
+class SyntheticResponse(object):
+    def __init__(self, content):
+        self.ok = True
+        self.status_code = 200
+        self.content = content
+
+
+class SyntheticImageryService(object):
+    """
+    Stand in for mapbox's Static service that serves one of a few generated jpegs (picked by location) for every
+    request. The jpegs are generated ahead of time by warm_up so generating them isn't counted as fetching imagery.
+    """
+
+    def __init__(self, latency=0.0, distinct_images=4):
+        self.latency = latency
+        self.distinct_images = distinct_images
+        self.requests = 0
+        self.images = {}
+
+    def warm_up(self, width=1280, retina=True):
+        for seed in range(self.distinct_images):
+            self.get_jpeg(width * (2 if retina else 1), seed)
+
+    def get_jpeg(self, side_length, seed):
+        key = (side_length, seed)
+        if key not in self.images:
+            self.images[key] = generate_jpeg(side_length, seed)
+        return self.images[key]
+
+    def image(self, map_id, lon=None, lat=None, z=None, width=600, height=600, image_format='png256', retina=False):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        seed = hash((round(lon, 7), round(lat, 7), z)) % self.distinct_images
+        return SyntheticResponse(self.get_jpeg(width * (2 if retina else 1), seed))
+
+
+class StubImageryServer(object):
+    """
+    Serves generated jpegs on the static image paths mapbox uses (and UrlStaticService requests), i.e.
+    http://127.0.0.1:<port>/<map_id>/<lon>,<lat>,<z>/<width>x<height>[@2x].<format>, from daemon threads, picking one
+    of a few images by location and answering after latency seconds. Given a rate, it answers requests beyond rate per
+    second (allowing bursts of up to burst requests) with a 429 like mapbox does, and a failure_rate fraction of
+    requests get a 429 regardless, to exercise retries.
+    """
+
+    def __init__(self, latency=0.0, rate=None, burst=2, failure_rate=0.0, distinct_images=4, seed=0):
+        self.distinct_images = distinct_images
+        self.requests = 0
+        self.rate_limited = 0
+        self.images = {}
+        random_state = np.random.RandomState(seed)
+        lock = threading.Lock()
+        # token bucket of requests the server will still answer
+        bucket = {'tokens': burst, 'time': time.monotonic()}
+        stub = self
+
+        class ImageryHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    stub.requests += 1
+                    limited = random_state.rand() < failure_rate
+                    if rate:
+                        now = time.monotonic()
+                        bucket['tokens'] = min(bucket['tokens'] + (now - bucket['time']) * rate, burst)
+                        bucket['time'] = now
+                        if bucket['tokens'] < 1:
+                            limited = True
+                        else:
+                            bucket['tokens'] -= 1
+                    stub.rate_limited += limited
+                if latency:
+                    time.sleep(latency)
+                if limited:
+                    self.send_response(429)
+                    self.end_headers()
+                    return
+                match = re.match(r'/[^/]+/([-\d.]+),([-\d.]+),(\d+)/(\d+)x\d+(@2x)?\.', urlparse(self.path).path)
+                if match is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                lon, lat, z, width, retina = match.groups()
+                seed = hash((round(float(lon), 7), round(float(lat), 7), int(z))) % stub.distinct_images
+                body = stub.get_jpeg(int(width) * (2 if retina else 1), seed)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageryHandler)
+        self.url = 'http://127.0.0.1:{port}'.format(port=self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def warm_up(self, width=1280, retina=True):
+        """Generates the jpegs ahead of time, so generating them isn't counted as serving imagery."""
+        for seed in range(self.distinct_images):
+            self.get_jpeg(width * (2 if retina else 1), seed)
+
+    def get_jpeg(self, side_length, seed):
+        key = (side_length, seed)
+        if key not in self.images:
+            self.images[key] = generate_jpeg(side_length, seed)
+        return self.images[key]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubPredictor(object):
+    """
+    Stand in for DeepSolar's Predictor, gives every image a (deterministic) softmax from its pixels, optionally taking
+    a fixed amount of time per image to stand in for the model.
+    """
+
+    def __init__(self, seconds_per_image=0.0):
+        self.seconds_per_image = seconds_per_image
+
+    def classify(self, image):
+        return self.classify_batch(image)[0]
+
+    def classify_batch(self, images):
+        if self.seconds_per_image:
+            time.sleep(self.seconds_per_image * len(images))
+        return np.asarray(images, dtype=np.float64).reshape((len(images), -1)).mean(axis=1) % 1.0
+
+
+def generate_positive_blobs(coords, positive_fraction=0.01, max_blob_side=4, seed=0):
+    """
+    Picks square blobs of tiles out of coords to mark as positive, like clusters of panels on neighbouring roofs.
+
+    :param coords: ndarray of (column, row) coordinates to pick from
+    :param positive_fraction: roughly what fraction of coords should be positive
+    :param max_blob_side: blobs are squares between 1 and this many tiles on a side
+    :param seed: random seed
+    :return: ndarray of the (column, row) coordinates of every positive tile (all of which are in coords)
+    """
+    random_state = np.random.RandomState(seed)
+    mean_blob_tiles = np.mean([side ** 2 for side in range(1, max_blob_side + 1)])
+    blob_count = max(int(len(coords) * positive_fraction / mean_blob_tiles), 1)
+    corners = coords[random_state.randint(0, len(coords), blob_count)]
+    sides = random_state.randint(1, max_blob_side + 1, blob_count)
+    blobs = [np.stack(np.meshgrid(np.arange(side) + corner[0], np.arange(side) + corner[1]), axis=-1).reshape((-1, 2))
+             for corner, side in zip(corners, sides)]
+    candidates = np.unique(np.vstack(blobs), axis=0)
+    # blobs near the outline can hang outside of it
+    inside = np.isin(candidates[:, 0] * 2 ** 32 + candidates[:, 1], coords[:, 0] * 2 ** 32 + coords[:, 1])
+    return candidates[inside]
+
+
+class StubNominatimServer(object):
+    """
+    Serves nominatim style search results on http://127.0.0.1:<port>/search from daemon threads, answering every
+    query with a small square polygon (placed by a hash of the query) after latency seconds. A failure_rate fraction
+    of requests get a 503 instead, to exercise retries.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.requests = 0
+        self.failures = 0
+        random_state = np.random.RandomState(seed)
+        lock = threading.Lock()
+        stub = self
+
+        class NominatimHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    stub.requests += 1
+                    failed = random_state.rand() < failure_rate
+                    stub.failures += failed
+                if latency:
+                    time.sleep(latency)
+                if failed:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                query = sorted(parse_qs(urlparse(self.path).query).items())
+                offset = hash(str(query)) % 1000 / 100.0
+                lon, lat = -120.0 + offset, 30.0 + offset / 2
+                body = json.dumps([{'display_name': str(query), 'geojson': {'type': 'Polygon', 'coordinates': [[
+                    [lon, lat], [lon + 0.1, lat], [lon + 0.1, lat + 0.1], [lon, lat + 0.1], [lon, lat]]]}}])
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), NominatimHandler)
+        self.url = 'http://127.0.0.1:{port}/search'.format(port=self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubOverpassServer(object):
+    """
+    Answers overpass bbox queries posted to http://127.0.0.1:<port>/api/interpreter from daemon threads with
+    nodes_per_query solar nodes spread over the bbox (the same ones every time for the same bbox), after latency
+    seconds.
+    """
+
+    def __init__(self, latency=0.0, nodes_per_query=100):
+        self.requests = 0
+        lock = threading.Lock()
+        stub = self
+
+        class OverpassHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                with lock:
+                    stub.requests += 1
+                if latency:
+                    time.sleep(latency)
+                query = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))['data'][0]
+                south, west, north, east = map(float, re.search(r'\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\)',
+                                                                query).groups())
+                random_state = np.random.RandomState(hash((south, west)) % 2 ** 32)
+                lons = random_state.uniform(west, east, nodes_per_query)
+                lats = random_state.uniform(south, north, nodes_per_query)
+                body = json.dumps({'elements': [{'type': 'node', 'id': index, 'lon': lon, 'lat': lat}
+                                                for index, (lon, lat) in enumerate(zip(lons.tolist(),
+                                                                                       lats.tolist()))]})
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), OverpassHandler)
+        self.url = 'http://127.0.0.1:{port}/api/interpreter'.format(port=self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,299 @@
+import numpy as np
+
+
+def encode_coordinates(coordinates):
+    """
+    Packs (column, row) coordinates into single integers that sort by column and then row, slippy tile coordinates
+    are below 2 ** 31 at every zoom level this project uses so nothing collides.
+
+    :param coordinates: ndarray of shape (x,2)
+    :return: int64 ndarray of shape (x,)
+    """
+    coordinates = np.asarray(coordinates, dtype=np.int64)
+    return (coordinates[:, 0] << 32) + coordinates[:, 1]
+
+
+def decode_coordinates(keys):
+    """
+    :param keys: int64 ndarray of keys from encode_coordinates
+    :return: int64 ndarray of shape (x,2) of the (column, row) each key was packed from
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    return np.column_stack((keys >> 32, keys & 0xFFFFFFFF))
+
+
+def get_neighbor_pairs(coordinates):
+    """
+    Finds every pair of coordinates that share an edge (north/south or east/west neighbours).
+
+    :param coordinates: ndarray of unique coordinates of shape (x,2)
+    :return: tuple of two index ndarrays, coordinates[first[i]] and coordinates[second[i]] are neighbours
+    """
+    keys = encode_coordinates(coordinates)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    firsts, seconds = [], []
+    for offset in [(1, 0), (0, 1)]:
+        neighbor_keys = encode_coordinates(np.asarray(coordinates, dtype=np.int64) + offset)
+        positions = np.minimum(np.searchsorted(sorted_keys, neighbor_keys), len(keys) - 1)
+        found = sorted_keys[positions] == neighbor_keys
+        firsts.append(np.nonzero(found)[0])
+        seconds.append(order[positions[found]])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def label_clusters(coordinates, labels=None, cluster_ids=None):
+    """
+    Labels the connected components (clusters) of a sparse set of grid coordinates, where coordinates are connected if
+    they share an edge. This is a union-find run over all of the neighbour pairs at once: every round hooks the root of
+    the larger label onto the smaller one and then compresses paths by pointer jumping, so there's no recursion and no
+    per tile python.
+
+    :param coordinates: ndarray of unique coordinates of shape (x,2)
+    :param labels: optional ndarray of a label for each coordinate, neighbours with different labels aren't connected
+    :param cluster_ids: optional ndarray of the cluster id each coordinate already has (or -1), coordinates with the
+    same id are connected even if they don't touch, as the rest of their cluster connects them
+    :return: int64 ndarray of shape (x,), coordinates with the same label are in the same cluster, and each label is
+    the index of the first coordinate in its cluster
+    """
+    parents = np.arange(len(coordinates), dtype=np.int64)
+    if not len(coordinates):
+        return parents
+    firsts, seconds = get_neighbor_pairs(coordinates)
+    if labels is not None:
+        same_label = labels[firsts] == labels[seconds]
+        firsts, seconds = firsts[same_label], seconds[same_label]
+    if cluster_ids is not None:
+        # connect every coordinate with an id to the first coordinate with the same id
+        order = np.argsort(cluster_ids, kind='stable')
+        sorted_ids = cluster_ids[order]
+        group_firsts = order[np.searchsorted(sorted_ids, sorted_ids)]
+        has_id = sorted_ids >= 0
+        firsts = np.concatenate((firsts, group_firsts[has_id]))
+        seconds = np.concatenate((seconds, order[has_id]))
+    while True:
+        first_roots, second_roots = parents[firsts], parents[seconds]
+        unmerged = first_roots != second_roots
+        if not unmerged.any():
+            return parents
+        first_roots, second_roots = first_roots[unmerged], second_roots[unmerged]
+        np.minimum.at(parents, np.maximum(first_roots, second_roots), np.minimum(first_roots, second_roots))
+        while True:
+            grandparents = parents[parents]
+            if np.array_equal(grandparents, parents):
+                break
+            parents = grandparents
+
+
+def assign_cluster_ids(labels, existing_cluster_ids, allocate_cluster_ids):
+    """
+    Turns cluster labels into cluster ids, reusing existing ids so that clusters can be updated incrementally: a
+    cluster that already contains tiles with an id keeps the smallest of those ids (merging any other clusters it now
+    touches into it), and a brand new cluster gets a freshly allocated id. When a cluster has split up, only its first
+    part keeps its id and the other parts get new ones.
+
+    :param labels: ndarray of labels from label_clusters
+    :param existing_cluster_ids: int64 ndarray the same length as labels, the id each tile already has or -1 for none
+    :param allocate_cluster_ids: function that takes a count and returns that many new cluster ids
+    :return: int64 ndarray of the cluster id for each tile
+    """
+    unique_labels, label_indexes = np.unique(labels, return_inverse=True)
+    no_id = np.iinfo(np.int64).max
+    cluster_ids = np.full(len(unique_labels), no_id, dtype=np.int64)
+    has_id = existing_cluster_ids >= 0
+    np.minimum.at(cluster_ids, label_indexes[has_id], existing_cluster_ids[has_id])
+    _, first_labels = np.unique(cluster_ids, return_index=True)
+    taken = np.ones(len(cluster_ids), dtype=bool)
+    taken[first_labels] = False
+    cluster_ids[taken] = no_id
+    new_clusters = cluster_ids == no_id
+    if new_clusters.any():
+        cluster_ids[new_clusters] = allocate_cluster_ids(int(new_clusters.sum()))
+    return cluster_ids[label_indexes]
+
+
+# the directions boundary edges run in, clockwise on screen (rows increase southwards): east, south, west and north,
+# so turning right is always the next direction along
+EDGE_DIRECTIONS = np.array([(1, 0), (0, 1), (-1, 0), (0, -1)], dtype=np.int64)
+# for each side of a tile (top, right, bottom, left), the neighbour that has to be missing for it to be a boundary
+# edge, the corner the edge starts at and the direction it runs in, so the tile is always on the edge's right
+TILE_SIDES = [((0, -1), (0, 0), 0), ((1, 0), (1, 0), 1), ((0, 1), (1, 1), 2), ((-1, 0), (0, 1), 3)]
+
+
+def find_coordinates(sorted_keys, order, coordinates):
+    """
+    :param sorted_keys: sorted keys from encode_coordinates
+    :param order: the argsort that sorted the keys, to turn positions back into indexes
+    :param coordinates: ndarray of coordinates to look for, of shape (x,2)
+    :return: int64 ndarray of shape (x,) of the index of each coordinate, or -1 where it isn't there
+    """
+    keys = encode_coordinates(coordinates)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[positions] == keys, order[positions], -1)
+
+
+def get_neighbourhood_keys(coordinates, radius):
+    """
+    Finds every coordinate within radius of one of the coordinates, diagonals included (so each one's neighbourhood is
+    a square 2 * radius + 1 on a side), all at once by adding every offset to every coordinate.
+
+    :param coordinates: ndarray of coordinates of shape (x,2)
+    :param radius: number of tiles around each coordinate to include
+    :return: sorted int64 ndarray of the unique keys (see encode_coordinates) of the neighbourhood
+    """
+    coordinates = np.asarray(coordinates, dtype=np.int64).reshape((-1, 2))
+    steps = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(steps, steps), axis=-1).reshape((-1, 2))
+    return np.unique(encode_coordinates((coordinates[:, np.newaxis, :] + offsets).reshape((-1, 2))))
+
+
+def get_boundary_edges(coordinates, labels):
+    """
+    Finds every tile side that isn't shared with a tile of the same label.
+
+    :param coordinates: ndarray of unique coordinates of shape (x,2)
+    :param labels: ndarray of the label of each coordinate
+    :return: tuple of int64 ndarrays (starts, directions, tile_indexes), the corner each edge starts at, the index into
+    EDGE_DIRECTIONS it runs in and the index of the tile on its right
+    """
+    coordinates = np.asarray(coordinates, dtype=np.int64)
+    keys = encode_coordinates(coordinates)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    starts, directions, tile_indexes = [], [], []
+    for neighbor_offset, start_offset, direction in TILE_SIDES:
+        neighbors = find_coordinates(sorted_keys, order, coordinates + neighbor_offset)
+        boundary = (neighbors < 0) | (labels[neighbors] != labels)
+        starts.append(coordinates[boundary] + start_offset)
+        directions.append(np.full(int(boundary.sum()), direction, dtype=np.int64))
+        tile_indexes.append(np.nonzero(boundary)[0])
+    return np.vstack(starts), np.concatenate(directions), np.concatenate(tile_indexes)
+
+
+def get_next_edges(starts, directions, components):
+    """
+    Links every boundary edge to the edge that carries on from its end. Where two tiles only touch at a corner there
+    are two edges to choose from: turning left joins the two tiles up, which is right if they're in the same cluster
+    anyway (it splits a ring that would touch itself into an exterior and a hole, so every ring is simple), and
+    turning right keeps them apart otherwise.
+
+    :param starts: ndarray of the corner each edge starts at, from get_boundary_edges
+    :param directions: ndarray of the direction each edge runs in, from get_boundary_edges
+    :param components: ndarray of the connected component of the tile on the right of each edge
+    :return: int64 ndarray of the index of the next edge along for each edge
+    """
+    # an edge is identified by its start and direction, there can't be two of them
+    edge_keys = encode_coordinates(starts) * 4 + directions
+    order = np.argsort(edge_keys)
+    sorted_keys = edge_keys[order]
+    end_keys = encode_coordinates(starts + EDGE_DIRECTIONS[directions]) * 4
+    next_edges = np.full(len(starts), -1, dtype=np.int64)
+    # left turns within a component, then right turn, straight on and left turn, one of them is always there as
+    # every ring is closed
+    for turn, same_component in [(3, True), (1, False), (0, False), (3, False)]:
+        unlinked = np.nonzero(next_edges < 0)[0]
+        if not len(unlinked):
+            break
+        wanted_keys = end_keys[unlinked] + (directions[unlinked] + turn) % 4
+        positions = np.minimum(np.searchsorted(sorted_keys, wanted_keys), len(sorted_keys) - 1)
+        found = sorted_keys[positions] == wanted_keys
+        if same_component:
+            found &= components[order[positions]] == components[unlinked]
+        next_edges[unlinked[found]] = order[positions[found]]
+    return next_edges
+
+
+def order_rings(next_edges):
+    """
+    Splits the edges into rings and puts each ring's edges in order, both by pointer jumping so, like label_clusters,
+    there's no per edge python. Each ring starts at its lowest edge index.
+
+    :param next_edges: ndarray from get_next_edges, which is a permutation made up of one cycle per ring
+    :return: tuple of int64 ndarrays (ring_ids, positions), the lowest edge index of each edge's ring and how far
+    along the ring the edge is
+    """
+    ring_ids = np.arange(len(next_edges), dtype=np.int64)
+    jumps = next_edges
+    while True:
+        # after n rounds each edge has seen the 2 ** n edges after it, so the ids stop changing once that's a whole
+        # ring for every ring
+        jumped_ids = np.minimum(ring_ids, ring_ids[jumps])
+        if np.array_equal(jumped_ids, ring_ids):
+            break
+        ring_ids, jumps = jumped_ids, jumps[jumps]
+    # cut each ring in front of its first edge, then count the edges from every edge to the cut
+    is_last = ring_ids[next_edges] == next_edges
+    jumps = np.where(is_last, np.arange(len(next_edges)), next_edges)
+    remaining = (~is_last).astype(np.int64)
+    while not np.array_equal(jumps[jumps], jumps):
+        remaining = remaining + remaining[jumps]
+        jumps = jumps[jumps]
+    ring_lengths = np.bincount(ring_ids, minlength=len(next_edges))
+    return ring_ids, ring_lengths[ring_ids] - 1 - remaining
+
+
+def trace_rings(coordinates, labels=None):
+    """
+    Traces the outlines of sets of tiles straight from their grid coordinates, without building a polygon per tile and
+    unioning them. Only the tiles' sides are looked at (once each, with numpy) and the python work is per ring, so this
+    scales with the length of the outlines rather than the number of tiles.
+
+    Exterior rings run clockwise (rows increase southwards, so that's clockwise on a map too) and holes run the other
+    way. Every ring is simple, though holes can touch their exterior or each other at a corner, which geojson and
+    shapely both allow.
+
+    :param coordinates: ndarray of unique coordinates of shape (x,2)
+    :param labels: optional ndarray of the cluster label of each coordinate, tiles with different labels are outlined
+    separately even where they touch
+    :return: tuple of (rings, ring_labels, ring_components, areas), a list of int64 ndarrays of shape (x,2) with the
+    corners of each ring (the first repeated at the end), ndarrays of the label and connected component (from
+    label_clusters) of each ring, and an ndarray of the signed area of each ring in tiles, positive for exteriors and
+    negative for holes
+    """
+    coordinates = np.asarray(coordinates, dtype=np.int64).reshape((-1, 2))
+    labels = np.zeros(len(coordinates), dtype=np.int64) if labels is None else np.asarray(labels)
+    if not len(coordinates):
+        return [], labels[:0], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    components = label_clusters(coordinates, labels)
+    starts, directions, tile_indexes = get_boundary_edges(coordinates, labels)
+    next_edges = get_next_edges(starts, directions, components[tile_indexes])
+    ring_ids, positions = order_rings(next_edges)
+
+    # an edge carrying straight on from the one before it doesn't start a corner, so isn't a vertex
+    previous_edges = np.empty_like(next_edges)
+    previous_edges[next_edges] = np.arange(len(next_edges))
+    corner_indexes = np.nonzero(directions != directions[previous_edges])[0]
+    corner_indexes = corner_indexes[np.lexsort((positions[corner_indexes], ring_ids[corner_indexes]))]
+    vertices = starts[corner_indexes]
+    vertex_rings = ring_ids[corner_indexes]
+    ring_starts = np.flatnonzero(np.r_[True, vertex_rings[1:] != vertex_rings[:-1]])
+
+    # shoelace formula, wrapping each ring's last vertex round to its first
+    next_vertices = np.arange(1, len(vertices) + 1)
+    next_vertices[np.r_[ring_starts[1:], len(vertices)] - 1] = ring_starts
+    cross_products = vertices[:, 0] * vertices[next_vertices, 1] - vertices[next_vertices, 0] * vertices[:, 1]
+    areas = np.add.reduceat(cross_products, ring_starts) // 2
+
+    rings = [np.vstack((ring, ring[:1])) for ring in np.split(vertices, ring_starts[1:])]
+    ring_tiles = tile_indexes[corner_indexes[ring_starts]]
+    return rings, labels[ring_tiles], components[ring_tiles], areas
+
+
+def group_rings(ring_labels, ring_components, areas):
+    """
+    Groups the rings from trace_rings into polygons, one per connected component, each with its exterior first and
+    then its holes.
+
+    :return: dict of label to a list of polygons, each a list of indexes into the rings
+    """
+    polygons = {}
+    component_polygons = {}
+    # exteriors first, so every hole's polygon already exists
+    for index in np.argsort(-areas, kind='stable').tolist():
+        component = ring_components[index].item()
+        if areas[index] > 0:
+            component_polygons[component] = [index]
+            polygons.setdefault(ring_labels[index].item(), []).append(component_polygons[component])
+        else:
+            component_polygons[component].append(index)
+    return polygons
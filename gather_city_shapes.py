@@ -1,10 +1,24 @@
 import argparse
+import concurrent.futures
 import csv
+import hashlib
 import json
 import os
+import threading
 
 import requests
 
+import metrics
+from http_retries import request_with_retries, write_json_atomically
+from rate_limiter import RateLimiter
+
+DEFAULT_NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+# nominatim's usage policy allows at most one request a second
+DEFAULT_NOMINATIM_RATE = 1.0
+DEFAULT_GATHER_WORKERS = 4
+DEFAULT_CACHE_DIRECTORY = os.path.join('data', 'nominatim_cache')
+USER_AGENT = 'SolarPanelDataWrangler (https://github.com/typicalTYLER/SolarPanelDataWrangler)'
+
 
 def get_filename(city, state):
     return city.replace(' ', '_') + '.' + state.replace(' ', '_') + '.json'
@@ -24,35 +38,105 @@ def get_city_state_filepaths(csvpath):
         yield city, state, os.path.join('data', 'geoJSON', get_filename(city, state))
 
 
-def gather(csvpath):
-    for city, state, filepath in get_city_state_filepaths(csvpath):
-        if not os.path.isfile(filepath):
-            with open(filepath, 'w') as outfile:
-                json.dump(query_nominatim_for_geojson(city, state), outfile)
+def gather(csvpath, workers=DEFAULT_GATHER_WORKERS):
+    """
+    Gathers the geoJSON of every city in the csv that doesn't have one yet, workers at a time (but never faster than
+    the rate limit set by configure_nominatim). As cities that were already gathered are skipped, and responses are
+    cached, an interrupted gather picks up where it left off when it's ran again.
+
+    :param csvpath: csv of city, state rows
+    :param workers: number of cities to query for at once
+    :return: list of (city, state, error) for every city that couldn't be gathered
+    """
+    pending = [(city, state, filepath) for city, state, filepath in get_city_state_filepaths(csvpath)
+               if not os.path.isfile(filepath)]
+    if pending:
+        os.makedirs(os.path.dirname(pending[0][2]), exist_ok=True)
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(query_nominatim_for_geojson, city, state): (city, state, filepath)
+                   for city, state, filepath in pending}
+        for future in concurrent.futures.as_completed(futures):
+            city, state, filepath = futures[future]
+            try:
+                write_json_atomically(filepath, future.result())
+            except (ValueError, ConnectionError) as error:
+                print("Couldn't gather {city}, {state}: {error}".format(city=city, state=state, error=error))
+                failures.append((city, state, error))
+    print("Gathered {gathered} of {pending} cities".format(gathered=len(pending) - len(failures), pending=len(pending)))
+    return failures
+
+
+# where nominatim is queried, how fast and where its responses are cached, see configure_nominatim
+nominatim_url = DEFAULT_NOMINATIM_URL
+rate_limiter = RateLimiter(DEFAULT_NOMINATIM_RATE)
+cache_directory = DEFAULT_CACHE_DIRECTORY
+# each thread keeps its own pooled session, requests doesn't promise a session is safe to share between threads
+thread_local = threading.local()
+
+
+def configure_nominatim(url=DEFAULT_NOMINATIM_URL, rate=DEFAULT_NOMINATIM_RATE, cache=DEFAULT_CACHE_DIRECTORY):
+    """
+    :param url: search endpoint to query, e.g. a local nominatim (or a stub of one) instead of the public one
+    :param rate: maximum number of requests per second across all threads, None for no limit
+    :param cache: directory to cache responses in, None to not cache them
+    """
+    global nominatim_url, rate_limiter, cache_directory
+    nominatim_url = url
+    rate_limiter = RateLimiter(rate)
+    cache_directory = cache
+
+
+def get_http_session():
+    if getattr(thread_local, 'session', None) is None:
+        thread_local.session = requests.Session()
+        thread_local.session.headers['User-Agent'] = USER_AGENT
+    return thread_local.session
+
+
+def normalize_query(params):
+    """
+    :param params: dict of nominatim search parameters
+    :return: the parameters sorted, lower cased and with whitespace collapsed (and without empty ones), so queries
+    that nominatim would treat the same get the same cache entry
+    """
+    return sorted((key, ' '.join(str(value).lower().split())) for key, value in params.items() if value)
+
+
+def get_cache_filename(params):
+    key = json.dumps([nominatim_url, normalize_query(params)])
+    return os.path.join(cache_directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def query_nominatim(params):
+    """
+    Searches nominatim, answering from the cache if the same query has been made before. Connection errors and
+    responses that might succeed later (rate limiting and server errors) are retried with jittered exponential backoff.
+
+    :param params: dict of search parameters (the output format parameters are added here)
+    :return: the decoded json response, a list of places
+    """
+    cache_filename = get_cache_filename(params) if cache_directory else None
+    if cache_filename and os.path.isfile(cache_filename):
+        metrics.increment('nominatim_cache_hits')
+        with open(cache_filename, 'r') as infile:
+            return json.load(infile)
+    request_params = dict(normalize_query(params), polygon_geojson=1, format='json')
+    response_json = request_with_retries(get_http_session(), 'GET', nominatim_url, 'nominatim', rate_limiter,
+                                         params=request_params, timeout=60).json()
+    if cache_filename:
+        os.makedirs(cache_directory, exist_ok=True)
+        write_json_atomically(cache_filename, response_json)
+    return response_json
 
 
 def query_nominatim_for_geojson(city=None, state=None, county=None, country=None):
-    url = "https://nominatim.openstreetmap.org/search?"
-    if city:
-        url += "city=" + city + "&"
-    if state:
-        url += "state=" + state + "&"
-    if county:
-        url += "county=" + county + "&"
-    if country:
-        url += "country=" + country + "&"
-    url += "polygon_geojson=1&format=json"
-    response = requests.get(
-        url)
-    if response.ok:
-        response_json = response.json()
-        for single_json in response_json:
-            feature_type = single_json.get('geojson').get('type')
-            if feature_type == 'Polygon' or feature_type == 'MultiPolygon':
-                return single_json['geojson']
-        raise ValueError("No suitable polygons found for url: {}".format(url))
-    else:
-        raise ConnectionError(response.content)
+    params = {'city': city, 'state': state, 'county': county, 'country': country}
+    for single_json in query_nominatim(params):
+        feature_type = single_json.get('geojson').get('type')
+        if feature_type == 'Polygon' or feature_type == 'MultiPolygon':
+            return single_json['geojson']
+    raise ValueError("No suitable polygons found for: {}".format(normalize_query(params)))
 
 
 # These cities are hard to programmatically get for some reason or another, so you have to use the method here to fix
@@ -75,7 +159,19 @@ if __name__ == '__main__':
                         const=True, default=False,
                         help='Run the gather portion of this script, which uses the csv input to gather geoJSON shapes'
                              'from OSM for each city/state pair')
+    parser.add_argument('--workers', dest='workers', type=int, default=DEFAULT_GATHER_WORKERS,
+                        help='Number of cities to query nominatim for at once, defaults to {}'
+                        .format(DEFAULT_GATHER_WORKERS))
+    parser.add_argument('--rate', dest='rate', type=float, default=DEFAULT_NOMINATIM_RATE,
+                        help='Maximum number of nominatim requests per second across all workers, defaults to {} '
+                             '(the most the public nominatim allows)'.format(DEFAULT_NOMINATIM_RATE))
+    parser.add_argument('--nominatim_url', dest='nominatim_url', default=DEFAULT_NOMINATIM_URL,
+                        help='Search endpoint to query instead of the public nominatim, e.g. a local one')
+    parser.add_argument('--cache_dir', dest='cache_dir', default=DEFAULT_CACHE_DIRECTORY,
+                        help='Directory to cache nominatim responses in, defaults to {}'
+                        .format(DEFAULT_CACHE_DIRECTORY))
     args = parser.parse_args()
 
+    configure_nominatim(url=args.nominatim_url, rate=args.rate, cache=args.cache_dir)
     if args.gather:
-        gather(args.csvpath)
+        gather(args.csvpath, workers=args.workers)
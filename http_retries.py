@@ -0,0 +1,62 @@
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+
+import metrics
+
+MAX_RETRIES = 6
+# responses worth retrying, anything else that isn't ok won't get better by asking again
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def request_with_retries(session, method, url, service, rate_limiter, max_retries=MAX_RETRIES, **kwargs):
+    """
+    Makes a request under a rate limit, retrying connection errors and responses that might succeed later (rate
+    limiting and server errors) with jittered exponential backoff. Waits, requests and failures are recorded in the
+    <service>_rate_limit_wait, <service>_query, <service>_queries and <service>_query_failures metrics.
+
+    :param session: requests session to make the request with
+    :param method: http method, e.g. 'GET' or 'POST'
+    :param url: url to request
+    :param service: name of the service in metrics and messages, e.g. 'nominatim'
+    :param rate_limiter: RateLimiter shared by everything making requests to the service
+    :param max_retries: number of attempts to make before giving up
+    :param kwargs: passed on to session.request
+    :return: the ok response
+    """
+    for i in range(max_retries):
+        with metrics.timer(service + '_rate_limit_wait'):
+            rate_limiter.wait()
+        try:
+            with metrics.timer(service + '_query'):
+                response = session.request(method, url, **kwargs)
+        except requests.RequestException as error:
+            reason = error
+        else:
+            if response.ok:
+                metrics.increment(service + '_queries')
+                return response
+            if response.status_code not in RETRY_STATUS_CODES:
+                raise ConnectionError(response.content)
+            reason = response.status_code
+        metrics.increment(service + '_query_failures')
+        # full jitter, so workers that failed together don't all retry together
+        backoff_time = random.uniform(0, 2 ** i)
+        print('Got "{reason}" from {service}, backing off for {time:.1f} seconds.'.format(
+            reason=reason, service=service, time=backoff_time))
+        time.sleep(backoff_time)
+    raise ConnectionError("Couldn't query {service} after {retries} retries".format(service=service,
+                                                                                    retries=max_retries))
+
+
+def write_json_atomically(filepath, value):
+    """Writes value to a temporary file first, so an interrupted write never leaves half a file behind."""
+    temporary_filepath = '{filepath}.{pid}.{thread}.tmp'.format(filepath=filepath, pid=os.getpid(),
+                                                               thread=threading.get_ident())
+    with open(temporary_filepath, 'w') as outfile:
+        json.dump(value, outfile)
+    os.replace(temporary_filepath, filepath)
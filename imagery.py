@@ -1,14 +1,27 @@
+import argparse
+import concurrent.futures
+import functools
+import hashlib
 import os
 import pathlib
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from io import BytesIO
 
+import numpy as np
+import requests
 from PIL import Image
-from mapbox import Static
 
+import metrics
 import solardb
+from rate_limiter import RateLimiter
 from process_city_shapes import num2deg
 
+# shards of the sharded tile storage are rolled over once they reach this size
+DEFAULT_SHARD_BYTES = 1024 * 1024 * 1024
+
 
 class ImageTile(object):
     """Represents a single image tile."""
@@ -44,7 +57,12 @@ class ImageTile(object):
         if not filename:
             filename = self.generate_filename(zoom=zoom)
         pathlib.Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
-        self.image.save(filename, file_format)
+        # write then rename, so a reader (e.g. stitching a border tile while the prefetcher saves its grid) never opens
+        # a half written jpeg
+        temporary_filename = '{filename}.{pid}.{thread}.tmp'.format(filename=filename, pid=os.getpid(),
+                                                                    thread=threading.get_ident())
+        self.image.save(temporary_filename, file_format)
+        os.replace(temporary_filename, filename)
         self.filename = filename
 
     def load(self, filename=None, zoom=21):
@@ -72,6 +90,388 @@ class ImageTile(object):
         return '<Tile #{}>'.format(self.coords)
 
 
+class ImageGrid(object):
+    """
+    Represents a whole query grid of imagery stored as a single uncompressed array, which can be memory mapped so
+    that any tile (or stitched view) inside of it is just a slice.
+    """
+
+    def __init__(self, array, base_coords, filename=None):
+        self.array = array
+        self.base_coords = base_coords
+        self.filename = filename
+
+    def generate_filename(self, zoom=21, directory=os.path.join(os.getcwd(), 'data', 'imagery'), path=True):
+        """Construct and return a filename for this grid."""
+        filename = os.path.join(str(zoom), 'grids', str(self.base_coords[1]), str(self.base_coords[0]) + '.npy')
+        if not path:
+            return filename
+        return os.path.join(directory, filename)
+
+    def save(self, filename=None, zoom=21):
+        if not filename:
+            filename = self.generate_filename(zoom=zoom)
+        pathlib.Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        # write then rename, so a reader never memory maps a half written grid
+        np.save(filename + '.tmp.npy', self.array)
+        os.replace(filename + '.tmp.npy', filename)
+        self.filename = filename
+
+    def load(self, filename=None, zoom=21):
+        if not filename:
+            filename = self.generate_filename(zoom=zoom)
+        if self.array is not None:
+            return self.array
+        if not pathlib.Path(filename).is_file():
+            return None
+        self.filename = filename
+        self.array = open_grid_array(filename)
+        return self.array
+
+    def delete(self, filename=None, zoom=21):
+        if not filename:
+            filename = self.generate_filename(zoom=zoom)
+        open_grid_array.cache_clear()
+        pathlib.Path(filename).unlink()
+        self.filename = filename
+
+    def __repr__(self):
+        return '<Grid #{} - {}>'.format(self.base_coords, self.filename)
+
+
+# keeps the most recently used grids mapped, the os page cache takes care of keeping their pixels in memory
+@functools.lru_cache(maxsize=64)
+def open_grid_array(filename):
+    return np.load(filename, mmap_mode='r')
+
+
+class FileTileStorage(object):
+    """Stores every tile as its own jpeg, at <directory>/<zoom>/<row>/<column>.jpg"""
+
+    def __init__(self, directory=os.path.join(os.getcwd(), 'data', 'imagery')):
+        self.directory = directory
+
+    def get_filename(self, coords, zoom):
+        return ImageTile(None, coords).generate_filename(zoom=zoom, directory=self.directory)
+
+    def exists(self, coords, zoom=21):
+        return os.path.isfile(self.get_filename(coords, zoom))
+
+    def load(self, coords, zoom=21):
+        return ImageTile(None, coords).load(filename=self.get_filename(coords, zoom))
+
+    def read_bytes(self, coords, zoom=21):
+        with open(self.get_filename(coords, zoom), 'rb') as infile:
+            return infile.read()
+
+    def save_many(self, tiles, zoom=21):
+        for tile in tiles:
+            tile.save(filename=self.get_filename(tile.coords, zoom))
+
+    def delete_many(self, slippy_coordinates, workers=1):
+        """
+        :param slippy_coordinates: list of (column, row, zoom) tuples
+        :param workers: number of threads to unlink files with
+        :return: (number of tiles deleted, number of bytes freed)
+        """
+        filenames = [self.get_filename(coordinate_tuple[:2], coordinate_tuple[2])
+                     for coordinate_tuple in slippy_coordinates]
+        return delete_files(filenames, workers=workers)
+
+
+class ShardedTileStorage(object):
+    """
+    Packs tiles into large append-only shard files, with an index of where each one is kept in a sqlite database next
+    to them. Tiles are content addressed, so identical tiles (e.g. open water) are only stored once. The index is also
+    held in memory as sorted arrays, so checking whether a tile exists never touches the disk and reading one is a
+    single pread.
+
+    Deleting a tile only removes it from the index, run compact to reclaim the space in the shards.
+    """
+
+    def __init__(self, directory=os.path.join(os.getcwd(), 'data', 'imagery', 'shards'),
+                 shard_bytes=DEFAULT_SHARD_BYTES):
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._read_fds = {}
+        self._append_file = None
+        self._index = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self._index.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS blobs (digest BLOB PRIMARY KEY, shard INTEGER NOT NULL,
+                                              offset INTEGER NOT NULL, length INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS tiles (zoom INTEGER NOT NULL, "column" INTEGER NOT NULL, "row" INTEGER NOT NULL,
+                                              digest BLOB NOT NULL, PRIMARY KEY (zoom, "column", "row"));
+        """)
+        shards = [int(get_basename(filename).split('-')[1]) for filename in os.listdir(directory)
+                  if filename.startswith('shard-')]
+        self._shard = max(shards) if shards else 0
+        self._shard_size = self._get_shard_size(self._shard)
+        self._load_index()
+
+    def _load_index(self):
+        rows = np.array(self._index.execute(
+            'SELECT t.zoom, t."column", t."row", b.shard, b.offset, b.length '
+            'FROM tiles t JOIN blobs b ON t.digest = b.digest').fetchall(), dtype=np.int64).reshape((-1, 6))
+        keys = encode_tile_keys(rows[:, 0:3])
+        order = np.argsort(keys)
+        # shard, offset and length of each key, a length of -1 means the tile was deleted. Both arrays are swapped in
+        # together so readers never see one without the other
+        self._sorted_index = (keys[order], rows[order, 3:6])
+
+    def _merge_index(self, keys, locations):
+        """
+        Merges tiles into the sorted index arrays, replacing the locations of keys that are already there
+
+        :param keys: int64 ndarray of tile keys, see encode_tile_keys
+        :param locations: int64 ndarray of shape (x,3) of the (shard, offset, length) of each key
+        """
+        if not len(keys):
+            return
+        # a tile put twice in one batch keeps its last location
+        keys, last = np.unique(keys[::-1], return_index=True)
+        locations = locations[::-1][last]
+        sorted_keys, sorted_locations = self._sorted_index
+        positions = np.searchsorted(sorted_keys, keys)
+        found = positions < len(sorted_keys)
+        found[found] = sorted_keys[positions[found]] == keys[found]
+        sorted_locations = sorted_locations.copy()
+        sorted_locations[positions[found]] = locations[found]
+        self._sorted_index = (np.insert(sorted_keys, positions[~found], keys[~found]),
+                              np.insert(sorted_locations, positions[~found], locations[~found], axis=0))
+
+    def _get_shard_filename(self, shard):
+        return os.path.join(self.directory, 'shard-{:05d}.bin'.format(shard))
+
+    def _get_shard_size(self, shard):
+        filename = self._get_shard_filename(shard)
+        return os.path.getsize(filename) if os.path.isfile(filename) else 0
+
+    def _get_read_fd(self, shard):
+        fd = self._read_fds.get(shard)
+        if fd is None:
+            # under the lock so two readers missing at once don't both open the shard and leak one of the fds
+            with self._lock:
+                fd = self._read_fds.get(shard)
+                if fd is None:
+                    fd = self._read_fds[shard] = os.open(self._get_shard_filename(shard), os.O_RDONLY)
+        return fd
+
+    def _append(self, data):
+        """Appends to the current shard through a handle kept open until _close_append_file, so call that after."""
+        if self._shard_size and self._shard_size + len(data) > self.shard_bytes:
+            self._close_append_file()
+            self._shard += 1
+            self._shard_size = 0
+        if self._append_file is None:
+            self._append_file = open(self._get_shard_filename(self._shard), 'ab')
+        self._append_file.write(data)
+        location = (self._shard, self._shard_size, len(data))
+        self._shard_size += len(data)
+        return location
+
+    def _close_append_file(self):
+        if self._append_file is not None:
+            self._append_file.close()
+            self._append_file = None
+
+    def get_location(self, coords, zoom=21):
+        """:return: (shard, offset, length) of the tile, or None if it isn't stored"""
+        key = encode_tile_key(coords, zoom)
+        keys, locations = self._sorted_index
+        position = np.searchsorted(keys, key)
+        if position < len(keys) and keys[position] == key and locations[position, 2] >= 0:
+            return tuple(locations[position])
+        return None
+
+    def exists(self, coords, zoom=21):
+        return self.get_location(coords, zoom) is not None
+
+    def read_bytes(self, coords, zoom=21):
+        location = self.get_location(coords, zoom)
+        if location is None:
+            return None
+        shard, offset, length = location
+        return os.pread(self._get_read_fd(shard), int(length), int(offset))
+
+    def load(self, coords, zoom=21):
+        data = self.read_bytes(coords, zoom)
+        if data is None:
+            return None
+        return Image.open(BytesIO(data))
+
+    def put_many(self, entries):
+        """
+        :param entries: iterable of (coords, zoom, encoded image bytes) tuples
+        """
+        with self._lock:
+            keys, locations = [], []
+            for coords, zoom, data in entries:
+                digest = hashlib.sha1(data).digest()
+                location = self._index.execute('SELECT shard, offset, length FROM blobs WHERE digest = ?',
+                                               (digest,)).fetchone()
+                if location is None:
+                    location = self._append(data)
+                    self._index.execute('INSERT INTO blobs VALUES (?, ?, ?, ?)', (digest,) + location)
+                self._index.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                                    (zoom, coords[0], coords[1], digest))
+                keys.append(encode_tile_key(coords, zoom))
+                locations.append(location)
+            # the shard data is written before the index that points at it is committed
+            self._close_append_file()
+            self._index.commit()
+            self._merge_index(np.array(keys, dtype=np.int64), np.array(locations, dtype=np.int64).reshape((-1, 3)))
+
+    def save_many(self, tiles, zoom=21, file_format='jpeg'):
+        entries = []
+        for tile in tiles:
+            data = BytesIO()
+            tile.image.save(data, file_format)
+            entries.append((tile.coords, zoom, data.getvalue()))
+        self.put_many(entries)
+
+    def delete_many(self, slippy_coordinates):
+        """
+        Deleting is just an index update, so unlike FileTileStorage.delete_many there's nothing to spread over threads
+
+        :param slippy_coordinates: list of (column, row, zoom) tuples
+        :return: (number of tiles deleted, number of bytes they took up in the shards)
+        """
+        deleted, freed_bytes = 0, 0
+        with self._lock:
+            keys = []
+            for column, row, zoom in slippy_coordinates:
+                location = self.get_location((column, row), zoom)
+                if location is None:
+                    continue
+                self._index.execute('DELETE FROM tiles WHERE zoom = ? AND "column" = ? AND "row" = ?',
+                                    (zoom, column, row))
+                keys.append(encode_tile_key((column, row), zoom))
+                deleted += 1
+                freed_bytes += int(location[2])
+            self._index.commit()
+            self._merge_index(np.array(keys, dtype=np.int64), np.full((len(keys), 3), -1, dtype=np.int64))
+        return deleted, freed_bytes
+
+    def compact(self):
+        """
+        Rewrites every blob still referenced by a tile into fresh shards and deletes the old shards, reclaiming the
+        space of deleted tiles. Nothing else should be using the storage while this runs.
+
+        :return: number of bytes reclaimed
+        """
+        with self._lock:
+            old_shards = list(range(self._shard + 1))
+            old_bytes = sum(self._get_shard_size(shard) for shard in old_shards)
+            self._index.execute('DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM tiles)')
+            self._shard += 1
+            self._shard_size = 0
+            blobs = self._index.execute('SELECT digest, shard, offset, length FROM blobs ORDER BY shard, offset')
+            for digest, shard, offset, length in blobs.fetchall():
+                data = os.pread(self._get_read_fd(shard), length, offset)
+                self._index.execute('UPDATE blobs SET shard = ?, offset = ? WHERE digest = ?',
+                                    self._append(data)[:2] + (digest,))
+            self._close_append_file()
+            self._index.commit()
+            for shard in old_shards:
+                fd = self._read_fds.pop(shard, None)
+                if fd is not None:
+                    os.close(fd)
+                if os.path.isfile(self._get_shard_filename(shard)):
+                    os.unlink(self._get_shard_filename(shard))
+            self._load_index()
+            return old_bytes - sum(self._get_shard_size(shard) for shard in range(old_shards[-1] + 1,
+                                                                                   self._shard + 1))
+
+
+def encode_tile_key(coords, zoom):
+    """Packs a tile's coordinates into one integer, columns and rows get 29 bits each which covers up to zoom 29."""
+    return (int(zoom) << 58) | (int(coords[0]) << 29) | int(coords[1])
+
+
+def encode_tile_keys(zoom_column_rows):
+    zoom_column_rows = np.asarray(zoom_column_rows, dtype=np.int64)
+    return (zoom_column_rows[:, 0] << 58) | (zoom_column_rows[:, 1] << 29) | zoom_column_rows[:, 2]
+
+
+def delete_files(filenames, workers=1):
+    """
+    Deletes files, on a pool of threads if workers is more than 1. Files that don't exist are skipped.
+
+    :return: (number of files deleted, number of bytes freed)
+    """
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            freed_bytes = list(executor.map(delete_file, filenames))
+    else:
+        freed_bytes = [delete_file(filename) for filename in filenames]
+    deleted_bytes = [size for size in freed_bytes if size is not None]
+    return len(deleted_bytes), sum(deleted_bytes)
+
+
+class ImageCache(object):
+    """
+    Thread safe LRU cache of decoded images, bounded by the memory the decoded pixels take up. Hits and misses are also
+    counted in the <name>_cache_hits and <name>_cache_misses metrics.
+    """
+
+    def __init__(self, max_megabytes=0, name='image'):
+        self.name = name
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+        metrics.increment(self.name + ('_cache_misses' if image is None else '_cache_hits'))
+        return image
+
+    def put(self, key, image):
+        size = get_image_bytes(image)
+        if size > self.max_bytes:
+            return
+        image.load()  # PIL opens lazily, make sure what's cached is already decoded
+        with self._lock:
+            if key in self._images:
+                self.bytes -= get_image_bytes(self._images.pop(key))
+            self._images[key] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.bytes -= get_image_bytes(evicted)
+
+    def pop(self, key):
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                self.bytes -= get_image_bytes(image)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def __repr__(self):
+        lookups = self.hits + self.misses
+        return '<ImageCache {hits}/{lookups} hits ({rate:.0%}), {used:.0f}/{max:.0f}MB>'.format(
+            hits=self.hits, lookups=lookups, rate=self.hits / lookups if lookups else 0,
+            used=self.bytes / 1024 / 1024, max=self.max_bytes / 1024 / 1024)
+
+
+def get_image_bytes(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
 def get_basename(filename):
     """Strip path and extension. Return basename."""
     return os.path.splitext(os.path.basename(filename))[0]
@@ -140,13 +540,156 @@ PASTE_COORDINATES = [
 
 MAX_RETRIES = 12  # max wait time with exponential backoff would be ~34 minutes
 
-service = Static()
+
+class UrlStaticService(object):
+    """
+    Stand in for mapbox's Static service that requests the same static image paths from any base url, e.g. a local
+    server that serves fake satellite imagery.
+    """
+
+    def __init__(self, base_url, access_token=None):
+        self.base_url = base_url.rstrip('/')
+        self.access_token = access_token or os.environ.get('MAPBOX_ACCESS_TOKEN')
+        self.session = requests.Session()
+
+    def image(self, map_id, lon=None, lat=None, z=None, width=600, height=600, image_format='png256', retina=False):
+        url = '{base_url}/{map_id}/{lon},{lat},{z}/{width}x{height}{retina}.{image_format}'.format(
+            base_url=self.base_url, map_id=map_id, lon=lon, lat=lat, z=z, width=width, height=height,
+            retina='@2x' if retina else '', image_format=image_format)
+        return self.session.get(url, params={'access_token': self.access_token})
+
+
+# mapbox's Static service is created on first use, see get_imagery_service
+service = None
+# shared by every thread querying the imagery service
+rate_limiter = RateLimiter()
+
+
+def configure_imagery_service(url=None, rate=None):
+    """
+    :param url: base url of a server to query for imagery instead of mapbox (which is used when None)
+    :param rate: maximum number of imagery requests per second across all threads, None for no limit
+    """
+    global service, rate_limiter
+    service = UrlStaticService(url) if url else None
+    rate_limiter = RateLimiter(rate)
+
+
+def get_imagery_service():
+    global service
+    if service is None:
+        from mapbox import Static
+
+        service = Static()
+    return service
+
+# how fetched imagery is kept on disk, either "tiles" (a jpeg per tile) or "mosaic" (an ImageGrid per query grid, which
+# takes up roughly 13x the disk space but makes stitching a slice of a memory mapped array)
+IMAGERY_STORES = ('tiles', 'mosaic')
+imagery_store = 'tiles'
+
+
+def configure_imagery_store(store):
+    global imagery_store
+    if store not in IMAGERY_STORES:
+        raise ValueError("Unsupported imagery store: " + str(store))
+    imagery_store = store
+
+
+# where the jpegs of the "tiles" imagery store are kept, either "files" (FileTileStorage) or "shards"
+# (ShardedTileStorage)
+TILE_STORAGES = ('files', 'shards')
+tile_storage = FileTileStorage()
+
+
+def configure_tile_storage(storage):
+    global tile_storage
+    if storage not in TILE_STORAGES:
+        raise ValueError("Unsupported tile storage: " + str(storage))
+    tile_storage = ShardedTileStorage() if storage == 'shards' else FileTileStorage()
+
+
+# decoded tiles keyed by (column, row, zoom), each 256x256 tile takes up 192KB
+DEFAULT_TILE_CACHE_MEGABYTES = 512
+tile_cache = ImageCache(max_megabytes=DEFAULT_TILE_CACHE_MEGABYTES, name='tile')
+# whole decoded (upsampled) query grids keyed by the (column, row, zoom) of their top left tile, each one is 75MB so
+# this is off by default
+grid_cache = ImageCache(max_megabytes=0, name='grid')
+
+
+def configure_image_caches(tile_megabytes=DEFAULT_TILE_CACHE_MEGABYTES, grid_megabytes=0):
+    """
+    Replaces the tile and grid caches with empty ones of the given sizes, a size of 0 disables that cache.
+
+    :param tile_megabytes: memory cap of the decoded tile cache
+    :param grid_megabytes: memory cap of the decoded query grid cache
+    """
+    global tile_cache, grid_cache
+    tile_cache = ImageCache(max_megabytes=tile_megabytes, name='tile')
+    grid_cache = ImageCache(max_megabytes=grid_megabytes, name='grid')
+
+
+def get_grid_base_coords(slippy_coordinates, grid_size=GRID_SIZE):
+    """Get the top left tile of the query grid the given tile belongs to."""
+    return tuple(map(lambda x: x - x % grid_size, slippy_coordinates))
+
+
+def crop_tile_from_grid(grid_image, base_coords, slippy_coordinates):
+    column_offset = (slippy_coordinates[0] - base_coords[0]) * TILE_SIDE_LENGTH
+    row_offset = (slippy_coordinates[1] - base_coords[1]) * TILE_SIDE_LENGTH
+    return grid_image.crop((column_offset, row_offset, column_offset + TILE_SIDE_LENGTH,
+                            row_offset + TILE_SIDE_LENGTH))
+
+
+def load_grid_image(base_coords, grid_size=GRID_SIZE, zoom=FINAL_ZOOM):
+    """
+    Assembles a whole query grid from the tiles saved on disk.
+
+    :return: the grid image, or None if any of its tiles aren't on disk
+    """
+    coords = [(base_coords[0] + column_offset, base_coords[1] + row_offset)
+              for row_offset in range(grid_size) for column_offset in range(grid_size)]
+    # check first so grids that have had tiles deleted don't get decoded only to be thrown away
+    if not all(tile_storage.exists(tile_coords, zoom=zoom) for tile_coords in coords):
+        return None
+    grid_image = Image.new('RGB', (TILE_SIDE_LENGTH * grid_size, TILE_SIDE_LENGTH * grid_size))
+    with metrics.timer('grid_read'):
+        for tile_coords in coords:
+            grid_image.paste(tile_storage.load(tile_coords, zoom=zoom),
+                             ((tile_coords[0] - base_coords[0]) * TILE_SIDE_LENGTH,
+                              (tile_coords[1] - base_coords[1]) * TILE_SIDE_LENGTH))
+    return grid_image
+
+
+grid_locks = {}
+grid_locks_lock = threading.Lock()
+
+
+def get_grid_lock(grid_key):
+    with grid_locks_lock:
+        return grid_locks.setdefault(grid_key, threading.Lock())
 
 
 def gather_and_persist_imagery_at_coordinate(slippy_coordinates, final_zoom=FINAL_ZOOM, grid_size=GRID_SIZE,
                                              imagery="mapbox"):
     # the top left square of the query grid this point belongs to
-    base_coords = tuple(map(lambda x: x - x % grid_size, slippy_coordinates))
+    base_coords = get_grid_base_coords(slippy_coordinates, grid_size=grid_size)
+    # only one thread fetches a grid at a time, any others waiting on it can use what it saved
+    with get_grid_lock(base_coords + (final_zoom,)):
+        if imagery_store == 'mosaic':
+            grid_array = ImageGrid(None, base_coords).load(zoom=final_zoom)
+            if grid_array is not None:
+                return Image.fromarray(get_tile_array(grid_array, base_coords, slippy_coordinates))
+        else:
+            image = tile_storage.load(slippy_coordinates, zoom=final_zoom)
+            if image:
+                return image
+        return query_and_persist_imagery_grid(slippy_coordinates, base_coords, final_zoom=final_zoom,
+                                              grid_size=grid_size, imagery=imagery)
+
+
+def query_and_persist_imagery_grid(slippy_coordinates, base_coords, final_zoom=FINAL_ZOOM, grid_size=GRID_SIZE,
+                                   imagery="mapbox"):
     if grid_size % 2 == 0:
         # if the grid size is even, the center point is between 4 tiles in center (or the top left of bottom right one)
         center_bottom_right_tile = tuple(map(lambda x: x + grid_size // 2, base_coords))
@@ -157,20 +700,40 @@ def gather_and_persist_imagery_at_coordinate(slippy_coordinates, final_zoom=FINA
         center_lon_lat = num2deg(center_tile, zoom=FINAL_ZOOM, center=True)
     if imagery == "mapbox":
         for i in range(MAX_RETRIES):
-            response = service.image('mapbox.satellite', lon=center_lon_lat[0], lat=center_lon_lat[1], z=final_zoom - 2,
-                                     width=MAX_IMAGE_SIDE_LENGTH, height=MAX_IMAGE_SIDE_LENGTH, image_format='jpg90',
-                                     retina=(ZOOM_FACTOR > 0))
+            with metrics.timer('imagery_rate_limit_wait'):
+                rate_limiter.wait()
+            with metrics.timer('imagery_fetch'):
+                response = get_imagery_service().image('mapbox.satellite', lon=center_lon_lat[0],
+                                                       lat=center_lon_lat[1], z=final_zoom - 2,
+                                                       width=MAX_IMAGE_SIDE_LENGTH, height=MAX_IMAGE_SIDE_LENGTH,
+                                                       image_format='jpg90', retina=(ZOOM_FACTOR > 0))
             if response.ok:
+                metrics.increment('imagery_fetches')
+                metrics.increment('imagery_fetch_bytes', len(response.content))
                 image = Image.open(BytesIO(response.content))
-                tiles = slice_image(image, base_coords, upsample_count=max(ZOOM_FACTOR - 1, 0),
-                                    slices_per_side=grid_size)
+                upsampled_image = image
+                for _ in range(max(ZOOM_FACTOR - 1, 0)):
+                    upsampled_image = double_image_size(upsampled_image)
+                if imagery_store == 'mosaic':
+                    grid = ImageGrid(np.asarray(upsampled_image.convert('RGB')), base_coords)
+                    with metrics.timer('imagery_save'):
+                        grid.save(zoom=final_zoom)
+                    solardb.mark_has_imagery(base_coords, grid_size, zoom=final_zoom)
+                    return Image.fromarray(get_tile_array(grid.array, base_coords, slippy_coordinates))
+                if grid_cache.enabled:
+                    grid_cache.put(base_coords + (final_zoom,), upsampled_image)
+                tiles = slice_image(upsampled_image, base_coords, slices_per_side=grid_size)
                 to_return = None
+                with metrics.timer('imagery_save'):
+                    tile_storage.save_many(tiles, zoom=FINAL_ZOOM)
                 for tile in tiles:
                     if tile.coords == slippy_coordinates:
                         to_return = tile.image
-                    tile.save(zoom=FINAL_ZOOM)
+                    # the tiles were just decoded, so save having to read them back in from disk
+                    tile_cache.put(tile.coords + (final_zoom,), tile.image)
                 solardb.mark_has_imagery(base_coords, grid_size, zoom=final_zoom)
                 return to_return
+            metrics.increment('imagery_fetch_failures')
             backoff_time = pow(2, i)
             print('Got this response from {service}:"{error}", exponentially backing off, {time} seconds.'
                   .format(service=imagery, error=getattr(response, "content", None), time=backoff_time))
@@ -181,19 +744,85 @@ def gather_and_persist_imagery_at_coordinate(slippy_coordinates, final_zoom=FINA
         AttributeError("Unsupported Imagery source: " + str(imagery))
 
 
-# loads image from disk if possible, otherwise queries an imagery service
+def get_tile_array(grid_array, base_coords, slippy_coordinates):
+    column_offset = (slippy_coordinates[0] - base_coords[0]) * TILE_SIDE_LENGTH
+    row_offset = (slippy_coordinates[1] - base_coords[1]) * TILE_SIDE_LENGTH
+    return grid_array[row_offset:row_offset + TILE_SIDE_LENGTH, column_offset:column_offset + TILE_SIDE_LENGTH]
+
+
+# loads a whole grid from the mosaic store, otherwise queries an imagery service for it
+def get_grid_array(base_coords, zoom=FINAL_ZOOM):
+    with metrics.timer('grid_read'):
+        array = ImageGrid(None, base_coords).load(zoom=zoom)
+    if array is None:
+        gather_and_persist_imagery_at_coordinate(base_coords, final_zoom=zoom)
+        array = ImageGrid(None, base_coords).load(zoom=zoom)
+    return array
+
+
+# gets the stitched view around a coordinate as an array, straight out of the mosaic store if it's being used, this is a
+# view of the memory mapped grid (no copying) unless the view straddles the edge of a grid
+def stitch_array_at_coordinate(slippy_coordinate, grid_size=GRID_SIZE):
+    if imagery_store != 'mosaic':
+        return np.asarray(stitch_image_at_coordinate(slippy_coordinate))
+    grid_side_length = grid_size * TILE_SIDE_LENGTH
+    # pixel bounds of the stitched view, counted from the top left of the whole map
+    left = slippy_coordinate[0] * TILE_SIDE_LENGTH - STITCH_WIDTH
+    top = slippy_coordinate[1] * TILE_SIDE_LENGTH - STITCH_WIDTH
+    right = left + FINISHED_TILE_SIDE_LENGTH
+    bottom = top + FINISHED_TILE_SIDE_LENGTH
+    grid_lefts = range(left - left % grid_side_length, right, grid_side_length)
+    grid_tops = range(top - top % grid_side_length, bottom, grid_side_length)
+    if len(grid_lefts) == 1 and len(grid_tops) == 1:
+        grid_array = get_grid_array((grid_lefts[0] // TILE_SIDE_LENGTH, grid_tops[0] // TILE_SIDE_LENGTH))
+        return grid_array[top - grid_tops[0]:bottom - grid_tops[0], left - grid_lefts[0]:right - grid_lefts[0]]
+    # the view straddles a grid edge, so copy the overlapping part of each neighbouring grid into place
+    output = np.empty((FINISHED_TILE_SIDE_LENGTH, FINISHED_TILE_SIDE_LENGTH, 3), dtype=np.uint8)
+    for grid_top in grid_tops:
+        for grid_left in grid_lefts:
+            grid_array = get_grid_array((grid_left // TILE_SIDE_LENGTH, grid_top // TILE_SIDE_LENGTH))
+            overlap_left, overlap_right = max(left, grid_left), min(right, grid_left + grid_side_length)
+            overlap_top, overlap_bottom = max(top, grid_top), min(bottom, grid_top + grid_side_length)
+            output[overlap_top - top:overlap_bottom - top, overlap_left - left:overlap_right - left] = \
+                grid_array[overlap_top - grid_top:overlap_bottom - grid_top,
+                           overlap_left - grid_left:overlap_right - grid_left]
+    return output
+
+
+# loads image from the caches or disk if possible, otherwise queries an imagery service
 def get_image_for_coordinate(slippy_coordinate):
-    tile = ImageTile(None, slippy_coordinate)
-    image = tile.load()
-    if not image:
-        image = gather_and_persist_imagery_at_coordinate(slippy_coordinate, final_zoom=FINAL_ZOOM)
-    return image
+    if imagery_store == 'mosaic':
+        base_coords = get_grid_base_coords(slippy_coordinate)
+        return Image.fromarray(get_tile_array(get_grid_array(base_coords), base_coords, slippy_coordinate))
+    key = tuple(slippy_coordinate) + (FINAL_ZOOM,)
+    image = tile_cache.get(key) if tile_cache.enabled else None
+    if image:
+        return image
+    if grid_cache.enabled:
+        base_coords = get_grid_base_coords(slippy_coordinate)
+        grid_key = base_coords + (FINAL_ZOOM,)
+        grid_image = grid_cache.get(grid_key)
+        if not grid_image:
+            grid_image = load_grid_image(base_coords)
+            if grid_image:
+                grid_cache.put(grid_key, grid_image)
+        if grid_image:
+            return crop_tile_from_grid(grid_image, base_coords, slippy_coordinate)
+    with metrics.timer('tile_read'):
+        image = tile_storage.load(slippy_coordinate, zoom=FINAL_ZOOM)
+    if image:
+        if tile_cache.enabled:
+            tile_cache.put(key, image)
+        return image
+    return gather_and_persist_imagery_at_coordinate(slippy_coordinate, final_zoom=FINAL_ZOOM)
 
 
 # gets a larger image at the specified slippy coordinate by stitching other border tiles together
 # TODO: optimize
 # TODO: there's also some symmetry here that can be exploited but this seems easier for now
 def stitch_image_at_coordinate(slippy_coordinate):
+    if imagery_store == 'mosaic':
+        return Image.fromarray(stitch_array_at_coordinate(slippy_coordinate))
     images = []
     # gather the images in each direction around the target image
     for column in range(slippy_coordinate[0] - 1, slippy_coordinate[0] + 2):
@@ -209,6 +838,190 @@ def stitch_image_at_coordinate(slippy_coordinate):
     return output_image
 
 
-def delete_images(slippy_coordinates):
+def delete_images(slippy_coordinates, grid_size=GRID_SIZE, workers=1):
+    """
+    Deletes the imagery of the given tiles, unlinking files on a pool of threads if workers is more than 1. Tiles that
+    have no imagery are skipped.
+
+    :param slippy_coordinates: iterable of (column, row, zoom) tuples
+    :param workers: number of threads to delete files with, sharded tile storage doesn't delete any files
+    :return: (number of files or tiles deleted, number of bytes freed)
+    """
+    slippy_coordinates = [tuple(coordinate_tuple) for coordinate_tuple in slippy_coordinates]
+    if imagery_store == 'mosaic':
+        open_grid_array.cache_clear()
+        return delete_files(get_deletable_grid_filenames(slippy_coordinates, grid_size=grid_size), workers=workers)
     for coordinate_tuple in slippy_coordinates:
-        ImageTile(None, coordinate_tuple).delete(zoom=coordinate_tuple[2])
+        tile_cache.pop(coordinate_tuple)
+    if isinstance(tile_storage, ShardedTileStorage):
+        return tile_storage.delete_many(slippy_coordinates)
+    return tile_storage.delete_many(slippy_coordinates, workers=workers)
+
+
+def delete_file(filename):
+    """:return: the size of the deleted file in bytes, or None if there wasn't a file to delete"""
+    try:
+        size = os.stat(filename).st_size
+        os.unlink(filename)
+        return size
+    except FileNotFoundError:
+        return None
+
+
+def get_deletable_grid_filenames(slippy_coordinates, grid_size=GRID_SIZE):
+    """
+    Works out which mosaic grids can be deleted now that the given tiles' imagery isn't needed anymore. A grid is kept
+    as long as any polygon tile in it (or bordering it, since stitching takes the tiles around a tile too) still has
+    imagery, so grids only partly freed by this batch are picked up by whichever later batch frees their last tile.
+
+    :param slippy_coordinates: iterable of (column, row, zoom) tuples whose tiles were just marked as not having imagery
+    :return: list of the filenames of the grids that can be deleted
+    """
+    grid_keys = set()
+    for column, row, zoom in slippy_coordinates:
+        for border_column in range(column - 1, column + 2):
+            for border_row in range(row - 1, row + 2):
+                grid_keys.add(get_grid_base_coords((border_column, border_row), grid_size=grid_size) + (zoom,))
+    filenames = [(grid_key, ImageGrid(None, grid_key[:2]).generate_filename(zoom=grid_key[2]))
+                 for grid_key in sorted(grid_keys)]
+    filenames = [(grid_key, filename) for grid_key, filename in filenames if os.path.isfile(filename)]
+    needed_grid_keys = solardb.query_grids_needing_imagery([grid_key for grid_key, _ in filenames], grid_size)
+    return [filename for grid_key, filename in filenames if grid_key not in needed_grid_keys]
+
+
+def get_missing_grids(slippy_coordinates, grid_size=GRID_SIZE):
+    """
+    Works out which query grids have to be fetched before the given tiles can be stitched (including the grids of their
+    border tiles). Each grid is only checked once, through the first tile needed from it, as grids are saved whole; a
+    grid that's since lost some of its tiles is fetched again by whoever needs them.
+
+    :param slippy_coordinates: iterable of (column, row, zoom) tuples
+    :return: list of (column, row, zoom) keys of the missing grids' top left tiles, in the order they're first needed
+    """
+    checked_grids = set()
+    missing_grids = []
+    for column, row, zoom in slippy_coordinates:
+        for border_column in range(column - 1, column + 2):
+            for border_row in range(row - 1, row + 2):
+                grid_key = get_grid_base_coords((border_column, border_row), grid_size=grid_size) + (zoom,)
+                if grid_key in checked_grids:
+                    continue
+                checked_grids.add(grid_key)
+                if imagery_store == 'mosaic':
+                    exists = os.path.isfile(ImageGrid(None, grid_key[:2]).generate_filename(zoom=zoom))
+                else:
+                    exists = tile_storage.exists((border_column, border_row), zoom=zoom)
+                if not exists:
+                    missing_grids.append(grid_key)
+    return missing_grids
+
+
+class ImageryPrefetcher(object):
+    """Fetches the query grids upcoming tiles will need on a pool of threads, so inference doesn't wait on them."""
+
+    def __init__(self, workers=4):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = set()
+        self.fetched = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def prefetch(self, slippy_coordinates):
+        """
+        Queues up fetches for every missing grid the given tiles need that isn't already being fetched, returns without
+        waiting for them.
+
+        :param slippy_coordinates: iterable of (column, row, zoom) tuples, in the order they'll be needed
+        :return: number of grid fetches queued
+        """
+        queued = 0
+        for grid_key in get_missing_grids(slippy_coordinates):
+            with self._lock:
+                if grid_key in self.in_flight:
+                    continue
+                self.in_flight.add(grid_key)
+            self.executor.submit(self.fetch_grid, grid_key)
+            queued += 1
+        return queued
+
+    def fetch_grid(self, grid_key):
+        fetched = False
+        try:
+            gather_and_persist_imagery_at_coordinate(grid_key[:2], final_zoom=grid_key[2])
+            fetched = True
+        except Exception as e:
+            # whoever needs this grid will try (and fail loudly) again itself
+            print("Couldn't prefetch imagery grid {grid}: {error}".format(grid=grid_key, error=e))
+        with self._lock:
+            self.in_flight.discard(grid_key)
+            if fetched:
+                self.fetched += 1
+            else:
+                self.failed += 1
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __repr__(self):
+        return '<ImageryPrefetcher {fetched} fetched, {failed} failed, {in_flight} in flight>'.format(
+            fetched=self.fetched, failed=self.failed, in_flight=len(self.in_flight))
+
+
+def migrate_tile_files_to_shards(source=None, destination=None, delete=False, batch_size=1000):
+    """
+    Copies every tile jpeg from the file per tile layout into sharded storage (without re-encoding them).
+
+    :param source: FileTileStorage to migrate from, defaults to the one in data/imagery
+    :param destination: ShardedTileStorage to migrate to, defaults to the one in data/imagery/shards
+    :param delete: delete each jpeg once it's been migrated
+    :param batch_size: number of tiles to commit to the shard index at a time
+    :return: number of tiles migrated
+    """
+    source = source or FileTileStorage()
+    destination = destination or ShardedTileStorage()
+    start_time = time.time()
+    migrated = 0
+    batch = []
+    for zoom_name in sorted(os.listdir(source.directory)):
+        if not zoom_name.isdigit():
+            continue  # e.g. the shards themselves
+        for row_name in sorted(os.listdir(os.path.join(source.directory, zoom_name))):
+            if not row_name.isdigit():
+                continue  # e.g. mosaic grids
+            for filename in os.listdir(os.path.join(source.directory, zoom_name, row_name)):
+                if not filename.endswith('.jpg'):
+                    continue  # e.g. a tile that's still being written
+                coords = (int(get_basename(filename)), int(row_name))
+                batch.append((coords, int(zoom_name)))
+                if len(batch) >= batch_size:
+                    migrated += migrate_tile_batch(source, destination, batch, delete)
+                    batch = []
+                    print("Migrated {0} tiles, {1:.0f} tiles/s".format(migrated, migrated / (time.time() - start_time)),
+                          end='\r')
+    migrated += migrate_tile_batch(source, destination, batch, delete)
+    print("Migrated {0} tiles into {1} in {2:.0f} seconds".format(migrated, destination.directory,
+                                                                  time.time() - start_time))
+    return migrated
+
+
+def migrate_tile_batch(source, destination, batch, delete):
+    destination.put_many((coords, zoom, source.read_bytes(coords, zoom)) for coords, zoom in batch)
+    if delete:
+        source.delete_many([coords + (zoom,) for coords, zoom in batch])
+    return len(batch)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the imagery stored on disk')
+    parser.add_argument('--migrate_to_shards', dest='migrate', action='store_const', const=True, default=False,
+                        help='Copy every tile jpeg in data/imagery into sharded storage in data/imagery/shards')
+    parser.add_argument('--delete_migrated', dest='delete', action='store_const', const=True, default=False,
+                        help='Delete each tile jpeg once it has been migrated')
+    parser.add_argument('--compact_shards', dest='compact', action='store_const', const=True, default=False,
+                        help='Reclaim the space taken up by deleted tiles in sharded storage')
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_tile_files_to_shards(delete=args.delete)
+    if args.compact:
+        print("Reclaimed {0:.1f}MB".format(ShardedTileStorage().compact() / 1024 / 1024))
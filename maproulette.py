@@ -1,101 +1,176 @@
-import functools
+import argparse
+import json
 import os
-from collections import defaultdict
+import time
 
-from rtree import index
-from shapely import geometry
-from shapely.ops import cascaded_union
+import numpy as np
 
+import clustering
+import metrics
 import solardb
-from process_city_shapes import num2deg
-
-GEOJSON_STRING = \
-    '{{"type": "FeatureCollection", "features": [{{"type": "Feature", "properties": {{"prediction_confidence": ' \
-    '{confidence}}}, "geometry": {{"type": "Polygon", "coordinates": [{points}]}}}}]}}\n'
+from process_city_shapes import num2deg_array
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# offsets of the corners of a tile's outline, clockwise from the top left and back to it
+TILE_OUTLINE_OFFSETS = np.array([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+
+
+def encode_json(value):
+    """:return: value encoded as compact json, by orjson if it's installed as it's several times faster than json"""
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'))
+
+
+def write_maproulette_features(the_file, polygon_dicts):
+    """
+    Writes each polygon as soon as it's handed over, as line by line geojson (a FeatureCollection of one Feature on
+    each line) which is what maproulette imports. Only the encoding and writing is observed under maproulette_write,
+    not making the polygons, as the generators that make them time their own stages.
+
+    :param the_file: file open for writing text
+    :param polygon_dicts: iterable of dicts with a geojson "geometry" and a "confidence"
+    """
+    write_seconds = 0.0
+    for polygon_dict in polygon_dicts:
+        start_time = time.perf_counter()
+        the_file.write(encode_json({"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "properties": {"prediction_confidence": polygon_dict["confidence"]},
+            "geometry": polygon_dict["geometry"]
+        }]}) + "\n")
+        write_seconds += time.perf_counter() - start_time
+        metrics.increment('maproulette_tasks')
+    metrics.observe('maproulette_write', write_seconds)
 
 
 def create_simple_maproulette_geojson(threshold=0.25, polygon_name=None):
-    tiles = solardb.query_tiles_over_threshold(threshold=threshold, polygon_name=polygon_name)
     with open(os.path.join("data", (polygon_name or "") + "maproulette.geojson"), "w") as the_file:
-        for tile in tiles:
-            bounding_polygon_slippy_coordinates = [
-                (tile.column, tile.row),
-                (tile.column + 1, tile.row),
-                (tile.column + 1, tile.row + 1),
-                (tile.column, tile.row + 1),
-                (tile.column, tile.row)
-            ]
-            bounding_polygon_lon_lat_coordinates = \
-                map(functools.partial(num2deg, center=False), bounding_polygon_slippy_coordinates)
-
-            points = str([list(coordinates) for coordinates in bounding_polygon_lon_lat_coordinates])
-            confidence = tile.panel_softmax
-            the_file.write(GEOJSON_STRING.format(points=points, confidence=confidence))
-
-
-def get_clustered_positive_polygon_dicts(threshold=0.25, polygon_name=None):
-    tiles = solardb.query_tiles_over_threshold(threshold=threshold, polygon_name=polygon_name)
-    cluster_to_tile_map = defaultdict(list)
-    for tile in tiles:
-        cluster_to_tile_map[tile.cluster_id].append(tile)
+        for tiles in solardb.iter_tiles_over_threshold(threshold=threshold, polygon_name=polygon_name,
+                                                       order_by_softmax=True):
+            metrics.increment('maproulette_tiles', len(tiles))
+            outlines = get_tile_outlines_lon_lat(np.column_stack((tiles['column'], tiles['row'])))
+            write_maproulette_features(the_file, ({"geometry": {"type": "Polygon", "coordinates": [outline.tolist()]},
+                                                   "confidence": confidence}
+                                                  for outline, confidence in zip(outlines,
+                                                                                 tiles['panel_softmax'].tolist())))
+
+
+def get_tile_outlines_lon_lat(column_rows):
+    """
+    :param column_rows: sequence of (column, row) tile coordinates
+    :return: ndarray of shape (x, 5, 2) containing the lon lat outline of each tile, top left corner first and last
+    """
+    column_rows = np.asarray(column_rows, dtype=np.int64).reshape((-1, 1, 2))
+    return num2deg_array(column_rows + TILE_OUTLINE_OFFSETS, center=False)
+
+
+def get_clustered_positive_polygon_dicts(threshold=0.25, polygon_name=None, exclude_cluster_ids=()):
+    """
+    Outlines each cluster of positive tiles, most confident cluster first. The outlines are traced from the tiles'
+    grid coordinates (see clustering.trace_rings) so clusters with holes in them, or made up of separate parts, come
+    out as they are rather than as just the outside of their first part. The tiles are streamed a cluster after
+    another and outlined a batch of whole clusters at a time, so memory stays bounded however many positive tiles
+    there are.
+
+    :param threshold: minimum panel softmax
+    :param polygon_name: optional name to filter for
+    :param exclude_cluster_ids: ids of clusters to leave out (-1 for the unclustered tiles)
+    :return: yields dicts with the cluster's geojson "geometry" (a Polygon, or a MultiPolygon if the cluster has
+    separate parts) and its highest "confidence"
+    """
+    for tiles in iter_cluster_batches(threshold=threshold, polygon_name=polygon_name):
+        metrics.increment('maproulette_tiles', len(tiles))
+        if len(exclude_cluster_ids):
+            tiles = tiles[~np.isin(tiles['cluster_id'], list(exclude_cluster_ids))]
+        if len(tiles):
+            yield from get_cluster_polygon_dicts(tiles)
+
+
+def iter_cluster_batches(threshold=0.25, polygon_name=None):
+    """
+    Regroups the chunks of tiles streamed by cluster into batches of whole clusters, holding back the last cluster of
+    each chunk as it might carry on into the next one.
+
+    :return: yields structured ndarrays of solardb.TILE_ROW_DTYPE, most confident cluster first
+    """
+    chunks = solardb.iter_tiles_over_threshold(threshold=threshold, polygon_name=polygon_name, order_by_cluster=True)
+    # the parts of the last cluster seen so far, only joined up once it's finished so a cluster spanning many chunks
+    # isn't copied again for every one of them
+    carried_over = []
+    while True:
+        with metrics.timer('maproulette_query'):
+            tiles = next(chunks, None)
+        if tiles is None:
+            break
+        # the last cluster starts right after the last tile from another cluster
+        last_cluster_start = np.flatnonzero(tiles['cluster_id'] != tiles['cluster_id'][-1])
+        last_cluster_start = last_cluster_start[-1] + 1 if len(last_cluster_start) else 0
+        if last_cluster_start:
+            yield np.concatenate(carried_over + [tiles[:last_cluster_start]])
+            carried_over = []
+        carried_over.append(tiles[last_cluster_start:])
+    if carried_over:
+        yield np.concatenate(carried_over)
+
+
+def get_cluster_polygon_dicts(tiles):
+    """
+    Outlines a batch of whole clusters, see get_clustered_positive_polygon_dicts.
+
+    :param tiles: structured ndarray of solardb.TILE_ROW_DTYPE of every tile in the clusters
+    :return: list of polygon dicts, most confident cluster first
+    """
+    coordinates = np.column_stack((tiles['column'], tiles['row']))
+    # unclustered tiles all have a cluster id of -1, and are outlined together as one (multi) polygon like before
+    _, labels = np.unique(tiles['cluster_id'], return_inverse=True)
+    confidences = np.zeros(labels.max() + 1)
+    np.maximum.at(confidences, labels, tiles['panel_softmax'])
+    with metrics.timer('maproulette_trace'):
+        rings, ring_labels, ring_components, areas = clustering.trace_rings(coordinates, labels)
+        label_polygons = clustering.group_rings(ring_labels, ring_components, areas)
+    lon_lat_rings = get_rings_lon_lat(rings)
     polygon_dicts = []
-    for cluster_id, tiles in cluster_to_tile_map.items():
-        bounding_polygons_slippy_coordinates = []
-        for tile in tiles:
-            bounding_polygon_slippy_coordinates = [
-                (tile.column, tile.row),
-                (tile.column + 1, tile.row),
-                (tile.column + 1, tile.row + 1),
-                (tile.column, tile.row + 1),
-                (tile.column, tile.row)
-            ]
-            bounding_polygons_slippy_coordinates.append(
-                geometry.Polygon([[p[0], p[1]] for p in bounding_polygon_slippy_coordinates]))
-        unioned_slippy_coordinate_polygon = cascaded_union(bounding_polygons_slippy_coordinates)
-        slippy_coordinate_bounding_polygon_coordinates = \
-            zip(*unioned_slippy_coordinate_polygon.exterior.xy)
-        bounding_polygon_lon_lat_coordinates = \
-            list(map(functools.partial(num2deg, center=False), slippy_coordinate_bounding_polygon_coordinates))
-        string_points = str([list(coordinates) for coordinates in bounding_polygon_lon_lat_coordinates])
-        confidence = max(tile.panel_softmax for tile in tiles)
-        polygon_dicts.append({
-            "bounding_polygon_lon_lat_coordinates": bounding_polygon_lon_lat_coordinates,
-            "string_points": string_points,
-            "confidence": confidence
-        })
+    for label in np.argsort(-confidences, kind='stable').tolist():
+        # geojson wants exteriors anticlockwise and holes clockwise, the other way round to how they're traced
+        polygons = [[lon_lat_rings[index][::-1].tolist() for index in polygon] for polygon in label_polygons[label]]
+        if len(polygons) == 1:
+            cluster_geometry = {"type": "Polygon", "coordinates": polygons[0]}
+        else:
+            cluster_geometry = {"type": "MultiPolygon", "coordinates": polygons}
+        polygon_dicts.append({"geometry": cluster_geometry, "confidence": confidences[label].item()})
     return polygon_dicts
 
 
-def filter_polygon_dicts_based_off_osm_panels(polygon_dicts):
-    panel_nodes = solardb.get_osm_pv_nodes()
-    polygon_dict_map = {}
-    for i, polygon_dict in enumerate(polygon_dicts):
-        polygon_dict_map[i] = polygon_dict
-    polygon_enumeration = []
-    for i, polygon_dict in polygon_dict_map.items():
-        polygon_enumeration.append((i, geometry.Polygon(polygon_dict["bounding_polygon_lon_lat_coordinates"])))
-    spatial_index = index.Index(polygon_rtree_generator(polygon_enumeration))
-    for node_lon_lat_tuple in panel_nodes:
-        for intersecting_item in spatial_index.intersection(node_lon_lat_tuple + node_lon_lat_tuple, objects=True):
-            if intersecting_item.object.contains(geometry.Point(node_lon_lat_tuple)):
-                spatial_index.delete(intersecting_item.id, intersecting_item.bounds)
-                polygon_dict_map.pop(intersecting_item.id, None)
-    return polygon_dict_map.values()
-
+def get_rings_lon_lat(rings):
+    """
+    Converts many rings from slippy coordinates into lon lats in one go, as converting them a ring at a time would
+    spend most of its time on numpy's per call overhead.
 
-def polygon_rtree_generator(polygon_enumeration):
-    for i, polygon in polygon_enumeration:
-        yield (i, polygon.bounds, polygon)
+    :param rings: list of ndarrays of shape (x, 2) in slippy tile coordinates
+    :return: list of ndarrays of shape (x, 2) containing the lon lats of each ring
+    """
+    if not rings:
+        return []
+    ends = np.cumsum([len(ring) for ring in rings])[:-1]
+    return np.split(num2deg_array(np.vstack(rings), center=False), ends)
 
 
 def create_clustered_maproulette_geojson(threshold=0.25, polygon_name=None, filter_existing_osm_panels=True):
-    polygon_dicts = get_clustered_positive_polygon_dicts(threshold=threshold, polygon_name=polygon_name)
+    exclude_cluster_ids = set()
     if filter_existing_osm_panels:
-        polygon_dicts = filter_polygon_dicts_based_off_osm_panels(polygon_dicts)
+        with metrics.timer('maproulette_osm_filter'):
+            exclude_cluster_ids = solardb.query_cluster_ids_containing_osm_nodes(threshold=threshold,
+                                                                                polygon_name=polygon_name)
+        metrics.increment('maproulette_clusters_with_osm_panels', len(exclude_cluster_ids))
+    polygon_dicts = get_clustered_positive_polygon_dicts(threshold=threshold, polygon_name=polygon_name,
+                                                         exclude_cluster_ids=exclude_cluster_ids)
     with open(os.path.join("data", get_maproulette_geojson_filename(polygon_name)), "w") as the_file:
-        for polygon_dict in polygon_dicts:
-            the_file.write(GEOJSON_STRING.format(points=polygon_dict["string_points"],
-                                                 confidence=polygon_dict["confidence"]))
+        write_maproulette_features(the_file, polygon_dicts)
 
 
 def get_maproulette_geojson_filename(polygon_name):
@@ -105,4 +180,14 @@ def get_maproulette_geojson_filename(polygon_name):
 
 
 if __name__ == "__main__":
-    create_clustered_maproulette_geojson()
+    parser = argparse.ArgumentParser(description='Creates a maproulette geojson of the clusters of positive tiles')
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help='Append a json line of every counter and latency histogram to this file')
+    args = parser.parse_args()
+
+    metrics.configure_metrics(filename=args.metrics_file)
+    try:
+        create_clustered_maproulette_geojson()
+    finally:
+        metrics.close_metrics()
+    print("Time spent in each stage:\n" + metrics.format_summary())
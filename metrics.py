@@ -0,0 +1,208 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds (in seconds) of the latency histogram buckets, doubling from 10us to ~170s
+LATENCY_BUCKETS = tuple(0.00001 * 2 ** power for power in range(25))
+DEFAULT_METRICS_INTERVAL = 30
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets, so percentiles can be estimated without keeping every observation."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # the last bucket is everything over the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """:return: upper bound of the bucket the given fraction of observations fall under (the max if it's lower)"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95), 'p99': self.percentile(0.99)}
+
+
+class MetricsRegistry(object):
+    """Thread safe collection of named counters and latency histograms."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Observes how long the body of the with statement takes, under name."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {'timestamp': time.time(), 'uptime': time.time() - self.started, 'counters': dict(self.counters),
+                    'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()}}
+
+    def format_prometheus(self, prefix='solar_'):
+        """:return: every metric in the prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE {0}{1}_total counter'.format(prefix, name))
+                lines.append('{0}{1}_total {2}'.format(prefix, name, value))
+            for name, histogram in sorted(self.histograms.items()):
+                metric = prefix + name + '_seconds'
+                lines.append('# TYPE {0} histogram'.format(metric))
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('{0}_bucket{{le="{1:g}"}} {2}'.format(metric, bound, cumulative))
+                lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(metric, histogram.count))
+                lines.append('{0}_sum {1}'.format(metric, histogram.sum))
+                lines.append('{0}_count {1}'.format(metric, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def format_summary(self):
+        """:return: a table of every stage's latency (slowest total first) followed by every counter"""
+        snapshot = self.snapshot()
+        lines = ["{0:<28} {1:>10} {2:>10} {3:>6} {4:>10} {5:>10} {6:>10}".format(
+            'stage', 'count', 'total s', '% run', 'mean ms', 'p95 ms', 'max ms')]
+        histograms = sorted(snapshot['histograms'].items(), key=lambda item: item[1]['sum'], reverse=True)
+        for name, histogram in histograms:
+            lines.append("{0:<28} {1:>10} {2:>10.1f} {3:>6.0%} {4:>10.2f} {5:>10.2f} {6:>10.2f}".format(
+                name, histogram['count'], histogram['sum'],
+                histogram['sum'] / snapshot['uptime'] if snapshot['uptime'] else 0,
+                histogram['sum'] / histogram['count'] * 1000, histogram['p95'] * 1000, histogram['max'] * 1000))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append("{0:<28} {1:>10}".format(name, value))
+        return '\n'.join(lines)
+
+
+class JsonLinesWriter(object):
+    """Appends a snapshot of the metrics to a file every interval seconds (and once more when closed)."""
+
+    def __init__(self, registry, filename, interval=DEFAULT_METRICS_INTERVAL):
+        self.registry = registry
+        self.filename = filename
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def write(self):
+        with open(self.filename, 'a') as outfile:
+            outfile.write(json.dumps(self.registry.snapshot()) + '\n')
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+
+class PrometheusServer(object):
+    """Serves the metrics in the prometheus text format on every path of http://<host>:<port>/ from a daemon thread."""
+
+    def __init__(self, registry, port, host=''):
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.format_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # don't print every scrape
+
+        self.server = HTTPServer((host, port), MetricsHandler)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# collects metrics from every module of the pipeline, whether or not they're being written anywhere
+registry = MetricsRegistry()
+outputs = []
+
+
+def configure_metrics(filename=None, interval=DEFAULT_METRICS_INTERVAL, port=None):
+    """
+    :param filename: append a json snapshot of the metrics to this file every interval seconds, None to not write them
+    :param interval: seconds between snapshots written to filename
+    :param port: serve the metrics for prometheus to scrape on this port, None to not serve them
+    """
+    close_metrics()
+    if filename:
+        outputs.append(JsonLinesWriter(registry, filename, interval=interval))
+    if port:
+        outputs.append(PrometheusServer(registry, port))
+
+
+def close_metrics():
+    """Stops the outputs set up by configure_metrics, writing one last snapshot to the json lines file."""
+    while outputs:
+        outputs.pop().close()
+
+
+def increment(name, value=1):
+    registry.increment(name, value)
+
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+
+def timer(name):
+    return registry.timer(name)
+
+
+def format_summary():
+    return registry.format_summary()
@@ -0,0 +1,171 @@
+import concurrent.futures
+import json
+import math
+import os
+import threading
+import time
+
+import requests
+
+import metrics
+import solardb
+from http_retries import request_with_retries, write_json_atomically
+from rate_limiter import RateLimiter
+
+DEFAULT_OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+# overpass-api.de gives each client a couple of query slots, more workers than that just queue up
+DEFAULT_OVERPASS_WORKERS = 2
+DEFAULT_OVERPASS_RATE = 1.0
+DEFAULT_CACHE_DIRECTORY = os.path.join('data', 'overpass_cache')
+# tiles older than this are queried again, so panels mapped since the last run get filtered out of new tasks
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+# side of the lon lat grid the search areas are split along, small enough that a dense city's tile answers quickly
+DEFAULT_TILE_DEGREES = 0.25
+
+SOLAR_QUERY = \
+    """
+    [out:json][timeout:300];
+    (
+    node["generator:source"="solar"]({south},{west},{north},{east});
+    way["generator:source"="solar"]({south},{west},{north},{east});
+    relation["generator:source"="solar"]({south},{west},{north},{east});
+    );
+    out body;
+    >;
+    out skel qt;
+    """
+
+# where overpass is queried, how fast and where its responses are cached, see configure_overpass
+overpass_url = DEFAULT_OVERPASS_URL
+rate_limiter = RateLimiter(DEFAULT_OVERPASS_RATE)
+cache_directory = DEFAULT_CACHE_DIRECTORY
+cache_ttl = DEFAULT_CACHE_TTL
+thread_local = threading.local()
+
+
+def configure_overpass(url=DEFAULT_OVERPASS_URL, rate=DEFAULT_OVERPASS_RATE, cache=DEFAULT_CACHE_DIRECTORY,
+                       ttl=DEFAULT_CACHE_TTL):
+    """
+    :param url: interpreter endpoint to query, e.g. a local overpass (or a stub of one) instead of the public one
+    :param rate: maximum number of queries per second across all threads, None for no limit
+    :param cache: directory to cache each tile's nodes in, None to not cache them
+    :param ttl: seconds a cached tile stays fresh for
+    """
+    global overpass_url, rate_limiter, cache_directory, cache_ttl
+    overpass_url = url
+    rate_limiter = RateLimiter(rate)
+    cache_directory = cache
+    cache_ttl = ttl
+
+
+def get_http_session():
+    if getattr(thread_local, 'session', None) is None:
+        thread_local.session = requests.Session()
+    return thread_local.session
+
+
+def get_bbox_tiles(polygons, tile_degrees=DEFAULT_TILE_DEGREES):
+    """
+    :param polygons: shapely polygons in lon lat
+    :param tile_degrees: side of the grid's tiles in degrees
+    :return: sorted list of the (x, y) grid indexes of every tile that intersects one of the polygons, tile (x, y)
+    spans longitudes x * tile_degrees to (x + 1) * tile_degrees and likewise latitudes
+    """
+    from shapely.geometry import box
+    from shapely.prepared import prep
+
+    tiles = set()
+    for polygon in polygons:
+        prepared_polygon = prep(polygon)
+        west, south, east, north = polygon.bounds
+        for x in range(int(math.floor(west / tile_degrees)), int(math.floor(east / tile_degrees)) + 1):
+            for y in range(int(math.floor(south / tile_degrees)), int(math.floor(north / tile_degrees)) + 1):
+                if (x, y) not in tiles and prepared_polygon.intersects(box(*get_tile_bounds((x, y), tile_degrees))):
+                    tiles.add((x, y))
+    return sorted(tiles)
+
+
+def get_tile_bounds(tile, tile_degrees=DEFAULT_TILE_DEGREES):
+    """:return: (west, south, east, north) of the grid tile"""
+    return (tile[0] * tile_degrees, tile[1] * tile_degrees, (tile[0] + 1) * tile_degrees, (tile[1] + 1) * tile_degrees)
+
+
+def get_cache_filename(tile, tile_degrees=DEFAULT_TILE_DEGREES):
+    return os.path.join(cache_directory, '{degrees:g}_{x}_{y}.json'.format(degrees=tile_degrees, x=tile[0], y=tile[1]))
+
+
+def load_cached_tile(tile, tile_degrees=DEFAULT_TILE_DEGREES):
+    """:return: the tile's cached list of [lon, lat] nodes, or None if it isn't cached or has gone stale"""
+    if not cache_directory:
+        return None
+    cache_filename = get_cache_filename(tile, tile_degrees)
+    if not os.path.isfile(cache_filename):
+        return None
+    with open(cache_filename, 'r') as infile:
+        cached = json.load(infile)
+    if time.time() - cached['fetched'] > cache_ttl:
+        return None
+    return cached['nodes']
+
+
+def query_overpass_tile(tile, tile_degrees=DEFAULT_TILE_DEGREES):
+    """
+    Queries overpass for the solar generators in a grid tile (and the nodes of the ways and relations among them),
+    retrying with jittered exponential backoff when overpass is busy or unreachable, and caches the nodes.
+
+    :return: list of [lon, lat] of every node
+    """
+    west, south, east, north = get_tile_bounds(tile, tile_degrees)
+    query = SOLAR_QUERY.format(south=south, west=west, north=north, east=east)
+    response = request_with_retries(get_http_session(), 'POST', overpass_url, 'overpass', rate_limiter,
+                                    data={'data': query}, timeout=330)
+    nodes = [[element['lon'], element['lat']] for element in response.json()['elements'] if element['type'] == 'node']
+    if cache_directory:
+        os.makedirs(cache_directory, exist_ok=True)
+        write_json_atomically(get_cache_filename(tile, tile_degrees), {'fetched': time.time(), 'nodes': nodes})
+    return nodes
+
+
+def get_tile_nodes(tile, tile_degrees=DEFAULT_TILE_DEGREES):
+    nodes = load_cached_tile(tile, tile_degrees)
+    if nodes is not None:
+        metrics.increment('overpass_cache_hits')
+        return nodes
+    return query_overpass_tile(tile, tile_degrees)
+
+
+def query_osm_solar(polygons, decimal_places_to_round=5, tile_degrees=DEFAULT_TILE_DEGREES,
+                    workers=DEFAULT_OVERPASS_WORKERS):
+    """
+    Finds the solar panels already mapped in OpenStreetMap inside search polygons. The polygons are split into tiles
+    on a fixed lon lat grid which are queried with bbox queries (which overpass answers a lot faster than poly
+    queries), workers at a time, and each tile's nodes are cached so later runs only query the tiles that have gone
+    stale. The nodes are then clipped to the polygons here.
+
+    :param polygons: shapely polygons in lon lat to find the solar panels in
+    :param decimal_places_to_round: decimal places to round each node's lon lat to
+    :param tile_degrees: side of the grid tiles queried at a time in degrees
+    :param workers: number of tiles to query at once
+    :return: set of (lon, lat) of every solar node inside (or on the boundary of) one of the polygons
+    """
+    from shapely.geometry import Point
+    from shapely.prepared import prep
+
+    tiles = get_bbox_tiles(polygons, tile_degrees)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        tile_nodes = list(executor.map(lambda tile: get_tile_nodes(tile, tile_degrees), tiles))
+    prepared_polygons = [prep(polygon) for polygon in polygons]
+    solar_node_lon_lats = set()
+    for nodes in tile_nodes:
+        for lon, lat in nodes:
+            point = Point(lon, lat)
+            if any(polygon.intersects(point) for polygon in prepared_polygons):
+                solar_node_lon_lats.add((round(lon, decimal_places_to_round), round(lat, decimal_places_to_round)))
+    return solar_node_lon_lats
+
+
+def query_and_persist_osm_solar(polygons, tile_degrees=DEFAULT_TILE_DEGREES, workers=DEFAULT_OVERPASS_WORKERS):
+    solar_node_lon_lats = query_osm_solar(polygons, tile_degrees=tile_degrees, workers=workers)
+    solardb.persist_osm_solar_nodes(solar_node_lon_lats)
+    metrics.increment('osm_solar_nodes', len(solar_node_lon_lats))
+    print("Found {count} solar nodes in OSM".format(count=len(solar_node_lon_lats)))
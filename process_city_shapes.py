@@ -1,18 +1,20 @@
 import argparse
+import collections
+import itertools
 import json
 import math
+import multiprocessing
 import os
 import sys
 import time
+import rasterize
 import solardb
 
 import geojson
-import geojsonio as geojsonio
-import geopandas
 import numpy as np
-from shapely.geometry import shape, mapping, GeometryCollection, Point
 
-from gather_city_shapes import get_city_state_filepaths, get_city_state_tuples
+# shapely, geopandas, geojsonio and gather_city_shapes are imported where they're used, so modules that only need
+# deg2num/num2deg (and short runs of this script) don't pay for importing them
 
 
 def deg2num(arr, zoom=21):
@@ -28,7 +30,7 @@ def deg2num(arr, zoom=21):
     """
     lon_deg = arr[0]
     lat_deg = arr[1]
-    lat_rad = np.math.radians(lat_deg)
+    lat_rad = math.radians(lat_deg)
     n = 2.0 ** zoom
     column = int((lon_deg + 180.0) / 360.0 * n)
     row = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
@@ -59,6 +61,43 @@ def num2deg(arr, zoom=21, center=True):
     return lon_deg, lat_deg
 
 
+def deg2num_array(lon_lats, zoom=21):
+    """
+    Convert an array of longitudes and latitudes into slippy tile coordinates, all at once. Gives the same results as
+    calling deg2num on each pair.
+
+    :param lon_lats: array like of shape (..., 2) containing longitude latitude pairs
+    :param zoom: zoom parameter necessary for calculating slippy tile coordinates, defaults to 21
+    :return: int64 ndarray of the same shape containing column row pairs
+    """
+    lon_lats = np.asarray(lon_lats, dtype=np.float64)
+    lat_rad = np.radians(lon_lats[..., 1])
+    n = 2.0 ** zoom
+    columns = (lon_lats[..., 0] + 180.0) / 360.0 * n
+    rows = (1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2.0 * n
+    # truncate towards zero like int() does
+    return np.trunc(np.stack((columns, rows), axis=-1)).astype(np.int64)
+
+
+def num2deg_array(column_rows, zoom=21, center=True):
+    """
+    Convert an array of slippy tile columns and rows into longitude latitude coordinates, all at once. Gives the same
+    results as calling num2deg on each pair.
+
+    :param column_rows: array like of shape (..., 2) containing column row pairs
+    :param zoom: zoom parameter necessary for calculating longitude latitude coordinates, defaults to 21
+    :param center: whether the lon_lat should be at the middle of the tile or the top left, defaults to center
+    :return: float64 ndarray of the same shape containing longitude latitude pairs
+    """
+    column_rows = np.asarray(column_rows, dtype=np.float64)
+    if center:
+        column_rows = column_rows + 0.5
+    n = 2.0 ** zoom
+    lon_deg = column_rows[..., 0] / n * 360.0 - 180.0
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * column_rows[..., 1] / n))))
+    return np.stack((lon_deg, lat_deg), axis=-1)
+
+
 def get_polygons(csvpath, exclude=None):
     """
     Loads polygons for cities listed in csvpath, polygons must have already been calculated and placed into
@@ -68,6 +107,8 @@ def get_polygons(csvpath, exclude=None):
     :param exclude: list of name strings to exclude from the load (name string is "<city>, <state>"), default None
     :return: yields the json of the polygon file
     """
+    from gather_city_shapes import get_city_state_filepaths
+
     if exclude is None:
         exclude = []
     for city, state, filepath in get_city_state_filepaths(csvpath):
@@ -86,6 +127,8 @@ def combine_all_polygons(csvpath, exclude=None):
     :param exclude: list of name strings to exclude from the load (name string is "<city>, <state>"), default None
     :return: GeometryCollection containing all simplified polygons loaded from files
     """
+    from shapely.geometry import GeometryCollection
+
     return GeometryCollection([simplify_polygon(polygon) for polygon in get_polygons(
         csvpath, exclude=exclude)])
 
@@ -101,6 +144,8 @@ def simplify_polygon(polygon, simplify_tolerance=0.001, buffer_distance=0.004):
     :param buffer_distance: distance to "dilate" the polygon, the default parameter grows it somewhat
     :return: simplified shapely polygon
     """
+    from shapely.geometry import shape
+
     return shape(polygon).convex_hull.simplify(simplify_tolerance).buffer(buffer_distance)
 
 
@@ -112,13 +157,13 @@ def convert_to_slippy_tile_coords(polygons, zoom=21):
     :param zoom: zoom level used in conversion, defaults to 21
     :return: converted polygons
     """
-    converted_polygons = []
-    for polygon in polygons:
-        geojson_object = mapping(polygon)
-        geojson_object['coordinates'] = np.apply_along_axis(deg2num, 2, np.array(geojson_object['coordinates']),
-                                                            zoom=zoom)
-        converted_polygons.append(shape(geojson_object))
-    return converted_polygons
+    from shapely.ops import transform
+
+    def convert_ring(lons, lats):
+        return tuple(deg2num_array(np.column_stack((lons, lats)), zoom=zoom).T)
+
+    # transform hands over the coordinates of a whole ring at a time
+    return [transform(convert_ring, polygon) for polygon in polygons]
 
 
 def save_geojson(filename, feature):
@@ -140,6 +185,8 @@ def point_mapper(x, polygon=None):
     :param polygon: polygon to check if point is contained in
     :return: whether or not the polygon contains the point
     """
+    from shapely.geometry import Point
+
     return not polygon.contains(Point((x[0], x[1])))
 
 
@@ -147,10 +194,25 @@ def get_coords_inside_polygon(polygon):
     """
     Calculate all grid coordinate inside a given polygon.
 
+    This rasterizes the polygon a scan line at a time (see rasterize.py), which gives the same result as
+    get_coords_inside_polygon_shapely but doesn't have to run a shapely contains for every point in the bounding box.
+
+    :param polygon: polygon to calculate coordinates inside of
+    :return: ndarray containing coordinate pairs (shape (x,2))
+    """
+    return rasterize.get_coords_inside_polygon(polygon)
+
+
+def get_coords_inside_polygon_shapely(polygon):
+    """
+    Calculate all grid coordinate inside a given polygon by checking every point in its bounding box with shapely.
+
     This method takes a while, possibly need to multiprocess (1 cpu is maxed out on my machine) or switch to matplotlib
     for possibly more efficient code:
     https://stackoverflow.com/questions/21339448/how-to-get-list-of-points-inside-a-polygon-in-python
 
+    It's kept around as the reference implementation for get_coords_inside_polygon, see verify_inner_coordinates.
+
     :param polygon: polygon to calculate coordinates inside of
     :return: ndarray containing coordinate pairs (shape (x,2))
     """
@@ -160,6 +222,9 @@ def get_coords_inside_polygon(polygon):
     # convert the meshgrid to an array of points
     x, y = x.flatten(), y.flatten()
     points = np.vstack((x, y)).T
+    if not len(points):
+        # the polygon's narrower than a tile, apply_along_axis can't take an empty array
+        return points
 
     # calculate if the polygon contains every point
     mask = np.apply_along_axis(point_mapper, 1, points, polygon=polygon)
@@ -171,37 +236,26 @@ def get_coords_inside_polygon(polygon):
     return np.ma.masked_array(points, mask=mask).compressed().reshape((-1, 2))
 
 
-def get_coords_caller(name, polygon):
-    """
-    Calls the get inner coordinate method and times the execution
-
-    :param name: name of polygon
-    :param polygon: polygon to calculate inner coordinates of
-    :return: ndarray containing coordinate pairs (shape (x,2))
-    """
-    start_time = time.time()
-    coordinates = get_coords_inside_polygon(polygon)
-    print(str(time.time() - start_time) + " seconds to complete inner grid calculations for " + name)
-    return coordinates
-
-
-def calculate_inner_coordinates_from_csvpath(csvpath, zoom=21):
+def calculate_inner_coordinates_from_csvpath(csvpath, zoom=21, workers=1):
     """
     Calculates and persists inner coordinates of all polygons in csvpath, this is the public api
 
     :param csvpath: path containing the csv file for all polygons to calculate inner coordinates for
     :param zoom: zoom level at which to calculate inner coordinates, defaults to 21
+    :param workers: number of processes to calculate inner coordinates with, defaults to 1
     """
+    from gather_city_shapes import get_city_state_tuples
+
     start = time.time()
 
     polygons = list(combine_all_polygons(csvpath, exclude=solardb.get_inner_coords_calculated_polygon_names()))
     city_state_tuples = list(get_city_state_tuples(csvpath))
     polygon_names = [', '.join(city_state_tuple) for city_state_tuple in city_state_tuples]
-    calculate_inner_coordinates(polygon_names, polygons, zoom)
+    calculate_inner_coordinates(polygon_names, polygons, zoom, workers=workers)
     print("Total running time to calculate inner coordinates: " + str(time.time() - start) + " seconds.")
 
 
-def calculate_inner_coordinates(polygon_names, polygons, zoom=21):
+def calculate_inner_coordinates(polygon_names, polygons, zoom=21, workers=1):
     slippy_tile_coordinate_polygons = list(convert_to_slippy_tile_coords(polygons, zoom=zoom))
     assert (len(polygon_names) == len(slippy_tile_coordinate_polygons))  # make sure no length mismatch
     zipped_names_and_polygons = list(zip(polygon_names, slippy_tile_coordinate_polygons))
@@ -210,9 +264,78 @@ def calculate_inner_coordinates(polygon_names, polygons, zoom=21):
     for name, polygon in zipped_names_and_polygons:
         if not solardb.polygon_has_inner_grid(name):
             to_calculate_names_and_polygons.append((name, polygon))
+    if workers > 1:
+        calculate_inner_coordinates_in_parallel(to_calculate_names_and_polygons, zoom=zoom, workers=workers)
+        return
     for name, polygon in to_calculate_names_and_polygons:
-        coordinates = get_coords_caller(name, polygon)
-        solardb.persist_coords(name, coordinates, zoom=zoom)
+        # stream the inner grid into the db a band of rows at a time rather than calculating all of it up front
+        solardb.persist_coord_chunks(name, rasterize.iter_coords_inside_polygon(polygon), zoom=zoom)
+
+
+def rasterize_bands_in_pool(pool, bands, max_pending):
+    """
+    Rasterizes bands with a process pool, handing back the results in submission order. Unlike pool.imap, at most
+    max_pending bands are in flight (or finished and waiting) at a time, so memory stays bounded when the db writer is
+    slower than the rasterization.
+
+    :param pool: multiprocessing pool to rasterize with
+    :param bands: iterable of bands from rasterize.get_row_bands
+    :param max_pending: maximum number of bands submitted to the pool that haven't been yielded yet
+    :return: yields ndarrays containing coordinate pairs (shape (x,2)), one per band
+    """
+    pending = collections.deque()
+    for band in bands:
+        pending.append(pool.apply_async(rasterize.rasterize_band, (band,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def calculate_inner_coordinates_in_parallel(names_and_polygons, zoom=21, workers=os.cpu_count()):
+    """
+    Calculates and persists inner coordinates of polygons with a pool of processes. Every polygon's bounding box is
+    split into bands of rows and the bands of every polygon are farmed out to the pool, while this process streams the
+    finished bands (in order) into the database one polygon at a time.
+
+    :param names_and_polygons: list of (name, slippy tile coordinate polygon) tuples
+    :param zoom: zoom level of the slippy tile coordinates, defaults to 21
+    :param workers: number of processes in the pool, defaults to the cpu count
+    """
+    bands = itertools.chain.from_iterable(rasterize.get_row_bands(polygon) for _, polygon in names_and_polygons)
+    with multiprocessing.Pool(workers) as pool:
+        # bands come back in the order they were submitted, so each polygon's bands can be pulled in turn
+        rasterized_bands = rasterize_bands_in_pool(pool, bands, max_pending=workers * 4)
+        for name, polygon in names_and_polygons:
+            polygon_bands = itertools.islice(rasterized_bands, rasterize.count_row_bands(polygon))
+            solardb.persist_coord_chunks(name, polygon_bands, zoom=zoom)
+
+
+def verify_inner_coordinates(csvpath, zoom=16):
+    """
+    Checks that the scan line rasterization gives exactly the same inner coordinates as the (much slower) shapely
+    implementation for every polygon in csvpath. Defaults to a lower zoom level than the rest of the pipeline so the
+    shapely side finishes in a reasonable amount of time.
+
+    :param csvpath: path to csv containing city, state names for polygons to check
+    :param zoom: zoom level at which to compare inner coordinates, defaults to 16
+    :return: list of the names of the polygons whose inner coordinates didn't match
+    """
+    from gather_city_shapes import get_city_state_tuples
+
+    polygon_names = [', '.join(city_state_tuple) for city_state_tuple in get_city_state_tuples(csvpath)]
+    polygons = convert_to_slippy_tile_coords(list(combine_all_polygons(csvpath)), zoom=zoom)
+    mismatched_names = []
+    for name, polygon in zip(polygon_names, polygons):
+        expected = get_coords_inside_polygon_shapely(polygon)
+        actual = get_coords_inside_polygon(polygon)
+        if not np.array_equal(expected, actual):
+            print("Inner coordinates for {name} don't match, {expected} expected and {actual} calculated"
+                  .format(name=name, expected=len(expected), actual=len(actual)))
+            mismatched_names.append(name)
+    print("{mismatched} of {total} polygons had mismatched inner coordinates at zoom level {zoom}"
+          .format(mismatched=len(mismatched_names), total=len(polygon_names), zoom=zoom))
+    return mismatched_names
 
 
 if __name__ == '__main__':
@@ -228,8 +351,12 @@ if __name__ == '__main__':
                         help='Calculates the area of all polygons in km2')
     parser.add_argument('--calculate_inner_grid', dest='inner', action='store_const',
                         const=True, default=False,
-                        help='Calculates every slippy coordinate that\'s within a polygon, '
-                             'currently takes a very long time')
+                        help='Calculates every slippy coordinate that\'s within a polygon')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes to calculate the inner grid with, defaults to 1')
+    parser.add_argument('--verify_inner_grid', dest='verify_inner', action='store_const',
+                        const=True, default=False,
+                        help='Checks the fast inner grid calculation against the slow shapely one at a low zoom level')
     parser.add_argument('--calculate_centroids', dest='centroids', action='store_const',
                         const=True, default=False,
                         help='Calculates missing centroids in the database')
@@ -239,7 +366,11 @@ if __name__ == '__main__':
     parser.add_argument('--geojsonio', dest='geojsonio', action='store_const',
                         const=True, default=False,
                         help='Opens processing output in geojsonio if the operation makes sense')
+    parser.add_argument('--database_url', dest='database_url', default=solardb.DEFAULT_DATABASE_URL,
+                        help='Database to persist polygons and tiles to, default {}'
+                        .format(solardb.DEFAULT_DATABASE_URL))
     args = parser.parse_args()
+    solardb.configure_database(url=args.database_url)
 
     output = None
     if args.combine_polygons:
@@ -252,10 +383,17 @@ if __name__ == '__main__':
               + " total tiles at zoom level " + str(21) + " in this multipolygon area!")
         output = projected_polygons
     if args.inner:
-        calculate_inner_coordinates_from_csvpath(csvpath=args.csvpath, zoom=21)
+        calculate_inner_coordinates_from_csvpath(csvpath=args.csvpath, zoom=21, workers=args.workers)
+    if args.verify_inner:
+        verify_inner_coordinates(csvpath=args.csvpath)
     if args.centroids:
         solardb.compute_centroid_distances()
     if args.osm_solar:
-        solardb.query_and_persist_osm_solar(list(combine_all_polygons(args.csvpath)))
+        import osm_solar
+
+        osm_solar.query_and_persist_osm_solar(list(combine_all_polygons(args.csvpath)))
     if args.geojsonio and output is not None:
+        import geojsonio
+        import geopandas
+
         geojsonio.display(geopandas.GeoSeries(output))
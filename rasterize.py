@@ -0,0 +1,166 @@
+import math
+
+import numpy as np
+
+# number of grid rows handed to a worker at a time when rasterizing in parallel
+ROWS_PER_BAND = 256
+
+
+def get_polygon_edges(polygon):
+    """
+    Collects every edge of a polygon (including the edges of its holes, and of every part of a MultiPolygon) into one
+    array so they can be scanned together with the even-odd rule.
+
+    :param polygon: shapely Polygon or MultiPolygon
+    :return: ndarray of shape (x,4) where each row is an edge (x0, y0, x1, y1)
+    """
+    edges = []
+    for part in getattr(polygon, 'geoms', [polygon]):
+        for ring in [part.exterior] + list(part.interiors):
+            coords = np.asarray(ring.coords, dtype=np.float64)[:, :2]
+            edges.append(np.hstack((coords[:-1], coords[1:])))
+    if not edges:
+        return np.empty((0, 4), dtype=np.float64)
+    return np.vstack(edges)
+
+
+def scanline_mask(edges, y, xs):
+    """
+    Calculates which points of a single grid row lie strictly inside the polygon described by edges.
+
+    Crossings are counted with a half open rule (an edge spans [min y, max y) ) so vertices sitting exactly on the scan
+    line are counted once, and then any point sitting exactly on an edge or vertex is masked out afterwards, to match
+    shapely's contains (which is false for points on the boundary).
+
+    :param edges: ndarray of edges from get_polygon_edges
+    :param y: the y coordinate of the row
+    :param xs: sorted ndarray of the x coordinates of the row
+    :return: boolean ndarray the same length as xs, true where the point is inside the polygon
+    """
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    y_min = np.minimum(y0, y1)
+    y_max = np.maximum(y0, y1)
+
+    # edges that touch the scan line at all, including their end points
+    touching = (y_min <= y) & (y <= y_max)
+    if not touching.any():
+        return np.zeros(len(xs), dtype=bool)
+    x0, y0, x1, y1 = x0[touching], y0[touching], x1[touching], y1[touching]
+    y_min, y_max = y_min[touching], y_max[touching]
+
+    horizontal = y0 == y1
+    sloped = ~horizontal
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = x0[sloped] + (y - y0[sloped]) * (x1[sloped] - x0[sloped]) / (y1[sloped] - y0[sloped])
+
+    # even-odd rule, a point is inside if there are an odd number of crossings to its left
+    counted = np.sort(crossings[y_max[sloped] != y])
+    mask = np.searchsorted(counted, xs, side='left') % 2 == 1
+
+    # points on the boundary aren't contained by the polygon
+    mask &= ~np.isin(xs, crossings)
+    for start, end in zip(np.minimum(x0[horizontal], x1[horizontal]), np.maximum(x0[horizontal], x1[horizontal])):
+        mask[np.searchsorted(xs, start, side='left'):np.searchsorted(xs, end, side='right')] = False
+    return mask
+
+
+def rasterize_rows(edges, xs, ys):
+    """
+    Calculates the grid coordinates inside a polygon for the given rows of a grid, one scan line at a time.
+
+    :param edges: ndarray of edges from get_polygon_edges
+    :param xs: sorted ndarray of the x coordinates of every row
+    :param ys: ndarray of the y coordinates of the rows to scan
+    :return: ndarray containing coordinate pairs (shape (x,2)), ordered by row and then by column
+    """
+    # only the edges that can reach one of these rows need to be considered for each scan line
+    if len(ys):
+        edges = edges[(np.minimum(edges[:, 1], edges[:, 3]) <= ys.max()) &
+                      (np.maximum(edges[:, 1], edges[:, 3]) >= ys.min())]
+    rows = []
+    for y in ys:
+        inside_xs = xs[scanline_mask(edges, y, xs)]
+        if len(inside_xs):
+            rows.append(np.column_stack((inside_xs, np.full(len(inside_xs), y, dtype=xs.dtype))))
+    if not rows:
+        return np.empty((0, 2), dtype=xs.dtype)
+    return np.vstack(rows)
+
+
+def get_grid_axes(polygon):
+    """
+    Gets the x and y coordinates of the grid spanning a polygon's bounding box, the same grid
+    process_city_shapes.get_coords_inside_polygon has always checked.
+
+    :param polygon: polygon to calculate the grid of
+    :return: tuple of ndarrays containing the x coordinates and the y coordinates
+    """
+    return np.arange(polygon.bounds[0], polygon.bounds[2]), np.arange(polygon.bounds[1], polygon.bounds[3])
+
+
+def get_coords_inside_polygon(polygon):
+    """
+    Calculate all grid coordinates inside a given polygon by rasterizing it a scan line at a time, rather than testing
+    every point in its bounding box with shapely.
+
+    :param polygon: polygon (or multipolygon) to calculate coordinates inside of
+    :return: ndarray containing coordinate pairs (shape (x,2))
+    """
+    xs, ys = get_grid_axes(polygon)
+    return rasterize_rows(get_polygon_edges(polygon), xs, ys)
+
+
+def get_row_bands(polygon, rows_per_band=ROWS_PER_BAND):
+    """
+    Splits the grid spanning a polygon's bounding box into bands of rows that can be rasterized independently (and in
+    parallel) with rasterize_band.
+
+    :param polygon: polygon (or multipolygon) to split
+    :param rows_per_band: maximum number of rows in each band
+    :return: yields (edges, xs, ys) tuples, one for each band, in row order
+    """
+    edges = get_polygon_edges(polygon)
+    xs, ys = get_grid_axes(polygon)
+    for start in range(0, len(ys), rows_per_band):
+        band_ys = ys[start:start + rows_per_band]
+        # only ship the edges that can reach this band to whichever process rasterizes it
+        band_edges = edges[(np.minimum(edges[:, 1], edges[:, 3]) <= band_ys.max()) &
+                           (np.maximum(edges[:, 1], edges[:, 3]) >= band_ys.min())]
+        yield band_edges, xs, band_ys
+
+
+def count_row_bands(polygon, rows_per_band=ROWS_PER_BAND):
+    """
+    Counts how many bands get_row_bands will split a polygon into.
+
+    :param polygon: polygon (or multipolygon) to split
+    :param rows_per_band: maximum number of rows in each band
+    :return: number of bands
+    """
+    return math.ceil(len(get_grid_axes(polygon)[1]) / rows_per_band)
+
+
+def rasterize_band(band):
+    """
+    Rasterizes a single band from get_row_bands, takes a single argument so it can be mapped over by a process pool.
+
+    :param band: (edges, xs, ys) tuple
+    :return: ndarray containing coordinate pairs (shape (x,2))
+    """
+    edges, xs, ys = band
+    return rasterize_rows(edges, xs, ys)
+
+
+def iter_coords_inside_polygon(polygon, rows_per_band=ROWS_PER_BAND):
+    """
+    Calculate all grid coordinates inside a given polygon, a band of rows at a time, so that only one band's worth of
+    coordinates is ever held in memory no matter how large the polygon is.
+
+    :param polygon: polygon (or multipolygon) to calculate coordinates inside of
+    :param rows_per_band: maximum number of grid rows in each yielded chunk
+    :return: yields ndarrays containing coordinate pairs (shape (x,2)), in row order
+    """
+    for band in get_row_bands(polygon, rows_per_band=rows_per_band):
+        coordinates = rasterize_band(band)
+        if len(coordinates):
+            yield coordinates
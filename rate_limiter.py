@@ -0,0 +1,24 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls across every thread sharing it so no more than rate happen per second, a rate of None doesn't
+    limit anything.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the caller is allowed to make its next call."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_until = max(self._next_time, now)
+            self._next_time = wait_until + 1.0 / self.rate
+        time.sleep(max(wait_until - now, 0))
@@ -1,18 +1,18 @@
 import argparse
 import os
 
-import geopandas
-from geojsonio import geojsonio
 from shapely.geometry import shape
 
 import gather_city_shapes
 import maproulette
+import osm_solar
 import process_city_shapes
 import run_inference
 import solardb
 
 ZOOM = 21
 BATCHES_BETWEEN_DELETE = 100
+DEFAULT_OSM_RADIUS = 1
 
 parser = argparse.ArgumentParser(description='Give the search parameters to find a location (usually city/state '
                                              'sufficient), and this script will attempt to find all the solar panels in'
@@ -29,8 +29,20 @@ parser.add_argument('--classification-checkpoint', dest='classification_checkpoi
 parser.add_argument('--segmentation-checkpoint', dest='segmentation_checkpoint',
                     default=os.path.join('..', 'DeepSolar', 'ckpt', 'inception_segmentation'),
                     help='Path to DeepSolar segmentation checkpoint.')
+parser.add_argument('--workers', dest='workers', type=int, default=1,
+                    help='Number of processes to calculate the inner grid with, defaults to 1')
+parser.add_argument('--database-url', dest='database_url', default=solardb.DEFAULT_DATABASE_URL,
+                    help='Database to keep the search polygon and its tiles in, defaults to {}'
+                    .format(solardb.DEFAULT_DATABASE_URL))
+parser.add_argument('--osm-radius', dest='osm_radius', type=int, default=DEFAULT_OSM_RADIUS,
+                    help='Hold back classifying the tiles within this many tiles of a solar panel already mapped in '
+                         'OSM, defaults to {}'.format(DEFAULT_OSM_RADIUS))
+parser.add_argument('--osm-scheduling', dest='osm_scheduling', choices=solardb.OSM_SCHEDULING_MODES, default='defer',
+                    help='Classify the held back tiles once every other tile is finished (defer) or never (skip), '
+                         'defaults to defer')
 
 args = parser.parse_args()
+solardb.configure_database(url=args.database_url)
 
 polygon_name_params = [args.city, args.county, args.state, args.country]
 polygon_name = ', '.join([polygon_name_param for polygon_name_param in polygon_name_params if polygon_name_param])
@@ -50,6 +62,9 @@ if polygon_name not in names:
     polygon = process_city_shapes.simplify_polygon(polygon)
 
     if not args.no_geojsonio:
+        import geopandas
+        from geojsonio import geojsonio
+
         # Create a link to geojsonio for the polygon to double check correctness
         print(geojsonio.make_url(geopandas.GeoSeries([polygon]).to_json()))
         input("A geojson.io link has been created with your simplified search polygon, press enter to continue if it "
@@ -57,19 +72,29 @@ if polygon_name not in names:
 
     print("Calculating the coordinates of the imagery grid contained within this polygon.")
     # This step is necessary so we know what images to query in this polygon, it also persists these in the db
-    process_city_shapes.calculate_inner_coordinates([polygon_name], [polygon], zoom=ZOOM)
+    process_city_shapes.calculate_inner_coordinates([polygon_name], [polygon], zoom=ZOOM, workers=args.workers)
 
 print("Calculating the distance to the search polygon's centroid from each point if it hasn't been done before.")
 # This step is just so we have an order for which coordinates to search first (outwards from the middle)
 solardb.compute_centroid_distances()
 
-print("Running classification on every tile in the search polygon that hasn't had inference ran yet.")
-# You should be able to SIGINT at this point if it's taking forever and it should pick up where it left off if you do
-run_inference.run_classification(args.classification_checkpoint, args.segmentation_checkpoint, BATCHES_BETWEEN_DELETE)
-
 print("Querying OpenStreetMap for existing solar panels in this search polygon.")
-# This will requery every time, but it's good because you want your task to filter the newly added panels out.
-solardb.query_and_persist_osm_solar([shape(polygon)])
+osm_solar.query_and_persist_osm_solar([shape(polygon)])
+
+print("Running classification on every tile in the search polygon that hasn't had inference ran yet.")
+# You should be able to SIGINT at this point if it's taking forever and it should pick up where it left off if you do.
+# Tiles next to a panel that's already mapped only make tasks that get filtered out, so they're held back (see
+# --osm-scheduling).
+run_inference.run_classification(args.classification_checkpoint, args.segmentation_checkpoint, BATCHES_BETWEEN_DELETE,
+                                 osm_radius=args.osm_radius, osm_mode=args.osm_scheduling)
+
+print("Querying OpenStreetMap again for solar panels mapped while classification was running.")
+# Only the parts of the polygon that haven't been queried in the last day are queried again, so panels that have been
+# added since still get filtered out of the task.
+osm_solar.query_and_persist_osm_solar([shape(polygon)])
+# how many of the tiles OSM already has a panel in the classifier found, a rough check of its recall
+print("Of the {osm_tiles} tiles with an OSM solar node, {osm_tiles_classified} have been classified and "
+      "{osm_tiles_detected} were positive.".format(**solardb.query_osm_coverage(polygon_name=polygon_name)))
 
 print("Detecting clusters of positive classification tiles.")
 run_inference.detect_clusters()
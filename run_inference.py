@@ -1,4 +1,6 @@
 import argparse
+import collections
+import concurrent.futures
 import itertools
 import os
 import time
@@ -6,126 +8,254 @@ import time
 import numpy as np
 import skimage
 
+import clustering
 import imagery
+import metrics
 import solardb
 
 from os import path
 import sys
 sys.path.append(path.abspath('../DeepSolar'))
 
-from inception.predictor import Predictor
-
 IMAGE_SIZE = 299
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_PREFETCH_DEPTH = 2
+DEFAULT_PREPROCESS_WORKERS = 4
+DEFAULT_IMAGERY_LOOKAHEAD = 4000
+DEFAULT_DELETE_WORKERS = 8
+
 
+def detect_clusters(incremental=True):
+    """
+    Groups every tile over the threshold into clusters of edge connected tiles, per polygon.
 
-def detect_clusters():
+    :param incremental: only cluster the tiles over threshold that aren't in a cluster yet, along with the clustered
+    tiles around them, so new positive tiles join (and merge) the clusters they touch without loading every positive
+    tile. Clusters don't split when tiles drop below the threshold though, so pass False after reclassifying tiles to
+    relabel every cluster from scratch (each cluster keeps its id where it can, and clusters left without any tiles are
+    deleted)
+    """
     polygon_names = solardb.get_polygon_names()
-    print("Starting clustering recursion")
     for polygon_name in polygon_names:
         print("Querying tiles for {polygon_name}".format(polygon_name=polygon_name))
-        tiles = {}
-        coordinates_to_iterate_through = set()
-        for tile in solardb.query_tiles_over_threshold(polygon_name=polygon_name, filter_clustered=True):
-            coordinate_tuple = (tile.column, tile.row, tile.zoom)
-            tiles[coordinate_tuple] = tile
-            coordinates_to_iterate_through.add(coordinate_tuple)
-        total_iterations = len(coordinates_to_iterate_through)
-        print("Starting clustering recursion")
-        while coordinates_to_iterate_through:
-            print("{0:.0%}".format(((total_iterations - len(coordinates_to_iterate_through)) / total_iterations)),
-                  end='\r')
-            tile = coordinates_to_iterate_through.pop()
-            cluster = {tile}
-            positive_cluster_id = solardb.get_new_positive_cluster_id()
-            detect_clusters_recursive_helper(cluster, coordinates_to_iterate_through, tile)
-            for coordinate_tuple in cluster:
-                slippy_tile = tiles[coordinate_tuple]
-                slippy_tile.cluster_id = positive_cluster_id
-        solardb.update_tiles(tiles.values())
-
-
-def detect_clusters_recursive_helper(cluster, coordinates_to_iterate_through, tile, no_check_direction=None):
-    north_tuple = (tile[0], tile[1] - 1, tile[2])
-    east_tuple = (tile[0] + 1, tile[1], tile[2])
-    south_tuple = (tile[0], tile[1] + 1, tile[2])
-    west_tuple = (tile[0] - 1, tile[1], tile[2])
-    neighbors = [north_tuple, east_tuple, south_tuple, west_tuple]
-    for i, coord_tuple in enumerate(neighbors):
-        # little bit of optimization to not call the "coord_tuple in coords_to_iterate_through" for the coordinate that
-        # just called this method and will never be in the remaining coordinates
-        if not (no_check_direction and no_check_direction == i) \
-                and coord_tuple in coordinates_to_iterate_through:
-            cluster.add(coord_tuple)
-            coordinates_to_iterate_through.remove(coord_tuple)
-            detect_clusters_recursive_helper(cluster, coordinates_to_iterate_through, coord_tuple, (i + 2) % 4)
-
-
-def batch_delete_extra_imagery():
+        if incremental:
+            detect_new_clusters(polygon_name)
+            continue
+        tile_array = solardb.query_positive_tile_array(polygon_name=polygon_name)
+        for zoom in np.unique(tile_array[:, 2]):
+            zoom_tile_array = tile_array[tile_array[:, 2] == zoom]
+            labels = clustering.label_clusters(zoom_tile_array[:, 0:2])
+            cluster_ids = clustering.assign_cluster_ids(labels, zoom_tile_array[:, 3],
+                                                        solardb.allocate_positive_cluster_ids)
+            changed = cluster_ids != zoom_tile_array[:, 3]
+            changed_tile_array = np.column_stack((zoom_tile_array[changed, 0:3], cluster_ids[changed]))
+            solardb.update_tile_cluster_ids(changed_tile_array)
+            print("Clustered {tiles} tiles into {clusters} clusters for {polygon_name}, {changed} tiles changed"
+                  .format(tiles=len(zoom_tile_array), clusters=len(np.unique(cluster_ids)),
+                          polygon_name=polygon_name, changed=len(changed_tile_array)))
+    if not incremental:
+        print("Deleted {clusters} clusters without any tiles left".format(clusters=solardb.remove_stale_clusters()))
+
+
+def detect_new_clusters(polygon_name):
+    """
+    Clusters the polygon's unclustered tiles over threshold together with the clustered tiles around them. Clusters a
+    new tile touches keep the smallest of their ids, and the rest of their tiles are moved into it.
+    """
+    new_tiles = solardb.query_tile_rows_over_threshold(polygon_name=polygon_name, filter_clustered=True)
+    for zoom in np.unique(new_tiles['zoom']).tolist():
+        zoom_tiles = new_tiles[new_tiles['zoom'] == zoom]
+        new_coordinates = np.column_stack((zoom_tiles['column'], zoom_tiles['row']))
+        neighbourhood = clustering.decode_coordinates(clustering.get_neighbourhood_keys(new_coordinates, 1))
+        neighbour_tiles = solardb.query_clustered_tile_rows(neighbourhood, zoom, polygon_name=polygon_name)
+        tiles = np.concatenate((zoom_tiles, neighbour_tiles))
+        labels = clustering.label_clusters(np.column_stack((tiles['column'], tiles['row'])),
+                                           cluster_ids=tiles['cluster_id'])
+        cluster_ids = clustering.assign_cluster_ids(labels, tiles['cluster_id'], solardb.allocate_positive_cluster_ids)
+        merged = cluster_ids[len(zoom_tiles):] != neighbour_tiles['cluster_id']
+        merged_cluster_ids = dict(zip(neighbour_tiles['cluster_id'][merged].tolist(),
+                                      cluster_ids[len(zoom_tiles):][merged].tolist()))
+        solardb.update_tile_cluster_ids(np.column_stack((new_coordinates, zoom_tiles['zoom'],
+                                                         cluster_ids[:len(zoom_tiles)])))
+        solardb.merge_cluster_ids(merged_cluster_ids)
+        print("Clustered {tiles} new tiles into {clusters} clusters for {polygon_name}, {merged} clusters merged"
+              .format(tiles=len(zoom_tiles), clusters=len(np.unique(cluster_ids[:len(zoom_tiles)])),
+                      polygon_name=polygon_name, merged=len(merged_cluster_ids)))
+
+
+def batch_delete_extra_imagery(threshold=0.25, workers=DEFAULT_DELETE_WORKERS):
     print("Starting extraneous imagery cleanup/deletion")
     polygon_names = solardb.get_polygon_names()
     for polygon_name in polygon_names:
-        tiles_above_threshold = solardb.query_tiles_over_threshold(polygon_name=polygon_name)
-        expanded_coords_above_threshold = set()
-        for tile in tiles_above_threshold:
-            for column in range(tile.column - 1, tile.column + 2):
-                for row in range(tile.row - 1, tile.row + 2):
-                    expanded_coords_above_threshold.add((column, row, tile.zoom))
-        print("Calculation for expanded positive coords for {polygon_name} completed".format(polygon_name=polygon_name))
-        while True:
-            tile_batch = solardb.query_tile_batch(polygon_name=polygon_name)
-            to_delete = []
-            if not tile_batch:
-                break
-            for tile in tile_batch:
-                tile_tuple = (tile.column, tile.row, tile.zoom)
-                if tile_tuple not in expanded_coords_above_threshold:
-                    tile.has_image = False
-                    to_delete.append(tile_tuple)
-            solardb.update_tiles(tile_batch)
-            imagery.delete_images(to_delete)
-            print("Deleted {num} non-solar panel containing imagery tiles for {polygon_name}".format(
-                num=len(to_delete), polygon_name=polygon_name))
-            # if no tiles got deleted in the batch it's probably done
-            # if the number of expanded coords is larger than the batch size, this could theoretically return early
-            if not to_delete:
-                break
+        start_time = time.time()
+        deleted_files, freed_bytes = 0, 0
+        for coordinates in solardb.iter_extra_imagery_batches(polygon_name, threshold=threshold):
+            solardb.mark_no_imagery(coordinates)
+            batch_files, batch_bytes = imagery.delete_images(coordinates, workers=workers)
+            deleted_files += batch_files
+            freed_bytes += batch_bytes
+        elapsed = time.time() - start_time
+        metrics.observe('delete_imagery', elapsed)
+        metrics.increment('imagery_files_deleted', deleted_files)
+        metrics.increment('imagery_bytes_freed', freed_bytes)
+        print("Deleted {num} non-solar panel containing imagery files for {polygon_name}, freeing {megabytes:.1f}MB "
+              "({rate:.0f} files/s)".format(num=deleted_files, polygon_name=polygon_name,
+                                            megabytes=freed_bytes / 1024 / 1024,
+                                            rate=deleted_files / elapsed if elapsed else 0))
     print("Deletion finished")
 
 
-def run_classification(classification_checkpoint, segmentation_checkpoint=None, delete_every=None):
+def preprocess_tile(tile):
+    """
+    Stitches the image for a tile together with its border tiles and resizes it for the classifier
+
+    :param tile: SlippyTile to preprocess
+    :return: (image, stitch seconds, resize seconds) where image is an ndarray of shape (IMAGE_SIZE, IMAGE_SIZE, 3)
+    """
+    start_time = time.time()
+    image = imagery.stitch_array_at_coordinate((tile.column, tile.row))
+    stitched_time = time.time()
+    resized_image = skimage.transform.resize(image, (IMAGE_SIZE, IMAGE_SIZE))[:, :, 0:3]
+    return resized_image, stitched_time - start_time, time.time() - stitched_time
+
+
+def preprocess_tile_into(tile, images, index):
+    image, stitch_seconds, resize_seconds = preprocess_tile(tile)
+    images[index] = image
+    return stitch_seconds, resize_seconds
+
+
+def classify_batch(predictor, images):
+    """
+    Classifies a batch of preprocessed images, in one model call if the predictor supports batches (DeepSolar's
+    Predictor.classify only takes one image at a time, so otherwise the batch is classified image by image)
+
+    :param predictor: DeepSolar Predictor
+    :param images: ndarray of shape (x, IMAGE_SIZE, IMAGE_SIZE, 3)
+    :return: list of panel softmax values, one per image
+    """
+    if hasattr(predictor, 'classify_batch'):
+        return list(predictor.classify_batch(images))
+    return [predictor.classify(image[None, ...]) for image in images]
+
+
+def classify_tiles(predictor, tiles, executor, image_buffers, stage_seconds, batch_size=DEFAULT_BATCH_SIZE,
+                   prefetch_depth=DEFAULT_PREFETCH_DEPTH):
+    """
+    Runs inference on tiles, with the executor's threads stitching and resizing upcoming batches into preallocated
+    buffers while the current batch is being classified. Sets the panel softmax, inference ran flag and timestamp on
+    every tile, but doesn't persist them.
+
+    :param predictor: DeepSolar Predictor
+    :param tiles: list of SlippyTiles to classify
+    :param executor: ThreadPoolExecutor to preprocess tiles with
+    :param image_buffers: prefetch_depth + 1 preallocated arrays of shape (batch_size, IMAGE_SIZE, IMAGE_SIZE, 3)
+    :param stage_seconds: defaultdict(float) that the time spent in each stage gets added to
+    :param batch_size: number of tiles to classify at a time
+    :param prefetch_depth: number of batches to preprocess ahead of the one being classified
+    """
+    batches = [tiles[start:start + batch_size] for start in range(0, len(tiles), batch_size)]
+    pending = collections.deque()
+    for batch_index in range(len(batches) + prefetch_depth):
+        if batch_index < len(batches):
+            images = image_buffers[batch_index % len(image_buffers)]
+            futures = [executor.submit(preprocess_tile_into, tile, images, i)
+                       for i, tile in enumerate(batches[batch_index])]
+            pending.append((batches[batch_index], images, futures))
+        if batch_index < prefetch_depth:
+            continue
+        batch, images, futures = pending.popleft()
+        start_time = time.time()
+        for future in futures:
+            stitch_seconds, resize_seconds = future.result()
+            stage_seconds['stitch'] += stitch_seconds
+            stage_seconds['resize'] += resize_seconds
+            metrics.observe('stitch', stitch_seconds)
+            metrics.observe('resize', resize_seconds)
+        stage_seconds['waiting'] += time.time() - start_time
+        metrics.observe('preprocess_wait', time.time() - start_time)
+
+        start_time = time.time()
+        softmaxes = classify_batch(predictor, images[:len(batch)])
+        stage_seconds['model'] += time.time() - start_time
+        metrics.observe('model', time.time() - start_time)
+        metrics.increment('tiles_classified', len(batch))
+        for tile, softmax in zip(batch, softmaxes):
+            tile.panel_softmax = softmax
+            tile.inference_ran = True
+            tile.inference_timestamp = time.time()
+
+
+def format_stage_rates(tile_count, stage_seconds, preprocess_workers):
+    rates = []
+    for stage in ['stitch', 'resize']:
+        # these stages run on every preprocessing thread at once
+        seconds = stage_seconds[stage] / preprocess_workers
+        rates.append("{0} {1:.2f} tiles/s".format(stage, tile_count / seconds if seconds else float('inf')))
+    seconds = stage_seconds['model']
+    rates.append("model {0:.2f} tiles/s".format(tile_count / seconds if seconds else float('inf')))
+    rates.append("{0:.1f}s waiting on preprocessing".format(stage_seconds['waiting']))
+    rates.append("{0:.0f}ms fetching the batch".format(stage_seconds['queue'] * 1000))
+    return " | ".join(rates)
+
+
+def run_classification(classification_checkpoint, segmentation_checkpoint=None, delete_every=None,
+                       batch_size=DEFAULT_BATCH_SIZE, prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                       preprocess_workers=DEFAULT_PREPROCESS_WORKERS, imagery_prefetch_workers=0,
+                       imagery_lookahead=DEFAULT_IMAGERY_LOOKAHEAD, osm_radius=None, osm_mode='defer'):
+    """
+    :param osm_radius: hold back the tiles within this many tiles of an OSM solar node, None to not hold any back
+    :param osm_mode: 'defer' to run inference on the held back tiles after every other tile, 'skip' to never run it
+    """
+    # imports tensorflow, which takes seconds, so only pay for it once there's inference to run
+    from inception.predictor import Predictor
+
     predictor = Predictor(
         dirpath_classification_checkpoint=classification_checkpoint,
         dirpath_segmentation_checkpoint=segmentation_checkpoint
     )
+    prefetcher = imagery.ImageryPrefetcher(workers=imagery_prefetch_workers) if imagery_prefetch_workers else None
+    image_buffers = [np.empty((batch_size, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
+                     for _ in range(prefetch_depth + 1)]
     avg_tiles_per_sec = 0.0
-    for i in itertools.count(0):
-        if delete_every and i % delete_every == 0:
-            batch_delete_extra_imagery()
-        start_time = time.time()
-        tiles = solardb.query_tile_batch_for_inference()
-        if not tiles:
-            print("No viable coordinates left to run inference on. Either provide more polygons or compute centroid "
-                  "distances. Attempting to detect clusters now.")
-            detect_clusters()
-            break
-
-        for tile in tiles:
-            image = np.array(imagery.stitch_image_at_coordinate((tile.column, tile.row)))
-
-            resized_image = skimage.transform.resize(image, (IMAGE_SIZE, IMAGE_SIZE))
-            if resized_image.shape[2] != 3:
-                resized_image = resized_image[:, :, 0:3]
-            resized_image = resized_image[None, ...]
-
-            tile.panel_softmax = predictor.classify(resized_image)
-            tile.inference_ran = True
-            tile.inference_timestamp = time.time()
+    work_queue = solardb.InferenceWorkQueue(osm_radius=osm_radius, osm_mode=osm_mode)
+    # one session is reused for every query and update made while classifying
+    with solardb.session_scope(), concurrent.futures.ThreadPoolExecutor(max_workers=preprocess_workers) as executor:
+        for i in itertools.count(0):
+            if delete_every and i % delete_every == 0:
+                batch_delete_extra_imagery()
+            start_time = time.time()
+            tiles = work_queue.next_batch()
+            queue_seconds = time.time() - start_time
+            metrics.observe('work_queue', queue_seconds)
+            if not tiles:
+                print("No viable coordinates left to run inference on. Either provide more polygons or compute "
+                      "centroid distances. Attempting to detect clusters now.")
+                if osm_radius is not None and osm_mode == 'skip':
+                    print("Skipped {count} tiles within {radius} tiles of an OSM solar node".format(
+                        count=work_queue.held_back_count, radius=osm_radius))
+                detect_clusters()
+                break
+            if prefetcher:
+                prefetcher.prefetch((tile.column, tile.row, tile.zoom) for tile in tiles)
+                prefetcher.prefetch(work_queue.peek(limit=imagery_lookahead))
 
-        solardb.update_tiles(tiles)
+            stage_seconds = collections.defaultdict(float)
+            stage_seconds['queue'] = queue_seconds
+            classify_tiles(predictor, tiles, executor, image_buffers, stage_seconds, batch_size=batch_size,
+                           prefetch_depth=prefetch_depth)
+            solardb.update_tiles(tiles)
 
-        tiles_per_sec = len(tiles) / (time.time() - start_time)
-        avg_tiles_per_sec = ((avg_tiles_per_sec * i) + tiles_per_sec) / (i + 1)
-        print("{0:.2f} tiles/s | {1:.2f} avg tiles/s".format(tiles_per_sec, avg_tiles_per_sec))
+            tiles_per_sec = len(tiles) / (time.time() - start_time)
+            avg_tiles_per_sec = ((avg_tiles_per_sec * i) + tiles_per_sec) / (i + 1)
+            print("{0:.2f} tiles/s | {1:.2f} avg tiles/s | {2} | tiles {3} | grids {4}{5}".format(
+                tiles_per_sec, avg_tiles_per_sec, format_stage_rates(len(tiles), stage_seconds, preprocess_workers),
+                imagery.tile_cache, imagery.grid_cache, " | {}".format(prefetcher) if prefetcher else ""))
+    if prefetcher:
+        prefetcher.shutdown(wait=False)
+    if solardb.query_timer.counts:
+        print("Slowest queries:\n" + solardb.query_timer.format_timings())
+    print("Time spent in each stage:\n" + metrics.format_summary())
 
 
 DEFAULT_DELETE_EVERY = 100
@@ -140,6 +270,73 @@ if __name__ == '__main__':
                         help='Path to DeepSolar segmentation checkpoint.')
     parser.add_argument('--delete_every', dest='delete_every', default=DEFAULT_DELETE_EVERY,
                         help='Deletes extra imagery every x inference batches, default {}'.format(DEFAULT_DELETE_EVERY))
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of tiles to classify at a time, default {}'.format(DEFAULT_BATCH_SIZE))
+    parser.add_argument('--prefetch-depth', dest='prefetch_depth', type=int, default=DEFAULT_PREFETCH_DEPTH,
+                        help='Number of batches to stitch and resize ahead of the one being classified, default {}'
+                        .format(DEFAULT_PREFETCH_DEPTH))
+    parser.add_argument('--preprocess-workers', dest='preprocess_workers', type=int,
+                        default=DEFAULT_PREPROCESS_WORKERS,
+                        help='Number of threads stitching and resizing images, default {}'
+                        .format(DEFAULT_PREPROCESS_WORKERS))
+    parser.add_argument('--tile-cache-mb', dest='tile_cache_mb', type=int,
+                        default=imagery.DEFAULT_TILE_CACHE_MEGABYTES,
+                        help='Memory cap of the decoded tile cache, default {}'
+                        .format(imagery.DEFAULT_TILE_CACHE_MEGABYTES))
+    parser.add_argument('--grid-cache-mb', dest='grid_cache_mb', type=int, default=0,
+                        help='Memory cap of the decoded query grid cache (75MB per grid), default 0 (disabled)')
+    parser.add_argument('--imagery-store', dest='imagery_store', choices=imagery.IMAGERY_STORES,
+                        default=imagery.imagery_store,
+                        help='Keep fetched imagery as a jpeg per tile or as one memory mapped array per query grid, '
+                             'default {}'.format(imagery.imagery_store))
+    parser.add_argument('--tile-storage', dest='tile_storage', choices=imagery.TILE_STORAGES, default='files',
+                        help='Keep the tiles of the "tiles" imagery store as a jpeg file each or packed into shards '
+                             '(see imagery.py --migrate_to_shards), default files')
+    parser.add_argument('--imagery-prefetch-workers', dest='imagery_prefetch_workers', type=int, default=0,
+                        help='Number of threads fetching imagery ahead of inference, default 0 (disabled)')
+    parser.add_argument('--imagery-lookahead', dest='imagery_lookahead', type=int, default=DEFAULT_IMAGERY_LOOKAHEAD,
+                        help='Number of upcoming tiles to prefetch imagery for, default {}'
+                        .format(DEFAULT_IMAGERY_LOOKAHEAD))
+    parser.add_argument('--osm-radius', dest='osm_radius', type=int, default=None,
+                        help='Hold back the tiles within this many tiles of a solar panel already mapped in OSM (see '
+                             'osm_solar.py), default none held back')
+    parser.add_argument('--osm-scheduling', dest='osm_scheduling', choices=solardb.OSM_SCHEDULING_MODES,
+                        default='defer',
+                        help='Run inference on the held back tiles once every other tile is finished (defer) or never '
+                             '(skip), default defer')
+    parser.add_argument('--imagery-rate-limit', dest='imagery_rate_limit', type=float, default=None,
+                        help='Maximum imagery requests per second across all threads, default unlimited')
+    parser.add_argument('--imagery-url', dest='imagery_url', default=None,
+                        help='Base url of a server to query for static imagery instead of mapbox, e.g. a local server '
+                             'serving fake imagery')
+    parser.add_argument('--database-url', dest='database_url', default=solardb.DEFAULT_DATABASE_URL,
+                        help='Database to read tiles from and write results to, default {}'
+                        .format(solardb.DEFAULT_DATABASE_URL))
+    parser.add_argument('--time-queries', dest='time_queries', action='store_const', const=True, default=False,
+                        help='Print the slowest database queries once inference finishes')
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help='Append a json line of every counter and latency histogram to this file periodically')
+    parser.add_argument('--metrics-interval', dest='metrics_interval', type=float,
+                        default=metrics.DEFAULT_METRICS_INTERVAL,
+                        help='Seconds between the lines written to the metrics file, default {}'
+                        .format(metrics.DEFAULT_METRICS_INTERVAL))
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=None,
+                        help='Serve metrics in the prometheus text format on this port')
     args = parser.parse_args()
 
-    run_classification(args.classification_checkpoint, args.segmentation_checkpoint, delete_every=args.delete_every)
+    solardb.configure_database(url=args.database_url, time_queries=args.time_queries)
+
+    imagery.configure_imagery_service(url=args.imagery_url, rate=args.imagery_rate_limit)
+    imagery.configure_imagery_store(args.imagery_store)
+    imagery.configure_tile_storage(args.tile_storage)
+    imagery.configure_image_caches(tile_megabytes=args.tile_cache_mb, grid_megabytes=args.grid_cache_mb)
+    metrics.configure_metrics(filename=args.metrics_file, interval=args.metrics_interval, port=args.metrics_port)
+    try:
+        run_classification(args.classification_checkpoint, args.segmentation_checkpoint,
+                           delete_every=args.delete_every, batch_size=args.batch_size,
+                           prefetch_depth=args.prefetch_depth, preprocess_workers=args.preprocess_workers,
+                           imagery_prefetch_workers=args.imagery_prefetch_workers,
+                           imagery_lookahead=args.imagery_lookahead, osm_radius=args.osm_radius,
+                           osm_mode=args.osm_scheduling)
+    finally:
+        metrics.close_metrics()
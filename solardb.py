@@ -1,16 +1,30 @@
-
+import contextlib
+import os
+import sqlite3
+import threading
 import time
+from collections import defaultdict
 
 import math
-import overpy
+import numpy as np
+
+import clustering
+import metrics
 from sqlalchemy import Column, Integer, String, ForeignKey, Float, Boolean, PrimaryKeyConstraint, Index, desc
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select, func, literal_column, tuple_, and_, or_, bindparam, text, cast
+from sqlalchemy import case
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, scoped_session
 from sqlalchemy.sql import expression
 
 Base = declarative_base()
-# TODO improve session management
+TILE_ROWID = literal_column('slippy_tiles.rowid')
+# the lightweight rows iter_tiles_over_threshold streams instead of SlippyTiles, cluster_id is -1 for unclustered tiles
+TILE_ROW_DTYPE = np.dtype([('column', np.int64), ('row', np.int64), ('zoom', np.int64), ('panel_softmax', np.float64),
+                           ('cluster_id', np.int64)])
+# can be overridden with configure_database, or the SOLARDB_URL environment variable
+DEFAULT_DATABASE_URL = os.environ.get('SOLARDB_URL', 'sqlite:///data/solar.db')
 
 
 class SearchPolygon(Base):
@@ -49,7 +63,10 @@ class SlippyTile(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint(row, column, zoom, sqlite_on_conflict='IGNORE'),
-        Index('centroid_index', polygon_name, centroid_distance)
+        Index('centroid_index', polygon_name, centroid_distance),
+        # only holds the tiles still waiting on inference, so finished tiles don't have to be scanned past to find them
+        Index('pending_inference_index', polygon_name, centroid_distance,
+              sqlite_where=(inference_ran == expression.false()) & centroid_distance.isnot(None))
     )
 
 
@@ -58,204 +75,772 @@ class OSMSolarNode(Base):
 
     longitude = Column(Float, nullable=False)
     latitude = Column(Float, nullable=False)
+    # the slippy tile the node is in, worked out when it's persisted so nodes can be joined against slippy_tiles
+    column = Column(Integer, nullable=True)
+    row = Column(Integer, nullable=True)
+    zoom = Column(Integer, nullable=True)
 
     __table_args__ = (
         PrimaryKeyConstraint(longitude, latitude, sqlite_on_conflict='IGNORE'),
+        Index('osm_solar_node_tile_index', row, column, zoom),
     )
 
 
-engine = create_engine('sqlite:///data/solar.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+# pragmas applied to every sqlite connection (along with a sqrt function), tuned for loading millions of tiles at a time
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -256000,  # negative means KiB, so ~250MB
+    'temp_store': 'MEMORY',
+    # wait for other writers (e.g. inference workers and the imagery prefetcher) rather than raising database is locked
+    'busy_timeout': 60000,
+}
 
 
-def persist_polygons(names_and_polygons, zoom=21):
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    dbapi_connection.create_function('sqrt', 1, math.sqrt)
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute('PRAGMA {pragma}={value}'.format(pragma=pragma, value=value))
+    cursor.close()
+
+
+class QueryTimer(object):
+    """
+    Times every sql statement run on an engine into the db_read and db_write metrics, and when enabled also accumulates
+    the number of executions and total time taken by each distinct statement.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info['query_start_times'].pop()
+        writes = statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE')
+        metrics.observe('db_write' if writes else 'db_read', elapsed)
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[statement] += 1
+            self.seconds[statement] += elapsed
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.seconds.clear()
+
+    def get_timings(self):
+        """:return: list of (statement, executions, total seconds) tuples, slowest first"""
+        with self.lock:
+            timings = [(statement, self.counts[statement], self.seconds[statement]) for statement in self.counts]
+        return sorted(timings, key=lambda timing: timing[2], reverse=True)
+
+    def format_timings(self, limit=10, statement_length=100):
+        lines = []
+        for statement, executions, seconds in self.get_timings()[:limit]:
+            statement = ' '.join(statement.split())
+            if len(statement) > statement_length:
+                statement = statement[:statement_length - 3] + '...'
+            lines.append("{0:8.2f}s {1:8d}x {2:8.2f}ms avg  {3}".format(seconds, executions,
+                                                                     seconds / executions * 1000, statement))
+        return '\n'.join(lines)
+
+
+# created on first use (or by configure_database), so importing this module never touches the database
+engine = None
+engine_lock = threading.Lock()
+# sessions are per thread, so threads (e.g. inference and the imagery prefetcher) never share one
+Session = scoped_session(sessionmaker(expire_on_commit=False))
+query_timer = QueryTimer()
+session_scope_depth = threading.local()
+
+
+def configure_database(url=DEFAULT_DATABASE_URL, time_queries=False):
+    """
+    (Re)creates the engine every function in this module uses, and creates any missing tables.
+
+    :param url: sqlalchemy database url
+    :param time_queries: also record how long each distinct statement takes in query_timer
+    """
+    global engine
+    Session.remove()
+    if engine is not None:
+        engine.dispose()
+    engine = create_engine(url)
+    query_timer.enabled = time_queries
+    event.listen(engine, 'before_cursor_execute', query_timer.before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', query_timer.after_cursor_execute)
+    Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+
+
+def get_engine():
+    """:return: the engine, connecting to DEFAULT_DATABASE_URL if configure_database hasn't been called yet"""
+    if engine is None:
+        with engine_lock:
+            if engine is None:
+                configure_database()
+    return engine
+
+
+@contextlib.contextmanager
+def session_scope():
+    """
+    Provides the current thread's session, committing when the scope exits (or rolling back if it raises). Scopes nest,
+    so wrapping a whole pipeline stage in one reuses the same session for every call made within it, and only the
+    outermost scope closes the session.
+    """
+    get_engine()
     session = Session()
-    for name, polygon in names_and_polygons:
-        exists = session.query(SearchPolygon).filter(SearchPolygon.name == name).first()
-        if not exists:
-            session.add(SearchPolygon(name=name, centroid_column=polygon.centroid.x, centroid_row=polygon.centroid.y,
-                                      centroid_zoom=zoom))
-    session.commit()
-    session.close()
+    session_scope_depth.value = getattr(session_scope_depth, 'value', 0) + 1
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session_scope_depth.value -= 1
+        if not session_scope_depth.value:
+            Session.remove()
+
+
+def persist_polygons(names_and_polygons, zoom=21):
+    with session_scope() as session:
+        for name, polygon in names_and_polygons:
+            exists = session.query(SearchPolygon).filter(SearchPolygon.name == name).first()
+            if not exists:
+                session.add(SearchPolygon(name=name, centroid_column=polygon.centroid.x,
+                                          centroid_row=polygon.centroid.y, centroid_zoom=zoom))
 
 
-def persist_coords(polygon_name, coords, zoom=21, batch_size=100000):
+def persist_coords(polygon_name, coords, zoom=21, batch_size=100000, compute_centroid_distance=True):
+    persist_coord_chunks(polygon_name, [coords], zoom=zoom, batch_size=batch_size,
+                         compute_centroid_distance=compute_centroid_distance)
+
+
+def persist_coord_chunks(polygon_name, coord_chunks, zoom=21, batch_size=100000, compute_centroid_distance=True):
+    """
+    Persists the inner grid of a polygon from an iterable of coordinate chunks (e.g. the bands yielded by
+    rasterize.iter_coords_inside_polygon), consuming them as they come so the whole grid never has to be in memory
+
+    :param polygon_name: name of the polygon the coordinates are inside of
+    :param coord_chunks: iterable of sequences (lists or ndarrays) of (column, row) coordinates
+    :param zoom: zoom level of the coordinates, defaults to 21
+    :param batch_size: number of tiles to insert per transaction
+    :param compute_centroid_distance: whether to fill in each tile's centroid distance as it's inserted, which saves
+    running compute_centroid_distances afterwards, defaults to True
+    :return: number of coordinates persisted
+    """
     start_time = time.time()
-    session = Session()
-    tiles_to_add = []
-    for coord in coords:
-        if len(tiles_to_add) >= batch_size:
-            session.add_all(tiles_to_add)
-            session.commit()
-            tiles_to_add = []
-        tiles_to_add.append(SlippyTile(polygon_name=polygon_name, column=coord[0], row=coord[1], zoom=zoom))
-    session.add_all(tiles_to_add)
-    session.query(SearchPolygon).filter(SearchPolygon.name == polygon_name).first().inner_coords_calculated = True
-    session.commit()
-    session.close()
-    print(str(time.time() - start_time) + " seconds to complete inner grid persistence for " + polygon_name)
+    row_count = 0
+    centroid = get_polygon_centroid(polygon_name) if compute_centroid_distance else None
+    for coords in coord_chunks:
+        for start in range(0, len(coords), batch_size):
+            with get_engine().begin() as connection:
+                row_count += insert_tiles(connection, coords[start:start + batch_size], zoom=zoom,
+                                          polygon_name=polygon_name, centroid=centroid)
+    with get_engine().begin() as connection:
+        connection.execute(SearchPolygon.__table__.update().where(SearchPolygon.name == polygon_name)
+                           .values(inner_coords_calculated=True))
+    elapsed = time.time() - start_time
+    metrics.observe('persist_coords', elapsed)
+    metrics.increment('tiles_persisted', row_count)
+    print("{seconds} seconds to complete inner grid persistence for {name} ({rate:.0f} rows/s)".format(
+        seconds=elapsed, name=polygon_name, rate=row_count / elapsed if elapsed else 0))
+    return row_count
+
+
+def insert_tiles(connection, coords, zoom=21, polygon_name=None, has_image=False, centroid=None):
+    """
+    Inserts tiles with a single executemany through the Core insert rather than building an ORM object per tile,
+    tiles that already exist are left as they are.
+
+    :param connection: connection to insert with, ideally inside a transaction
+    :param coords: sequence (list or ndarray) of (column, row) coordinates
+    :param zoom: zoom level of the coordinates, defaults to 21
+    :param polygon_name: name of the polygon the tiles belong to, if any
+    :param has_image: whether imagery has already been gathered for the tiles
+    :param centroid: (column, row) centroid of the tiles' polygon, if given each tile's centroid distance is inserted
+    along with it
+    :return: number of coordinates passed to the insert
+    """
+    if hasattr(coords, 'tolist'):
+        coords = coords.tolist()  # plain python numbers are a lot quicker for sqlite3 to bind than numpy scalars
+    if not len(coords):
+        return 0
+    connection.execute(SlippyTile.__table__.insert().prefix_with('OR IGNORE'), [
+        {'column': coord[0], 'row': coord[1], 'zoom': zoom, 'polygon_name': polygon_name, 'has_image': has_image,
+         'centroid_distance': math.hypot(centroid[0] - coord[0], centroid[1] - coord[1]) if centroid else None}
+        for coord in coords])
+    return len(coords)
+
+
+def get_polygon_centroid(name):
+    """
+    :param name: name of the search polygon
+    :return: (column, row) tuple of the polygon's centroid, or None if the polygon isn't in the db
+    """
+    polygons = SearchPolygon.__table__
+    with get_engine().connect() as connection:
+        centroid = connection.execute(select([polygons.c.centroid_column, polygons.c.centroid_row])
+                                      .where(polygons.c.name == name)).first()
+    return tuple(centroid) if centroid else None
 
 
 def get_polygon_names():
-    session = Session()
-    polygons = session.query(SearchPolygon).all()
-    session.close()
+    with session_scope() as session:
+        polygons = session.query(SearchPolygon).all()
     return [polygon.name for polygon in polygons]
 
 
 def get_inner_coords_calculated_polygon_names():
-    session = Session()
-    polygons = session.query(SearchPolygon).filter(SearchPolygon.inner_coords_calculated.is_(True)).all()
-    session.close()
+    with session_scope() as session:
+        polygons = session.query(SearchPolygon).filter(SearchPolygon.inner_coords_calculated.is_(True)).all()
     return [polygon.name for polygon in polygons]
 
 
 def polygon_has_inner_grid(name):
-    session = Session()
-    inner_grid = session.query(SearchPolygon.inner_coords_calculated).filter(SearchPolygon.name == name).first()[0]
-    session.close()
+    with session_scope() as session:
+        inner_grid = session.query(SearchPolygon.inner_coords_calculated).filter(SearchPolygon.name == name).first()[0]
     return inner_grid
 
 
-def compute_centroid_distances(batch_size=10000):
-    session = Session()
-    while True:
-        uncomputed_centroid_tiles = session.query(SlippyTile).filter(SlippyTile.centroid_distance.is_(None),
-                                                                     SlippyTile.polygon_name.isnot(None)
-                                                                     ).limit(batch_size).all()
-        if not uncomputed_centroid_tiles:
-            break
-        for tile in uncomputed_centroid_tiles:
-            tile.centroid_distance = math.sqrt(
-                math.pow(tile.polygon.centroid_row - tile.row, 2) + math.pow(tile.polygon.centroid_column - tile.column,
-                                                                             2))
-        session.commit()
-    session.close()
+def compute_centroid_distances(batch_size=1000000):
+    """
+    Fills in the distance from each tile to its polygon's centroid for any tiles that are missing it, with one
+    correlated UPDATE per range of rowids so sqlite does all of the work (sqrt is registered on every connection in
+    set_sqlite_pragmas as not every sqlite build has it). Tiles persisted through persist_coords already have their
+    distance, so this normally only has to scan.
+
+    :param batch_size: number of rowids to cover with each UPDATE (and transaction)
+    """
+    tiles = SlippyTile.__table__
+    polygons = SearchPolygon.__table__
+    rowid = literal_column('slippy_tiles.rowid')
+    distance = select([func.sqrt((polygons.c.centroid_row - tiles.c.row) * (polygons.c.centroid_row - tiles.c.row) +
+                                 (polygons.c.centroid_column - tiles.c.column) *
+                                 (polygons.c.centroid_column - tiles.c.column))]) \
+        .where(polygons.c.name == tiles.c.polygon_name).as_scalar()
+    with get_engine().connect() as connection:
+        max_rowid = connection.execute(select([func.max(rowid)]).select_from(tiles)).scalar() or 0
+    for start in range(0, max_rowid + 1, batch_size):
+        with get_engine().begin() as connection:
+            connection.execute(tiles.update().where(rowid.between(start, start + batch_size - 1))
+                               .where(tiles.c.centroid_distance.is_(None)).where(tiles.c.polygon_name.isnot(None))
+                               .values(centroid_distance=distance))
 
 
 # marks existing slippy tiles as having imagery in the db, and if the tiles don't exist it creates them (for cases where
 # the imagery gathered goes outside the planned polygon bounds, still need to track it, and maybe use it)
 def mark_has_imagery(base_coord, grid_size, zoom=21):
-    session = Session()
-    # get and update the tiles in this grid that exist
-    tile_query = session.query(SlippyTile).filter(SlippyTile.zoom == zoom).filter(SlippyTile.column.between(
-        base_coord[0], base_coord[0] + grid_size - 1)).filter(SlippyTile.row.between(base_coord[1], base_coord[1] +
-                                                                                     grid_size - 1))
-    tile_query.update({SlippyTile.has_image: True}, synchronize_session='fetch')
-    tiles = tile_query.all()
-
-    # create a meshgrid of points in this grid
-    coords = {}
-    for column in range(base_coord[0], base_coord[0] + 20):
-        for row in range(base_coord[1], base_coord[1] + 20):
-            coords[(column, row)] = True
-    # remove the tiles that we already know exist
-    for tile in tiles:
-        coords.pop((tile.column, tile.row), None)
-    tiles_to_add = []
-    # create new tile objects for the remaining points in the meshgrid and add them to the db
-    for coord in coords.keys():
-        tiles_to_add.append(SlippyTile(column=coord[0], row=coord[1], zoom=zoom, has_image=True))
-    session.add_all(tiles_to_add)
-    session.commit()
-    session.close()
+    tiles = SlippyTile.__table__
+    coords = [(column, row) for row in range(base_coord[1], base_coord[1] + grid_size)
+              for column in range(base_coord[0], base_coord[0] + grid_size)]
+    with get_engine().begin() as connection:
+        # update the tiles in this grid that exist, then create the rest (the insert ignores the ones that exist)
+        connection.execute(tiles.update().where(tiles.c.zoom == zoom)
+                           .where(tiles.c.column.between(base_coord[0], base_coord[0] + grid_size - 1))
+                           .where(tiles.c.row.between(base_coord[1], base_coord[1] + grid_size - 1))
+                           .values(has_image=True))
+        insert_tiles(connection, coords, zoom=zoom, has_image=True)
 
 
 # decimal places to round is so nodes with close lat/lon are only counted as one point,
 # degree precision versus length chart: https://en.wikipedia.org/wiki/Decimal_degrees#Precision
-def query_osm_solar(polygons, decimal_places_to_round=5):
-    api = overpy.Overpass()
-    solar_node_lon_lats = set()
-    for polygon in polygons:
-        # little bit of python magic to massage the polygon into a space separated list of coordinates
-        polygon_coords_string = " ".join([" ".join(map(str, coord)) for coord in zip(*reversed(polygon.boundary.xy))])
-        # I've read that querying within a polygon is a lot slower than querying within a bounding box, so if this
-        # ends up being too slow, feel free to just replace with the bounding box of the polygon
-        query_string = \
-            """
-            [out:json][timeout:2500];
-            (
-            node["generator:source"="solar"](poly:"{poly}");
-            way["generator:source"="solar"](poly:"{poly}");
-            relation["generator:source"="solar"](poly:"{poly}");
-            );
-            out body;
-            >;
-            out skel qt;
-            """.format(poly=polygon_coords_string)
-        result = api.query(query_string)
-        for node in result.nodes:
-            solar_node_lon_lats.add(
-                (round(node.lon, decimal_places_to_round), round(node.lat, decimal_places_to_round)))
-    return solar_node_lon_lats
-
-
-def query_and_persist_osm_solar(polygons):
-    session = Session()
-    solar_node_lon_lats = query_osm_solar(polygons)
-    solar_nodes = []
-    for lon, lat in solar_node_lon_lats:
-        solar_nodes.append(OSMSolarNode(longitude=lon, latitude=lat))
-    session.add_all(solar_nodes)
-    session.commit()
-    session.close()
+def persist_osm_solar_nodes(lon_lats, zoom=21):
+    """
+    Inserts the nodes, along with the tile each one is in, in a single executemany. Nodes that are already there are
+    skipped by the primary key's ON CONFLICT IGNORE so this is an upsert
 
+    :param lon_lats: iterable of (longitude, latitude)
+    :param zoom: zoom level of the tiles to work out
+    """
+    from process_city_shapes import deg2num_array
 
-def query_tile_batch(batch_size=1000000, polygon_name=None):
-    session = Session()
-    tile_query = session.query(SlippyTile).filter(SlippyTile.has_image.is_(True), SlippyTile.inference_ran.is_(True))
-    if polygon_name:
-        tile_query = tile_query.filter(SlippyTile.polygon_name == polygon_name)
-    tiles = tile_query.limit(batch_size).all()
-    session.close()
-    return tiles
+    lon_lats = np.asarray(list(lon_lats), dtype=np.float64).reshape((-1, 2))
+    if not len(lon_lats):
+        return
+    rows = [{'longitude': lon, 'latitude': lat, 'column': column, 'row': row, 'zoom': zoom}
+            for (lon, lat), (column, row) in zip(lon_lats.tolist(), deg2num_array(lon_lats, zoom=zoom).tolist())]
+    with get_engine().begin() as connection:
+        connection.execute(OSMSolarNode.__table__.insert(), rows)
+
+
+def get_pending_inference_filters(after=None):
+    """
+    :param after: (polygon_name, centroid_distance, rowid) key of a tile, only tiles after it in inference order match
+    :return: list of filters matching tiles waiting on inference, written so sqlite uses pending_inference_index
+    """
+    tiles = SlippyTile.__table__
+    filters = [tiles.c.inference_ran == expression.false(), tiles.c.centroid_distance.isnot(None)]
+    if after:
+        filters.append(tuple_(tiles.c.polygon_name, tiles.c.centroid_distance, TILE_ROWID) > tuple_(*after))
+    return filters
+
+
+def get_inference_order():
+    tiles = SlippyTile.__table__
+    # rowid breaks ties between tiles equally far from the centroid, so every tile has a unique key to page from
+    return [tiles.c.polygon_name, tiles.c.centroid_distance, TILE_ROWID]
+
+
+def query_pending_tile_batch(batch_size=400, after=None):
+    """
+    Queries the next batch of tiles waiting on inference, keyset paginated so it costs the same however many tiles are
+    already finished
+
+    :param batch_size: number of tiles to return
+    :param after: key of the last tile of the previous batch, as returned by this function
+    :return: (tiles, key) where key is the key of the last tile in the batch (or after if the batch is empty)
+    """
+    with session_scope() as session:
+        rows = session.query(SlippyTile, SlippyTile.polygon_name, SlippyTile.centroid_distance, TILE_ROWID)\
+            .filter(*get_pending_inference_filters(after)).order_by(*get_inference_order()).limit(batch_size).all()
+    if not rows:
+        return [], after
+    return [row[0] for row in rows], tuple(rows[-1][1:])
 
 
 def query_tile_batch_for_inference(batch_size=400):
-    session = Session()
-    tiles = \
-        session.query(SlippyTile).filter(SlippyTile.centroid_distance.isnot(None), SlippyTile.inference_ran.is_(False))\
-            .order_by(SlippyTile.polygon_name, SlippyTile.centroid_distance).limit(batch_size).all()
-    session.close()
-    return tiles
+    return query_pending_tile_batch(batch_size=batch_size)[0]
+
+
+def query_tile_coordinates_for_inference(limit=4000, after=None):
+    """
+    Looks further ahead in the same order as query_pending_tile_batch, without loading whole tiles
+
+    :param limit: number of tiles to look ahead
+    :param after: key of the tile to look ahead from, see query_pending_tile_batch
+    :return: list of (column, row, zoom) tuples
+    """
+    tiles = SlippyTile.__table__
+    with get_engine().connect() as connection:
+        return [tuple(coordinates) for coordinates in connection.execute(
+            select([tiles.c.column, tiles.c.row, tiles.c.zoom]).where(and_(*get_pending_inference_filters(after)))
+            .order_by(*get_inference_order()).limit(limit))]
+
+
+# what InferenceWorkQueue does with tiles near an OSM solar node: hand them out after every other tile, or never
+OSM_SCHEDULING_MODES = ['defer', 'skip']
+
+
+class InferenceWorkQueue(object):
+    """
+    Hands out the tiles waiting on inference a batch at a time, in order of polygon and then distance from the
+    polygon's centroid. Each batch picks up from the key of the last tile handed out rather than from the start, so
+    upcoming batches can be looked at (or even handed out) before the previous ones are persisted. Once the end is
+    reached it starts over from the beginning, to pick up any tiles that were handed out but never finished.
+
+    Given an osm_radius, the tiles within that many tiles of an OSM solar node are held back, since maproulette throws
+    away the clusters they'd be in anyway. They're handed out once every other tile is finished if osm_mode is
+    'defer', and never if it's 'skip'.
+    """
+
+    def __init__(self, osm_radius=None, osm_mode='defer'):
+        self.last_key = None
+        self.osm_mode = osm_mode
+        # zoom to the sorted keys of every tile near an OSM solar node, emptied once deferred tiles are handed out
+        self.osm_neighbourhoods = {}
+        # zoom to which of those tiles have come up in a batch and been held back
+        self.osm_held_back = {}
+        if osm_radius is not None:
+            node_tiles = query_osm_solar_node_tiles()
+            for zoom in np.unique(node_tiles[:, 2]).tolist():
+                keys = clustering.get_neighbourhood_keys(node_tiles[node_tiles[:, 2] == zoom, 0:2], osm_radius)
+                self.osm_neighbourhoods[zoom] = keys
+                self.osm_held_back[zoom] = np.zeros(len(keys), dtype=bool)
+
+    @property
+    def held_back_count(self):
+        """:return: number of distinct tiles held back for being near an OSM solar node so far"""
+        return sum(int(np.count_nonzero(held_back)) for held_back in self.osm_held_back.values())
+
+    def find_near_osm(self, coordinates, hold_back=True):
+        """
+        :param coordinates: int64 ndarray of shape (x,3) of each tile's (column, row, zoom)
+        :param hold_back: count the tiles near an OSM solar node as held back
+        :return: bool ndarray of shape (x,), which of the tiles are near an OSM solar node
+        """
+        near = np.zeros(len(coordinates), dtype=bool)
+        for zoom, keys in self.osm_neighbourhoods.items():
+            at_zoom = np.flatnonzero(coordinates[:, 2] == zoom)
+            positions = clustering.find_coordinates(keys, np.arange(len(keys)), coordinates[at_zoom, 0:2])
+            near[at_zoom] = positions >= 0
+            if hold_back:
+                positions = positions[positions >= 0]
+                metrics.increment('inference_tiles_held_back',
+                                  int(np.count_nonzero(~self.osm_held_back[zoom][positions])))
+                self.osm_held_back[zoom][positions] = True
+        return near
+
+    def query_batch(self, batch_size):
+        """Queries batches until one has tiles that aren't held back in it, or the end is reached."""
+        while True:
+            tiles, self.last_key = query_pending_tile_batch(batch_size=batch_size, after=self.last_key)
+            if not tiles or not self.osm_neighbourhoods:
+                return tiles
+            near = self.find_near_osm(np.array([(tile.column, tile.row, tile.zoom) for tile in tiles], dtype=np.int64))
+            if not near.all():
+                return [tile for tile, is_near in zip(tiles, near.tolist()) if not is_near]
+
+    def next_batch(self, batch_size=400):
+        tiles = self.query_batch(batch_size)
+        if not tiles and self.last_key is not None:
+            self.last_key = None
+            tiles = self.query_batch(batch_size)
+        if not tiles and self.osm_neighbourhoods and self.osm_mode == 'defer':
+            print("Every other tile is finished, running inference on the {count} tiles deferred for being near an OSM "
+                  "solar node".format(count=self.held_back_count))
+            self.osm_neighbourhoods = {}
+            self.last_key = None
+            tiles = self.query_batch(batch_size)
+        return tiles
+
+    def peek(self, limit=4000):
+        """:return: (column, row, zoom) tuples of the next limit tiles that will be handed out, less any held back"""
+        coordinates = query_tile_coordinates_for_inference(limit=limit, after=self.last_key)
+        if not coordinates or not self.osm_neighbourhoods:
+            return coordinates
+        near = self.find_near_osm(np.array(coordinates, dtype=np.int64), hold_back=False)
+        return [coordinate for coordinate, is_near in zip(coordinates, near.tolist()) if not is_near]
 
 
 def update_tiles(tiles):
-    session = Session()
-    session.add_all(tiles)
-    session.commit()
-    session.close()
+    with session_scope() as session:
+        session.add_all(tiles)
 
 
 def query_tiles_over_threshold(threshold=0.25, polygon_name=None, filter_clustered=False):
-    session = Session()
-    coordinate_query = session.query(SlippyTile).filter(SlippyTile.panel_softmax.isnot(None),
-                                                        SlippyTile.panel_softmax >= threshold).order_by(
-        desc(SlippyTile.panel_softmax))
+    with session_scope() as session:
+        coordinate_query = session.query(SlippyTile).filter(SlippyTile.panel_softmax.isnot(None),
+                                                            SlippyTile.panel_softmax >= threshold).order_by(
+            desc(SlippyTile.panel_softmax))
+        if polygon_name:
+            coordinate_query = coordinate_query.filter(SlippyTile.polygon_name == polygon_name)
+        if filter_clustered:
+            coordinate_query = coordinate_query.filter(SlippyTile.cluster_id.is_(None))
+        coordinates = coordinate_query.all()
+    return coordinates
+
+
+def iter_tiles_over_threshold(threshold=0.25, polygon_name=None, filter_clustered=False, order_by_softmax=False,
+                              order_by_cluster=False, chunk_size=100000):
+    """
+    Streams the tiles over threshold in chunks of lightweight rows, rather than loading a SlippyTile for every one of
+    them like query_tiles_over_threshold, so memory stays bounded however many positive tiles there are
+
+    :param threshold: minimum panel softmax
+    :param polygon_name: optional name to filter for
+    :param filter_clustered: only stream tiles that aren't in a cluster yet
+    :param order_by_softmax: stream the most confident tiles first, costs a sort of every tile over threshold
+    :param order_by_cluster: stream every tile of a cluster one after the other (the unclustered tiles together as
+    well), the cluster with the most confident tile first and then by cluster id, costs a sort of every tile over
+    threshold
+    :param chunk_size: maximum number of tiles in each chunk
+    :return: yields structured ndarrays of TILE_ROW_DTYPE
+    """
+    tiles = SlippyTile.__table__
+    # cluster_id is a string column, cast here so the rows go straight into an array
+    cluster_id = func.coalesce(cast(tiles.c.cluster_id, Integer), -1)
+    filters = [tiles.c.panel_softmax.isnot(None), tiles.c.panel_softmax >= threshold]
     if polygon_name:
-        coordinate_query = coordinate_query.filter(SlippyTile.polygon_name == polygon_name)
+        filters.append(tiles.c.polygon_name == polygon_name)
     if filter_clustered:
-        coordinate_query = coordinate_query.filter(SlippyTile.cluster_id.is_(None))
-    coordinates = coordinate_query.all()
-    session.close()
-    return coordinates
+        filters.append(tiles.c.cluster_id.is_(None))
+    tile_query = select([tiles.c.column, tiles.c.row, tiles.c.zoom, tiles.c.panel_softmax, cluster_id])\
+        .where(and_(*filters))
+    if order_by_cluster:
+        # a window rather than a join against the grouped clusters, which sqlite would scan once per tile
+        cluster_confidence = func.max(tiles.c.panel_softmax).over(partition_by=cluster_id)
+        tile_query = tile_query.order_by(desc(cluster_confidence), cluster_id)
+    if order_by_softmax:
+        tile_query = tile_query.order_by(desc(tiles.c.panel_softmax))
+    with get_engine().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(tile_query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield np.array([tuple(row) for row in rows], dtype=TILE_ROW_DTYPE)
+
+
+def query_tile_rows_over_threshold(threshold=0.25, polygon_name=None, filter_clustered=False, order_by_softmax=False):
+    """
+    :return: structured ndarray of TILE_ROW_DTYPE of every tile over threshold, see iter_tiles_over_threshold
+    """
+    return np.concatenate([np.empty(0, dtype=TILE_ROW_DTYPE)] + list(iter_tiles_over_threshold(
+        threshold=threshold, polygon_name=polygon_name, filter_clustered=filter_clustered,
+        order_by_softmax=order_by_softmax)))
 
 
-def get_new_positive_cluster_id():
-    session = Session()
-    positive_cluster = PositiveCluster()
-    session.add(positive_cluster)
-    session.commit()
-    positive_cluster_id = positive_cluster.id
-    session.close()
-    return positive_cluster_id
+def query_positive_tile_array(threshold=0.25, polygon_name=None):
+    """
+    Queries the tiles over threshold straight into an array, without building an ORM object per tile
+
+    :param threshold: minimum panel softmax
+    :param polygon_name: optional name to filter for
+    :return: int64 ndarray of shape (x,4) with columns column, row, zoom and cluster id (-1 if unclustered)
+    """
+    tile_rows = query_tile_rows_over_threshold(threshold=threshold, polygon_name=polygon_name)
+    return np.column_stack((tile_rows['column'], tile_rows['row'], tile_rows['zoom'], tile_rows['cluster_id']))
+
+
+def query_clustered_tile_rows(coordinates, zoom, threshold=0.25, polygon_name=None):
+    """
+    Looks up which of the given tiles are over threshold and already in a cluster, by joining a temp table of the
+    coordinates against the primary key rather than scanning every tile over threshold
+
+    :param coordinates: int64 ndarray of shape (x,2) of (column, row)
+    :param zoom: zoom level of the coordinates
+    :param threshold: minimum panel softmax
+    :param polygon_name: optional name to filter for
+    :return: structured ndarray of TILE_ROW_DTYPE of the clustered tiles among the coordinates
+    """
+    rows = []
+    with get_engine().connect() as connection:
+        with connection.begin():
+            connection.execute(text('CREATE TEMP TABLE IF NOT EXISTS wanted_tiles ("column" INTEGER, "row" INTEGER, '
+                                    'PRIMARY KEY ("column", "row") ON CONFLICT IGNORE)'))
+            connection.execute(text('DELETE FROM wanted_tiles'))
+            if len(coordinates):
+                connection.execute(text('INSERT INTO wanted_tiles VALUES (:column, :row)'),
+                                   [{'column': column, 'row': row}
+                                    for column, row in np.asarray(coordinates, dtype=np.int64).tolist()])
+                # the cross join makes sqlite look each wanted tile up by primary key, rather than scan the polygon's
+                # tiles through centroid_index
+                rows = connection.execute(text(
+                    'SELECT t."column", t."row", t.zoom, t.panel_softmax, CAST(t.cluster_id AS INTEGER) '
+                    'FROM wanted_tiles w CROSS JOIN slippy_tiles t '
+                    'ON t."row" = w."row" AND t."column" = w."column" AND t.zoom = :zoom '
+                    'WHERE t.panel_softmax >= :threshold AND t.cluster_id IS NOT NULL' +
+                    (' AND t.polygon_name = :polygon_name' if polygon_name else '')),
+                    zoom=zoom, threshold=threshold, polygon_name=polygon_name).fetchall()
+            connection.execute(text('DROP TABLE wanted_tiles'))
+    return np.array([tuple(row) for row in rows], dtype=TILE_ROW_DTYPE)
+
+
+def merge_cluster_ids(merged_cluster_ids):
+    """
+    Moves every tile of some clusters into other clusters with a single update, and deletes the emptied clusters
+
+    :param merged_cluster_ids: dict of the id of each cluster to merge away to the id of the cluster it's merged into
+    """
+    if not merged_cluster_ids:
+        return
+    tiles = SlippyTile.__table__
+    # cluster_id is a string column
+    merged_cluster_ids = {str(old_id): str(new_id) for old_id, new_id in merged_cluster_ids.items()}
+    clusters = PositiveCluster.__table__
+    with get_engine().begin() as connection:
+        connection.execute(tiles.update().where(tiles.c.cluster_id.in_(list(merged_cluster_ids)))
+                           .values(cluster_id=case(merged_cluster_ids, value=tiles.c.cluster_id)))
+        connection.execute(clusters.delete().where(clusters.c.id.in_([int(old_id) for old_id in merged_cluster_ids])))
+
+
+def remove_stale_clusters(threshold=0.25):
+    """
+    Takes the tiles that have dropped below threshold out of their clusters, then deletes every cluster without any
+    tiles left in it
+
+    :param threshold: minimum panel softmax
+    :return: number of clusters deleted
+    """
+    tiles = SlippyTile.__table__
+    clusters = PositiveCluster.__table__
+    with get_engine().begin() as connection:
+        connection.execute(tiles.update().where(tiles.c.cluster_id.isnot(None))
+                           .where(or_(tiles.c.panel_softmax.is_(None), tiles.c.panel_softmax < threshold))
+                           .values(cluster_id=None))
+        # cluster_id is a string column
+        clustered = select([cast(tiles.c.cluster_id, Integer)]).where(tiles.c.cluster_id.isnot(None))
+        return connection.execute(clusters.delete().where(clusters.c.id.notin_(clustered))).rowcount
+
+
+def allocate_positive_cluster_ids(count):
+    """
+    Creates count new positive clusters with a single insert
+
+    :param count: number of clusters to create
+    :return: list of the new clusters' ids
+    """
+    clusters = PositiveCluster.__table__
+    with get_engine().begin() as connection:
+        max_id = connection.execute(select([func.max(clusters.c.id)])).scalar() or 0
+        cluster_ids = list(range(max_id + 1, max_id + 1 + count))
+        if cluster_ids:
+            connection.execute(clusters.insert(), [{'id': cluster_id} for cluster_id in cluster_ids])
+    return cluster_ids
+
+
+def update_tile_cluster_ids(tile_array):
+    """
+    Sets the cluster id of many tiles with a single executemany
+
+    :param tile_array: ndarray of shape (x,4) with columns column, row, zoom and cluster id
+    """
+    if not len(tile_array):
+        return
+    tiles = SlippyTile.__table__
+    with get_engine().begin() as connection:
+        connection.execute(
+            tiles.update().where(tiles.c.column == bindparam('tile_column')).where(tiles.c.row == bindparam('tile_row'))
+            .where(tiles.c.zoom == bindparam('tile_zoom')).values(cluster_id=bindparam('tile_cluster_id')),
+            [{'tile_column': column, 'tile_row': row, 'tile_zoom': zoom, 'tile_cluster_id': cluster_id}
+             for column, row, zoom, cluster_id in np.asarray(tile_array).tolist()])
+
+
+def iter_extra_imagery_batches(polygon_name, threshold=0.25, batch_size=100000):
+    """
+    Walks every tile of a polygon that has imagery but doesn't need it anymore, i.e. inference has been ran on it and
+    it isn't over the threshold or bordering a tile that is. The tiles to keep are worked out once, in sqlite, into a
+    temp table, and the rest are keyset paginated by rowid so none get missed however many there are.
+
+    :param polygon_name: name of the polygon to walk
+    :param threshold: panel softmax at or above which a tile (and its border tiles) keep their imagery
+    :param batch_size: number of tiles to yield at a time
+    :return: yields lists of (column, row, zoom) tuples
+    """
+    with get_engine().connect() as connection:
+        with connection.begin():
+            connection.execute(text('CREATE TEMP TABLE IF NOT EXISTS keep_tiles '
+                                    '("column" INTEGER, "row" INTEGER, zoom INTEGER, '
+                                    'PRIMARY KEY ("column", "row", zoom) ON CONFLICT IGNORE)'))
+            connection.execute(text('DELETE FROM keep_tiles'))
+            connection.execute(text(
+                'WITH offsets(value) AS (VALUES (-1), (0), (1)) '
+                'INSERT INTO keep_tiles SELECT t."column" + c.value, t."row" + r.value, t.zoom '
+                'FROM slippy_tiles t, offsets c, offsets r '
+                'WHERE t.polygon_name = :polygon_name AND t.panel_softmax >= :threshold'),
+                polygon_name=polygon_name, threshold=threshold)
+        last_rowid = -1
+        while True:
+            rows = connection.execute(text(
+                'SELECT t."column", t."row", t.zoom, t.rowid FROM slippy_tiles t '
+                'WHERE t.polygon_name = :polygon_name AND t.has_image = 1 AND t.inference_ran = 1 '
+                'AND t.rowid > :last_rowid AND NOT EXISTS (SELECT 1 FROM keep_tiles k '
+                'WHERE k."column" = t."column" AND k."row" = t."row" AND k.zoom = t.zoom) '
+                'ORDER BY t.rowid LIMIT :batch_size'),
+                polygon_name=polygon_name, last_rowid=last_rowid, batch_size=batch_size).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][3]
+            yield [tuple(row[:3]) for row in rows]
+        connection.execute(text('DROP TABLE keep_tiles'))
+
+
+def mark_no_imagery(coordinates):
+    """
+    Marks tiles as not having imagery anymore with a single executemany
+
+    :param coordinates: list of (column, row, zoom) tuples
+    """
+    if not coordinates:
+        return
+    tiles = SlippyTile.__table__
+    with get_engine().begin() as connection:
+        connection.execute(
+            tiles.update().where(tiles.c.column == bindparam('tile_column')).where(tiles.c.row == bindparam('tile_row'))
+            .where(tiles.c.zoom == bindparam('tile_zoom')).values(has_image=False),
+            [{'tile_column': column, 'tile_row': row, 'tile_zoom': zoom} for column, row, zoom in coordinates])
+
+
+def query_grids_needing_imagery(grid_keys, grid_size):
+    """
+    :param grid_keys: list of (column, row, zoom) of the top left tile of query grids
+    :param grid_size: number of tiles on a side of each grid
+    :return: set of the grid keys where a polygon tile in the grid, or in the ring of tiles around it, still has imagery
+    """
+    tiles = SlippyTile.__table__
+    needed = set()
+    with get_engine().connect() as connection:
+        for column, row, zoom in grid_keys:
+            # an IN on row lets sqlite seek the primary key once per row, rather than scanning every column of a range
+            tile_query = select([literal_column('1')]).where(tiles.c.polygon_name.isnot(None))\
+                .where(tiles.c.has_image == expression.true()).where(tiles.c.zoom == zoom)\
+                .where(tiles.c.row.in_(list(range(row - 1, row + grid_size + 1))))\
+                .where(tiles.c.column.between(column - 1, column + grid_size)).limit(1)
+            if connection.execute(tile_query).first() is not None:
+                needed.add((column, row, zoom))
+    return needed
+
+
+def join_osm_solar_nodes(tile_query):
+    """
+    :param tile_query: select from slippy_tiles
+    :return: the select joined to the OSM solar nodes in each of its tiles, so only tiles containing one are selected
+    """
+    tiles, nodes = SlippyTile.__table__, OSMSolarNode.__table__
+    return tile_query.select_from(tiles.join(nodes, and_(nodes.c.row == tiles.c.row, nodes.c.column == tiles.c.column,
+                                                         nodes.c.zoom == tiles.c.zoom)))
+
+
+def query_cluster_ids_containing_osm_nodes(threshold=0.25, polygon_name=None):
+    """
+    Finds the clusters that already have a solar node in OSM, with a join on tile coordinates between the tiles over
+    threshold and the nodes (through osm_solar_node_tile_index) rather than testing every node in the database against
+    every cluster
+
+    :param threshold: minimum panel softmax
+    :param polygon_name: optional name to filter for
+    :return: set of the cluster ids (-1 for unclustered tiles) with an OSM solar node in one of their tiles
+    """
+    tiles = SlippyTile.__table__
+    cluster_query = join_osm_solar_nodes(select([func.coalesce(cast(tiles.c.cluster_id, Integer), -1)]).distinct())\
+        .where(tiles.c.panel_softmax.isnot(None)).where(tiles.c.panel_softmax >= threshold)
+    if polygon_name:
+        cluster_query = cluster_query.where(tiles.c.polygon_name == polygon_name)
+    with get_engine().connect() as connection:
+        return {cluster_id for cluster_id, in connection.execute(cluster_query)}
+
+
+def query_osm_coverage(threshold=0.25, polygon_name=None):
+    """
+    Counts how the tiles over threshold line up with the solar panels already mapped in OSM
+
+    :param threshold: minimum panel softmax
+    :param polygon_name: optional name to filter for
+    :return: dict of the number of tiles with an OSM solar node in them ("osm_tiles"), how many of those have been
+    through inference ("osm_tiles_classified") and how many of those are over threshold ("osm_tiles_detected")
+    """
+    tiles = SlippyTile.__table__
+    # a tile can have several nodes in it, but should only be counted once
+    osm_tiles = join_osm_solar_nodes(select([tiles.c.row, tiles.c.column, tiles.c.zoom, tiles.c.inference_ran,
+                                             tiles.c.panel_softmax]).distinct())
+    if polygon_name:
+        osm_tiles = osm_tiles.where(tiles.c.polygon_name == polygon_name)
+    osm_tiles = osm_tiles.alias('osm_tiles')
+    coverage_query = select([
+        func.count(),
+        func.coalesce(func.sum(cast(osm_tiles.c.inference_ran, Integer)), 0),
+        func.coalesce(func.sum(cast(osm_tiles.c.panel_softmax >= threshold, Integer)), 0)
+    ]).select_from(osm_tiles)
+    with get_engine().connect() as connection:
+        osm_tiles, classified, detected = connection.execute(coverage_query).first()
+    return {'osm_tiles': osm_tiles, 'osm_tiles_classified': classified, 'osm_tiles_detected': detected}
+
+
+def query_osm_solar_node_tiles():
+    """:return: int64 ndarray of shape (x,3) of the distinct (column, row, zoom) of the tiles OSM solar nodes are in"""
+    nodes = OSMSolarNode.__table__
+    with get_engine().connect() as connection:
+        rows = connection.execute(select([nodes.c.column, nodes.c.row, nodes.c.zoom]).distinct()
+                                  .where(nodes.c.zoom.isnot(None))).fetchall()
+    return np.array([tuple(row) for row in rows], dtype=np.int64).reshape((-1, 3))
 
 
 def get_osm_pv_nodes():
-    session = Session()
-    nodes = session.query(OSMSolarNode).all()
-    session.close()
+    with session_scope() as session:
+        nodes = session.query(OSMSolarNode).all()
     return [(node.longitude, node.latitude) for node in nodes]
 
 
@@ -266,15 +851,14 @@ def get_lat_lon_for_largest_clusters(limit=10, polygon_name=None):
     :param polygon_name: optional name to filter for
     :return: list of lat_lon tuples near each cluster (exact center doesn't really matter for my use case)
     """
-    session = Session()
-    cluster_query = session.query(SlippyTile.cluster_id).filter(SlippyTile.cluster_id.isnot(None))
-    if polygon_name:
-        cluster_query = cluster_query.filter(SlippyTile.polygon_name == polygon_name)
-    tuple_list = cluster_query.group_by(SlippyTile.cluster_id).order_by(desc(count(SlippyTile.cluster_id))).limit(
-        limit).all()
-    lat_lons = []
-    for cluster_id, in tuple_list:
-        lat_lons.append(reversed(num2deg(session.query(SlippyTile.column, SlippyTile.row).filter(
-            SlippyTile.cluster_id == cluster_id).limit(1).first())))
-    session.close()
+    with session_scope() as session:
+        cluster_query = session.query(SlippyTile.cluster_id).filter(SlippyTile.cluster_id.isnot(None))
+        if polygon_name:
+            cluster_query = cluster_query.filter(SlippyTile.polygon_name == polygon_name)
+        tuple_list = cluster_query.group_by(SlippyTile.cluster_id).order_by(
+            desc(count(SlippyTile.cluster_id))).limit(limit).all()
+        lat_lons = []
+        for cluster_id, in tuple_list:
+            lat_lons.append(reversed(num2deg(session.query(SlippyTile.column, SlippyTile.row).filter(
+                SlippyTile.cluster_id == cluster_id).limit(1).first())))
     return lat_lons
\ No newline at end of file